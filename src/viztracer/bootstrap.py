@@ -0,0 +1,102 @@
+# Licensed under the Apache License: http://www.apache.org/licenses/LICENSE-2.0
+# For details: https://github.com/gaogaotiantian/viztracer/blob/master/NOTICE.txt
+
+# This is the entry of the child processes of a traced process
+#   python -m viztracer.bootstrap <config> -- script.py args
+#   python -m viztracer.bootstrap <config> -m module args
+#   python -m viztracer.bootstrap <config> -c code args
+# The config is resolved and serialized in the parent process, so unlike
+# `python -m viztracer`, the child does not need to parse the arguments or
+# set up VizUI. The child still imports the viztracer package, which brings
+# in VizTracer and the multiprocess patches with it, because the child needs
+# them to save the report and to trace its own children. Keep the other
+# imports of this file minimal.
+
+import atexit
+import base64
+import json
+import os
+import sys
+import threading
+import types
+from typing import Any
+
+
+def encode_config(kwargs: dict[str, Any]) -> str:
+    # The config could be passed through a shell, so make it a safe string
+    return base64.urlsafe_b64encode(json.dumps(kwargs).encode("utf-8")).decode("ascii")
+
+
+def decode_config(config: str) -> dict[str, Any]:
+    return json.loads(base64.urlsafe_b64decode(config.encode("ascii")))
+
+
+def run(config: str, argv: list[str]) -> None:
+    from .viztracer import VizTracer
+
+    kwargs = decode_config(config)
+
+    if argv[0] == "-m":
+        import runpy
+
+        code: types.CodeType | str = (
+            "run_module(modname, run_name='__main__', alter_sys=True)"
+        )
+        global_dict = {"run_module": runpy.run_module, "modname": argv[1]}
+        sys.argv = argv[1:]
+        sys.path.insert(0, os.getcwd())
+    else:
+        main_mod = types.ModuleType("__main__")
+        if argv[0] == "-c":
+            setattr(main_mod, "__file__", "<string>")
+            code = compile(argv[1], "<string>", "exec")
+            sys.argv = ["-c"] + argv[2:]
+        else:
+            if argv[0] == "--":
+                argv = argv[1:]
+            file_name = argv[0]
+            if not os.path.isfile(file_name):
+                import shutil
+
+                if (file_path := shutil.which(file_name)) is None:
+                    print(f"No such file as {file_name}")
+                    sys.exit(1)
+                file_name = file_path
+            with open(file_name, "rb") as f:
+                code_string = f.read()
+            setattr(main_mod, "__file__", os.path.abspath(file_name))
+            code = compile(code_string, os.path.abspath(file_name), "exec")
+            sys.path.insert(0, os.path.dirname(file_name))
+            sys.argv = argv[:]
+        setattr(main_mod, "__builtins__", __builtins__)
+        # __mp_main__ should be a duplicate of __main__ for pickle
+        sys.modules["__main__"] = sys.modules["__mp_main__"] = main_mod
+        global_dict = main_mod.__dict__
+
+    kwargs["process_name"] = "python -c" if argv[0] == "-c" else sys.argv[0]
+
+    tracer = VizTracer(**kwargs)
+    tracer.register_exit()
+    tracer.start()
+
+    exec(code, global_dict)
+
+    tracer.stop(stop_option="flush_as_finish")
+
+    # Same as VizUI.run_code, concurrent.futures needs threading._threading_atexits
+    # to be executed to release the resources
+    if threading._threading_atexits:  # type: ignore
+        for atexit_call in reversed(threading._threading_atexits):  # type: ignore
+            atexit_call()
+        threading._threading_atexits = []  # type: ignore
+
+
+def main() -> None:
+    try:
+        run(sys.argv[1], sys.argv[2:])
+    finally:
+        atexit._run_exitfuncs()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,11 +2,13 @@
 # For details: https://github.com/gaogaotiantian/viztracer/blob/master/NOTICE.txt
 
 import functools
+import math
 import multiprocessing
 import os
 import time
 from typing import Any, Callable, TypeVar, overload
 
+from .snaptrace import SparseWrapper
 from .viztracer import VizTracer, get_tracer
 
 R = TypeVar("R")
@@ -96,16 +98,38 @@ def trace_and_save(
     return inner
 
 
+_SAMPLE_SCALE = 1 << 32
+
+
 def _log_sparse_wrapper(
-    func: Callable, stack_depth: int = 0, dynamic_tracer_check: bool = False
+    func: Callable,
+    stack_depth: int = 0,
+    dynamic_tracer_check: bool = False,
+    sample_rate: float = 1.0,
 ) -> Callable:
     if not dynamic_tracer_check:
         tracer = get_tracer()
         if tracer is None or not tracer.log_sparse:
             return func
 
+    if not 0 <= sample_rate <= 1:
+        raise ValueError("sample_rate should be between 0 and 1")
+
+    if stack_depth == 0:
+        # The native wrapper logs the function as a normal entry
+        sparse_wrapper = SparseWrapper(
+            func, None if dynamic_tracer_check else tracer, sample_rate
+        )
+        return functools.update_wrapper(sparse_wrapper, func)
+
+    # The same way as the sample_rate of the tracer, sample the
+    # invocations evenly so 1 / N is exactly 1 out of N
+    sample_step = math.ceil(sample_rate * _SAMPLE_SCALE)
+    sample_credit = 0
+
     @functools.wraps(func)
     def wrapper(*args, **kwargs) -> Any:
+        nonlocal sample_credit
         local_tracer = get_tracer() if dynamic_tracer_check else tracer
 
         if local_tracer is None:
@@ -113,30 +137,21 @@ def _log_sparse_wrapper(
         assert isinstance(local_tracer, VizTracer)
 
         if local_tracer.log_sparse and not local_tracer.enable:
-            if stack_depth > 0:
-                orig_max_stack_depth = local_tracer.max_stack_depth
-                local_tracer.max_stack_depth = stack_depth
-                local_tracer.log_sparse = False
-                local_tracer.start()
-                ret = func(*args, **kwargs)
-                local_tracer.stop()
-                local_tracer.log_sparse = True
-                local_tracer.max_stack_depth = orig_max_stack_depth
-                return ret
-            else:
-                start = local_tracer.getts()
-                ret = func(*args, **kwargs)
-                dur = local_tracer.getts() - start
-                code = func.__code__
-                raw_data = {
-                    "ph": "X",
-                    "name": f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})",
-                    "ts": start,
-                    "dur": dur,
-                    "cat": "FEE",
-                }
-                local_tracer.add_raw(raw_data)
-                return ret
+            if sample_step < _SAMPLE_SCALE:
+                sample_credit += sample_step
+                if sample_credit < _SAMPLE_SCALE:
+                    return func(*args, **kwargs)
+                sample_credit -= _SAMPLE_SCALE
+
+            orig_max_stack_depth = local_tracer.max_stack_depth
+            local_tracer.max_stack_depth = stack_depth
+            local_tracer.log_sparse = False
+            local_tracer.start()
+            ret = func(*args, **kwargs)
+            local_tracer.stop()
+            local_tracer.log_sparse = True
+            local_tracer.max_stack_depth = orig_max_stack_depth
+            return ret
         elif local_tracer.enable and not local_tracer.log_sparse:
             # The call is made from the module inside, so if `trace_self=False` it will be ignored.
             # To avoid this behavior, we need to reset the counter `ignore_stack_depth`` and then
@@ -150,14 +165,20 @@ def _log_sparse_wrapper(
 
 @overload
 def log_sparse(
-    func: None, stack_depth: int = 0, dynamic_tracer_check: bool = False
+    func: None,
+    stack_depth: int = 0,
+    dynamic_tracer_check: bool = False,
+    sample_rate: float = 1.0,
 ) -> Callable[[Callable[..., R]], Callable[..., R]]:
     pass  # pragma: no cover
 
 
 @overload
 def log_sparse(
-    func: Callable[..., R], stack_depth: int = 0, dynamic_tracer_check: bool = False
+    func: Callable[..., R],
+    stack_depth: int = 0,
+    dynamic_tracer_check: bool = False,
+    sample_rate: float = 1.0,
 ) -> Callable[..., R]:
     pass  # pragma: no cover
 
@@ -166,13 +187,18 @@ def log_sparse(
     func: Callable[..., R] | None = None,
     stack_depth: int = 0,
     dynamic_tracer_check: bool = False,
+    sample_rate: float = 1.0,
 ) -> Callable[..., R] | Callable[[Callable[..., R]], Callable[..., R]]:
     if func is None:
         return functools.partial(
             _log_sparse_wrapper,
             stack_depth=stack_depth,
             dynamic_tracer_check=dynamic_tracer_check,
+            sample_rate=sample_rate,
         )
     return _log_sparse_wrapper(
-        func=func, stack_depth=stack_depth, dynamic_tracer_check=dynamic_tracer_check
+        func=func,
+        stack_depth=stack_depth,
+        dynamic_tracer_check=dynamic_tracer_check,
+        sample_rate=sample_rate,
     )
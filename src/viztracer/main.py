@@ -27,6 +27,7 @@ from .util import (
     frame_stack_has_func,
     pid_exists,
     same_line_print,
+    size_str_to_bytes,
     time_str_to_us,
     unique_file_name,
 )
@@ -75,6 +76,15 @@ class VizUI:
             default=1000000,
             help="size of circular buffer. How many entries can it store",
         )
+        parser.add_argument(
+            "--tracer_memory",
+            nargs="?",
+            default=None,
+            help=(
+                "memory limit of circular buffer, like 512MB. "
+                "Overrides --tracer_entries and evicts the oldest entries when it's full"
+            ),
+        )
         filename_group = parser.add_mutually_exclusive_group()
         filename_group.add_argument(
             "--output_file",
@@ -96,6 +106,24 @@ class VizUI:
             default=None,
             help="output directory. Should only be used when --pid_suffix is used",
         )
+        parser.add_argument(
+            "--rotate_interval",
+            type=float,
+            default=0,
+            help="save the trace to a new file every ROTATE_INTERVAL seconds",
+        )
+        parser.add_argument(
+            "--rotate_entries",
+            type=int,
+            default=0,
+            help="save the trace to a new file when the buffer has ROTATE_ENTRIES entries",
+        )
+        parser.add_argument(
+            "--rotate_keep",
+            type=int,
+            default=0,
+            help="only keep the latest ROTATE_KEEP rotated files",
+        )
         parser.add_argument(
             "--file_info", action="store_true", default=False, help=argparse.SUPPRESS
         )
@@ -124,6 +152,82 @@ class VizUI:
             default="0",
             help="minimum duration of function to log",
         )
+        parser.add_argument(
+            "--tail_roots",
+            nargs="*",
+            default=None,
+            help=(
+                "only keep the entries under these functions if the function "
+                "takes longer than --tail_duration"
+            ),
+        )
+        parser.add_argument(
+            "--tail_duration",
+            default="0",
+            help="minimum duration of the tail roots to keep the entries under them",
+        )
+        parser.add_argument(
+            "--trigger_functions",
+            nargs="*",
+            default=None,
+            help=(
+                "only log the entries in a thread while it's in one of these "
+                "functions, --max_stack_depth counts from them"
+            ),
+        )
+        parser.add_argument(
+            "--sample_rate",
+            type=float,
+            default=1.0,
+            help=(
+                "the ratio of the invocations of --trigger_functions, or --tail_roots, "
+                "to trace, between 0 and 1"
+            ),
+        )
+        parser.add_argument(
+            "--include_functions",
+            nargs="*",
+            default=None,
+            help=(
+                "only trace these functions, and the C functions they call. "
+                "Other functions run at full speed on Python 3.12+"
+            ),
+        )
+        parser.add_argument(
+            "--line_functions",
+            nargs="*",
+            default=None,
+            help="log the time and hits of each line of these functions, Python 3.12+",
+        )
+        parser.add_argument(
+            "--log_line_events",
+            action="store_true",
+            default=False,
+            help="log an entry for every line executed in --line_functions",
+        )
+        parser.add_argument(
+            "--fold_loops",
+            action="store_true",
+            default=False,
+            help="fold the repeated calls with the same call tree into one entry",
+        )
+        parser.add_argument(
+            "--throttle_rate",
+            type=float,
+            default=0,
+            help="stop logging a function if it's called more than this many times per second",
+        )
+        parser.add_argument(
+            "--throttle_duration",
+            default="1us",
+            help="only throttle the functions that are shorter than this in average",
+        )
+        parser.add_argument(
+            "--clock",
+            choices=["auto", "tsc", "monotonic", "monotonic_coarse"],
+            default="auto",
+            help="the clock of the timestamps, auto uses tsc if it's invariant on this machine",
+        )
         parser.add_argument(
             "--exclude_files",
             nargs="*",
@@ -190,6 +294,30 @@ class VizUI:
             default=False,
             help="log all function arguments, this will introduce large overhead",
         )
+        parser.add_argument(
+            "--log_func_filter",
+            nargs="*",
+            default=None,
+            help=(
+                "only log args and return value of these functions. "
+                "A function can be specified by qualname, module or file:line"
+            ),
+        )
+        parser.add_argument(
+            "--log_func_repr_limit",
+            type=int,
+            default=0,
+            help="max length of the logged function arguments and return values",
+        )
+        parser.add_argument(
+            "--log_func_defer_repr",
+            action="store_true",
+            default=False,
+            help=(
+                "keep immutable function arguments and return values, "
+                "and repr them when saving the report"
+            ),
+        )
         parser.add_argument(
             "--log_gc",
             action="store_true",
@@ -226,6 +354,12 @@ class VizUI:
             default=None,
             help="log audit when audit event is raised, takes regex",
         )
+        parser.add_argument(
+            "--log_pool_tasks",
+            action="store_true",
+            default=False,
+            help="log tasks of multiprocessing.Pool and concurrent.futures executors",
+        )
         parser.add_argument(
             "--log_func_exec",
             nargs="*",
@@ -276,12 +410,36 @@ class VizUI:
             default=False,
             help="log as async format",
         )
+        parser.add_argument(
+            "--log_cpu_time",
+            action="store_true",
+            default=False,
+            help="log the thread CPU time of functions as tts and tdur",
+        )
+        parser.add_argument(
+            "--log_memory",
+            action="store_true",
+            default=False,
+            help="log the bytes allocated in functions and a counter of the allocated bytes",
+        )
         parser.add_argument(
             "--ignore_multiprocess",
             action="store_true",
             default=False,
             help="Do not log any process other than the main process",
         )
+        parser.add_argument(
+            "--trace_child_ratio",
+            type=float,
+            default=1.0,
+            help="the ratio of child processes to trace, between 0 and 1",
+        )
+        parser.add_argument(
+            "--max_traced_children",
+            type=int,
+            default=-1,
+            help="maximum number of child processes to trace",
+        )
         parser.add_argument(
             "--magic_comment",
             action="store_true",
@@ -500,6 +658,53 @@ class VizUI:
                 f"Can't convert {options.min_duration} to time. Format should be 0.3ms or 13us",
             )
 
+        try:
+            tail_duration = time_str_to_us(options.tail_duration)
+        except ValueError:
+            return (
+                False,
+                f"Can't convert {options.tail_duration} to time. Format should be 0.3ms or 13us",
+            )
+
+        try:
+            throttle_duration = time_str_to_us(options.throttle_duration)
+        except ValueError:
+            return (
+                False,
+                f"Can't convert {options.throttle_duration} to time. Format should be 0.3ms or 13us",
+            )
+
+        tracer_memory = 0
+        if options.tracer_memory is not None:
+            try:
+                tracer_memory = size_str_to_bytes(options.tracer_memory)
+            except ValueError:
+                return (
+                    False,
+                    f"Can't convert {options.tracer_memory} to size. Format should be 512MB or 2GB",
+                )
+            if tracer_memory <= 0:
+                return False, "--tracer_memory should be positive"
+
+        if not 0 <= options.trace_child_ratio <= 1:
+            return False, "--trace_child_ratio should be between 0 and 1"
+
+        if not 0 <= options.sample_rate <= 1:
+            return False, "--sample_rate should be between 0 and 1"
+
+        if (
+            options.rotate_interval < 0
+            or options.rotate_entries < 0
+            or options.rotate_keep < 0
+        ):
+            return (
+                False,
+                "--rotate_interval, --rotate_entries and --rotate_keep can't be negative",
+            )
+
+        if not tracer_memory and options.rotate_entries > options.tracer_entries:
+            return False, "--rotate_entries should not be larger than --tracer_entries"
+
         if options.log_torch:
             try:
                 import torch  # type: ignore  # noqa: F401
@@ -525,6 +730,7 @@ class VizUI:
         self.options, self.command = options, command
         self.init_kwargs = {
             "tracer_entries": options.tracer_entries,
+            "tracer_memory": tracer_memory,
             "verbose": self.verbose,
             "output_file": self.ofile,
             "max_stack_depth": options.max_stack_depth,
@@ -533,15 +739,24 @@ class VizUI:
             "ignore_c_function": options.ignore_c_function,
             "ignore_frozen": options.ignore_frozen,
             "ignore_multiprocess": options.ignore_multiprocess,
+            "trace_child_ratio": options.trace_child_ratio,
+            "max_traced_children": options.max_traced_children,
             "log_func_retval": options.log_func_retval,
             "log_func_args": options.log_func_args,
+            "log_func_repr_limit": options.log_func_repr_limit,
+            "log_func_defer_repr": options.log_func_defer_repr,
+            "log_func_filter": options.log_func_filter,
             "log_func_with_objprint": options.log_func_with_objprint,
             "log_print": options.log_print,
             "log_gc": options.log_gc,
             "log_sparse": options.log_sparse,
             "log_async": options.log_async,
+            "log_cpu_time": options.log_cpu_time,
+            "log_memory": options.log_memory,
+            "log_exception": options.log_exception and sys.version_info >= (3, 12),
             "log_audit": options.log_audit,
             "log_torch": options.log_torch,
+            "log_pool_tasks": options.log_pool_tasks,
             "pid_suffix": options.pid_suffix,
             "file_info": False,
             "register_global": True,
@@ -549,8 +764,22 @@ class VizUI:
             "plugins": options.plugins,
             "trace_self": options.trace_self,
             "min_duration": min_duration,
+            "fold_loops": options.fold_loops,
+            "tail_roots": options.tail_roots,
+            "tail_duration": tail_duration,
+            "trigger_functions": options.trigger_functions,
+            "include_functions": options.include_functions,
+            "sample_rate": options.sample_rate,
+            "line_functions": options.line_functions,
+            "log_line_events": options.log_line_events,
+            "throttle_rate": options.throttle_rate,
+            "throttle_duration": throttle_duration,
+            "clock": options.clock,
             "sanitize_function_name": options.sanitize_function_name,
             "dump_raw": True,
+            "rotate_interval": options.rotate_interval,
+            "rotate_entries": options.rotate_entries,
+            "rotate_keep": options.rotate_keep,
             "minimize_memory": options.minimize_memory,
             "process_name": None,
         }
@@ -718,7 +947,7 @@ class VizUI:
             or options.log_number
             or options.log_attr
             or options.log_func_exec
-            or options.log_exception
+            or (options.log_exception and sys.version_info < (3, 12))
             or options.log_func_entry
         ):
             monkey = CodeMonkey(file_name)
@@ -738,7 +967,8 @@ class VizUI:
                 monkey.add_instrument(
                     "log_func_entry", {"funcnames": options.log_func_entry}
                 )
-            if options.log_exception:
+            if options.log_exception and sys.version_info < (3, 12):
+                # The tracer logs the exceptions natively since 3.12
                 monkey.add_instrument("log_exception", {})
             builtins.compile = monkey.compile  # type: ignore
 
@@ -7,28 +7,168 @@
 #include "pythoncapi_compat.h"
 #include "eventnode.h"
 
+// =============================================================================
+// C function info
+// =============================================================================
+
+// An open addressing hash table of all the CFunctionInfo. It's shared by all
+// the tracers and snapshots and lives until the module is freed. It only
+// keeps the modules of the functions and the names of the types, so its size
+// is bounded by the C functions the program has.
+static struct CFunctionInfo** cfunction_table = NULL;
+static size_t cfunction_table_size = 0;
+static size_t cfunction_table_used = 0;
+
+static inline size_t
+cfunction_hash(PyMethodDef* ml, PyObject* module, const char* type_name)
+{
+    // The functions of a module are keyed by the module, and the methods
+    // by the name of the type
+    size_t h = (size_t)ml >> 4;
+    if (type_name) {
+        for (const char* c = type_name; *c; c++) {
+            h = h * 31 + (unsigned char)*c;
+        }
+    } else {
+        h ^= ((size_t)module >> 4) * 0x9E3779B1u;
+    }
+    return h;
+}
+
+static inline size_t
+cfunction_info_hash(struct CFunctionInfo* info)
+{
+    if (info->is_method && info->owner) {
+        return cfunction_hash(info->ml, NULL, PyUnicode_AsUTF8(info->owner));
+    }
+    return cfunction_hash(info->ml, info->owner, NULL);
+}
+
+static int
+cfunction_table_grow(void)
+{
+    size_t new_size = cfunction_table_size ? cfunction_table_size * 2 : 256;
+    struct CFunctionInfo** new_table = PyMem_Calloc(new_size, sizeof(struct CFunctionInfo*));
+    if (!new_table) {
+        return -1;
+    }
+    for (size_t i = 0; i < cfunction_table_size; i++) {
+        struct CFunctionInfo* info = cfunction_table[i];
+        if (info) {
+            size_t idx = cfunction_info_hash(info) & (new_size - 1);
+            while (new_table[idx]) {
+                idx = (idx + 1) & (new_size - 1);
+            }
+            new_table[idx] = info;
+        }
+    }
+    PyMem_FREE(cfunction_table);
+    cfunction_table = new_table;
+    cfunction_table_size = new_size;
+    return 0;
+}
+
+struct CFunctionInfo*
+get_cfunction_info(PyCFunctionObject* cfunc)
+{
+    PyMethodDef* ml = cfunc->m_ml;
+    PyObject* module = NULL;
+    const char* type_name = NULL;
+    int is_method = 0;
+
+    if (cfunc->m_module) {
+        // The function belongs to a module
+        module = cfunc->m_module;
+    } else if (cfunc->m_self) {
+        // The function is a method with __self__
+        type_name = Py_TYPE(cfunc->m_self)->tp_name;
+        is_method = 1;
+    }
+
+    if (cfunction_table_used * 2 >= cfunction_table_size) {
+        if (cfunction_table_grow() != 0) {
+            return NULL;
+        }
+    }
+
+    size_t idx = cfunction_hash(ml, module, type_name) & (cfunction_table_size - 1);
+    while (cfunction_table[idx]) {
+        struct CFunctionInfo* info = cfunction_table[idx];
+        if (info->ml == ml && info->ml_name == ml->ml_name && info->is_method == is_method &&
+                (type_name ? strcmp(PyUnicode_AsUTF8(info->owner), type_name) == 0
+                           : info->owner == module)) {
+            return info;
+        }
+        idx = (idx + 1) & (cfunction_table_size - 1);
+    }
+
+    struct CFunctionInfo* info = PyMem_Calloc(1, sizeof(struct CFunctionInfo));
+    if (!info) {
+        return NULL;
+    }
+    if (type_name) {
+        info->owner = PyUnicode_FromString(type_name);
+        if (!info->owner) {
+            PyErr_Clear();
+            PyMem_FREE(info);
+            return NULL;
+        }
+    } else {
+        info->owner = Py_XNewRef(module);
+    }
+    info->ml = ml;
+    info->ml_name = ml->ml_name;
+    info->is_method = is_method;
+    cfunction_table[idx] = info;
+    cfunction_table_used += 1;
+
+    return info;
+}
+
+void
+clear_cfunction_info(void)
+{
+    for (size_t i = 0; i < cfunction_table_size; i++) {
+        if (cfunction_table[i]) {
+            Py_CLEAR(cfunction_table[i]->owner);
+            PyMem_FREE(cfunction_table[i]);
+        }
+    }
+    PyMem_FREE(cfunction_table);
+    cfunction_table = NULL;
+    cfunction_table_size = 0;
+    cfunction_table_used = 0;
+}
+
+// =============================================================================
+// Event node
+// =============================================================================
+
+struct FEEExtra*
+get_fee_extra(struct EventNode* node)
+{
+    if (!node->data.fee.extra) {
+        node->data.fee.extra = PyMem_Calloc(1, sizeof(struct FEEExtra));
+    }
+    return node->data.fee.extra;
+}
+
 void
 clear_node(struct EventNode* node) {
     switch (node->ntype) {
     case FEE_NODE:
-        if (node->data.fee.type == PyTrace_CALL || node->data.fee.type == PyTrace_RETURN) {
+        if (node->type == PyTrace_CALL || node->type == PyTrace_RETURN) {
             Py_CLEAR(node->data.fee.code);
-            Py_CLEAR(node->data.fee.args);
-            Py_CLEAR(node->data.fee.retval);
         } else {
-            node->data.fee.ml_name = NULL;
-            if (node->data.fee.m_module) {
-                // The function belongs to a module
-                Py_CLEAR(node->data.fee.m_module);
-            } else {
-                // The function is a class method
-                if (node->data.fee.tp_name) {
-                    // It's not a static method, has __self__
-                    node->data.fee.tp_name = NULL;
-                }
-            }
+            node->data.fee.cfunc = NULL;
+        }
+        if (node->data.fee.extra) {
+            Py_CLEAR(node->data.fee.extra->args);
+            Py_CLEAR(node->data.fee.extra->retval);
+            PyMem_FREE(node->data.fee.extra->fold);
+            PyMem_FREE(node->data.fee.extra);
+            node->data.fee.extra = NULL;
         }
-        Py_CLEAR(node->data.fee.asyncio_task);
         break;
     case INSTANT_NODE:
         Py_CLEAR(node->data.instant.name);
@@ -40,7 +180,6 @@ clear_node(struct EventNode* node) {
         Py_CLEAR(node->data.counter.args);
         break;
     case OBJECT_NODE:
-        Py_CLEAR(node->data.object.ph);
         Py_CLEAR(node->data.object.id);
         Py_CLEAR(node->data.object.name);
         Py_CLEAR(node->data.object.args);
@@ -48,12 +187,123 @@ clear_node(struct EventNode* node) {
     case RAW_NODE:
         Py_CLEAR(node->data.raw);
         break;
+    case EXCEPTION_NODE:
+        Py_CLEAR(node->data.exception.code);
+        Py_CLEAR(node->data.exception.exc);
+        break;
+    case LINE_NODE:
+        Py_CLEAR(node->data.line.code);
+        break;
+    case FLOW_NODE:
+        break;
     default:
         printf("Unknown Node Type When Clearing!\n");
         exit(1);
     }
 }
 
+// A rough estimation of sys.getsizeof() including the containing objects.
+// It does not need to be accurate, but it should be cheap and stable for
+// the objects we keep in the nodes, which are mostly str and dict of str.
+static int64_t
+estimate_object_size(PyObject* obj, int depth)
+{
+    if (obj == NULL || obj == Py_None) {
+        return 0;
+    }
+
+    PyTypeObject* type = Py_TYPE(obj);
+
+    if (PyUnicode_CheckExact(obj)) {
+        if (PyUnicode_IS_COMPACT_ASCII(obj)) {
+            return sizeof(PyASCIIObject) + PyUnicode_GET_LENGTH(obj) + 1;
+        }
+        return sizeof(PyCompactUnicodeObject) + (PyUnicode_GET_LENGTH(obj) + 1) * PyUnicode_KIND(obj);
+    }
+
+    int64_t size = type->tp_basicsize;
+    if (PyLong_Check(obj)) {
+        // ob_size is not the number of digits of int since 3.12, and
+        // the ints we keep are mostly small
+        return size + type->tp_itemsize;
+    } else if (type->tp_itemsize) {
+        Py_ssize_t ob_size = Py_SIZE(obj);
+        size += (ob_size < 0 ? -ob_size : ob_size) * type->tp_itemsize;
+    }
+
+    if (depth <= 0) {
+        return size;
+    }
+
+    if (PyDict_Check(obj)) {
+        PyObject* key = NULL;
+        PyObject* value = NULL;
+        Py_ssize_t pos = 0;
+        // Each entry takes a hash, a key, a value and an index
+        size += PyDict_Size(obj) * (3 * sizeof(void*) + sizeof(int32_t));
+        while (PyDict_Next(obj, &pos, &key, &value)) {
+            size += estimate_object_size(key, depth - 1);
+            size += estimate_object_size(value, depth - 1);
+        }
+    } else if (PyList_Check(obj)) {
+        Py_ssize_t length = PyList_GET_SIZE(obj);
+        size += length * sizeof(PyObject*);
+        for (Py_ssize_t i = 0; i < length; i++) {
+            size += estimate_object_size(PyList_GET_ITEM(obj, i), depth - 1);
+        }
+    } else if (PyTuple_Check(obj)) {
+        Py_ssize_t length = PyTuple_GET_SIZE(obj);
+        for (Py_ssize_t i = 0; i < length; i++) {
+            size += estimate_object_size(PyTuple_GET_ITEM(obj, i), depth - 1);
+        }
+    }
+
+    return size;
+}
+
+int64_t
+estimate_node_memory(struct EventNode* node)
+{
+    int64_t size = 0;
+
+    switch (node->ntype) {
+    case FEE_NODE:
+        // The code objects are owned by the program
+        if (node->data.fee.extra) {
+            size += sizeof(struct FEEExtra);
+            if (node->data.fee.extra->fold) {
+                size += sizeof(struct FoldInfo);
+            }
+            size += estimate_object_size(node->data.fee.extra->args, SNAPTRACE_ESTIMATE_DEPTH);
+            size += estimate_object_size(node->data.fee.extra->retval, SNAPTRACE_ESTIMATE_DEPTH);
+        }
+        break;
+    case INSTANT_NODE:
+        size += estimate_object_size(node->data.instant.name, SNAPTRACE_ESTIMATE_DEPTH);
+        size += estimate_object_size(node->data.instant.args, SNAPTRACE_ESTIMATE_DEPTH);
+        break;
+    case COUNTER_NODE:
+        size += estimate_object_size(node->data.counter.name, SNAPTRACE_ESTIMATE_DEPTH);
+        size += estimate_object_size(node->data.counter.args, SNAPTRACE_ESTIMATE_DEPTH);
+        break;
+    case OBJECT_NODE:
+        size += estimate_object_size(node->data.object.id, SNAPTRACE_ESTIMATE_DEPTH);
+        size += estimate_object_size(node->data.object.name, SNAPTRACE_ESTIMATE_DEPTH);
+        size += estimate_object_size(node->data.object.args, SNAPTRACE_ESTIMATE_DEPTH);
+        break;
+    case RAW_NODE:
+        size += estimate_object_size(node->data.raw, SNAPTRACE_ESTIMATE_DEPTH);
+        break;
+    case EXCEPTION_NODE:
+        size += estimate_object_size(node->data.exception.exc, SNAPTRACE_ESTIMATE_DEPTH);
+        break;
+    default:
+        break;
+    }
+
+    return size;
+}
+
 // This will return a PyUnicode object to the caller
 // The caller is responsible to decrease the reference
 //   name_set is an initialized set to keep
@@ -71,7 +321,7 @@ get_name_from_fee_node(struct EventNode* node, PyObject* name_dict)
     // If it does, we use the one in name_dict and delete this one.
     // This way, for entries that has the same name, we won't create multiple
     // string instances
-    if (node->data.fee.type == PyTrace_CALL || node->data.fee.type == PyTrace_RETURN) {
+    if (node->type == PyTrace_CALL || node->type == PyTrace_RETURN) {
         name = PyUnicode_FromFormat(
             "%s (%s:%d)",
 #if PY_VERSION_HEX >= 0x030B0000
@@ -85,24 +335,25 @@ get_name_from_fee_node(struct EventNode* node, PyObject* name_dict)
                 PyUnicode_AsUTF8(node->data.fee.code->co_filename): "<unknown>",
             node->data.fee.code->co_firstlineno);
     } else {
-        if (node->data.fee.m_module) {
+        struct CFunctionInfo* cfunc = node->data.fee.cfunc;
+        if (!cfunc->is_method && cfunc->owner) {
             // The function belongs to a module
             name = PyUnicode_FromFormat(
                 "%s.%s",
-                PyUnicode_Check(node->data.fee.m_module) ?
-                    PyUnicode_AsUTF8(node->data.fee.m_module) : "<unknown>",
-                node->data.fee.ml_name);
+                PyUnicode_Check(cfunc->owner) ?
+                    PyUnicode_AsUTF8(cfunc->owner) : "<unknown>",
+                cfunc->ml_name);
         } else {
             // The function is a class method
-            if (node->data.fee.tp_name) {
+            if (cfunc->owner) {
                 // It's not a static method, has __self__
-                name = PyUnicode_FromFormat("%s.%s",
-                       node->data.fee.tp_name,
-                       node->data.fee.ml_name);
+                name = PyUnicode_FromFormat("%U.%s",
+                       cfunc->owner,
+                       cfunc->ml_name);
             } else {
                 // It's a static method, does not have __self__
                 name = PyUnicode_FromFormat("%s",
-                       node->data.fee.ml_name);
+                       cfunc->ml_name);
             }
         }
     }
@@ -134,7 +385,7 @@ fputs_escape(const char* s, FILE* fptr)
 void
 fprintfeename(FILE* fptr, struct EventNode* node, uint8_t sanitize_function_name)
 {
-    if (node->data.fee.type == PyTrace_CALL || node->data.fee.type == PyTrace_RETURN) {
+    if (node->type == PyTrace_CALL || node->type == PyTrace_RETURN) {
 #if PY_VERSION_HEX >= 0x030B0000
     if (PyUnicode_Check(node->data.fee.code->co_qualname)) {
         fputs(PyUnicode_AsUTF8(node->data.fee.code->co_qualname), fptr);
@@ -156,7 +407,8 @@ fprintfeename(FILE* fptr, struct EventNode* node, uint8_t sanitize_function_name
         }
         fprintf(fptr, ":%d)", node->data.fee.code->co_firstlineno);
     } else {
-        const char* ml_name = node->data.fee.ml_name;
+        struct CFunctionInfo* cfunc = node->data.fee.cfunc;
+        const char* ml_name = cfunc->ml_name;
 
         if (sanitize_function_name) {
             const char *c = ml_name;
@@ -168,19 +420,19 @@ fprintfeename(FILE* fptr, struct EventNode* node, uint8_t sanitize_function_name
                 c ++;
             }
         }
-        if (node->data.fee.m_module) {
+        if (!cfunc->is_method && cfunc->owner) {
             // The function belongs to a module
-            if (PyUnicode_Check(node->data.fee.m_module)) {
-                fputs(PyUnicode_AsUTF8(node->data.fee.m_module), fptr);
+            if (PyUnicode_Check(cfunc->owner)) {
+                fputs(PyUnicode_AsUTF8(cfunc->owner), fptr);
             } else {
                 fputs("<unknown>", fptr);
             }
             fputc('.', fptr);
         } else {
             // The function is a class method
-            if (node->data.fee.tp_name) {
+            if (cfunc->owner) {
                 // It's not a static method, has __self__
-                fputs(node->data.fee.tp_name, fptr);
+                fputs(PyUnicode_AsUTF8(cfunc->owner), fptr);
                 fputc('.', fptr);
             } else {
                 // It's a static method, does not have __self__
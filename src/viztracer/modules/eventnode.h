@@ -12,23 +12,56 @@ typedef enum _NodeType {
     INSTANT_NODE = 2,
     COUNTER_NODE = 3,
     OBJECT_NODE = 4,
-    RAW_NODE = 5
+    RAW_NODE = 5,
+    EXCEPTION_NODE = 6,
+    LINE_NODE = 7,
+    FLOW_NODE = 8
 } NodeType;
 
-struct FEEData {
+// Information of a C function, shared by all the FEE nodes of it.
+// These are kept until no tracer has any entry, so the nodes could just
+// keep a pointer to them.
+struct CFunctionInfo {
+    PyMethodDef* ml;
+    const char* ml_name;
+    // The module of the function, or the name of the type of __self__ if
+    // it's a method. NULL if it's a static method. We hold a reference to
+    // it, but not to the type so the types created at runtime can be freed.
+    PyObject* owner;
+    int is_method;
+};
+
+// The repeated calls folded into a FEE node
+struct FoldInfo {
+    uint64_t count;
+    int64_t total;
+    int64_t min;
+    int64_t max;
+};
+
+// Data that only a few FEE nodes have, so it's not in the node itself
+struct FEEExtra {
     PyObject* args;
     PyObject* retval;
+    struct FoldInfo* fold;
+    // Thread CPU time in ns, for log_cpu_time
+    int has_cpu_time;
+    int64_t cpu_ts;
+    int64_t cpu_dur;
+    // Bytes allocated during the call, for log_memory
+    int has_alloc;
+    uint64_t alloc_bytes;
+};
+
+// FEE node is the most common node, so keep it small. A plain function
+// entry only takes {ts, tid, dur, function} and the rest goes to extra
+struct FEEData {
+    int64_t dur;
     union {
-        struct {
-            PyObject* m_module;
-            const char* ml_name;
-            const char* tp_name;
-        };
         PyCodeObject* code;
+        struct CFunctionInfo* cfunc;
     };
-    int type;
-    int64_t dur;
-    PyObject* asyncio_task;
+    struct FEEExtra* extra;
 };
 
 struct InstantData {
@@ -46,27 +79,68 @@ struct ObjectData {
     PyObject* name;
     PyObject* args;
     PyObject* id;
-    PyObject* ph;
+};
+
+// An exception event, the type of the event is in the node. The event is
+// formatted when it's dumped, so we only keep (type, args) of the exception
+// instead of the exception itself, which keeps the frames alive.
+struct ExceptionData {
+    PyCodeObject* code;
+    int64_t offset;
+    PyObject* exc;
+};
+
+// The execution of a line in line_functions
+struct LineData {
+    PyCodeObject* code;
+    int64_t dur;
+    int line;
+};
+
+// One end of a flow from where a future is done to the task waiting for
+// it, the end is the ph of the node
+struct FlowData {
+    uint64_t id;
 };
 
 struct EventNode {
-    NodeType ntype;
     int64_t ts;
-    unsigned long tid;
+    uint32_t tid;
+    uint8_t ntype;
+    // PyTrace_CALL/PyTrace_RETURN/PyTrace_C_CALL/PyTrace_C_RETURN for FEE node
+    uint8_t type;
+    // ph of object node and flow node
+    char ph;
     union {
         struct FEEData fee;
         struct InstantData instant;
         struct CounterData counter;
         struct ObjectData object;
+        struct ExceptionData exception;
+        struct LineData line;
+        struct FlowData flow;
         PyObject* raw;
     } data;
 };
 
+// How deep estimate_node_memory() looks into the containers
+#define SNAPTRACE_ESTIMATE_DEPTH 3
+
 // ==== Functions ====
 
 // Clear the node, release reference 
 void clear_node(struct EventNode* node);
 
+// Get the shared CFunctionInfo of cfunc, NULL on memory error
+struct CFunctionInfo* get_cfunction_info(PyCFunctionObject* cfunc);
+void clear_cfunction_info(void);
+
+// Get the extra data of a FEE node, create one if it does not exist
+struct FEEExtra* get_fee_extra(struct EventNode* node);
+
+// Estimate the memory of the python objects that only the node keeps
+int64_t estimate_node_memory(struct EventNode* node);
+
 // get name from FEE node, passing in a dictionary for name cache
 PyObject* get_name_from_fee_node(struct EventNode* node, PyObject* name_dict);
 void fprintfeename(FILE*, struct EventNode* node, uint8_t sanitize_function_name);
@@ -19,6 +19,10 @@ LARGE_INTEGER qpc_freq;
 mach_timebase_info_data_t timebase_info;
 #endif
 
+#if defined(QUICKTIME_RDTSC) && !defined(_MSC_VER)
+#include <cpuid.h>
+#endif
+
 
 #define CALIBRATE_SIZE 1000
 
@@ -30,6 +34,7 @@ int64_t* start_ns = NULL;
 int64_t t0_ts = 0;
 int64_t t0_ns = 0;
 bool calibrated = false;
+int quicktime_clock = QUICKTIME_CLOCK_MONOTONIC;
 
 static int
 compare_double(const void *a, const void *b)
@@ -119,20 +124,46 @@ quicktime_free()
     free(start_ns);
 }
 
-void
-quicktime_init()
+int
+quicktime_tsc_supported(void)
 {
-#if _WIN32
-    QueryPerformanceFrequency(&qpc_freq);
-#elif defined(__APPLE__)
-    mach_timebase_info(&timebase_info);
+    // We need rdtscp and an invariant TSC, which ticks at a constant rate
+    // whatever the frequency or the power state of the core is
+#if defined(QUICKTIME_RDTSC)
+    unsigned int regs[4] = {0};
+#if defined(_MSC_VER)
+    __cpuid((int*)regs, 0x80000000);
+#else
+    __cpuid(0x80000000, regs[0], regs[1], regs[2], regs[3]);
 #endif
+    if (regs[0] < 0x80000007) {
+        return 0;
+    }
+#if defined(_MSC_VER)
+    __cpuid((int*)regs, 0x80000001);
+#else
+    __cpuid(0x80000001, regs[0], regs[1], regs[2], regs[3]);
+#endif
+    if (!(regs[3] & (1 << 27))) {
+        return 0;
+    }
+#if defined(_MSC_VER)
+    __cpuid((int*)regs, 0x80000007);
+#else
+    __cpuid(0x80000007, regs[0], regs[1], regs[2], regs[3]);
+#endif
+    return (regs[3] & (1 << 8)) != 0;
+#else
+    return 0;
+#endif
+}
 
-    start_ts = (int64_t*)malloc(sizeof(int64_t) * CALIBRATE_SIZE);
-    start_ns = (int64_t*)malloc(sizeof(int64_t) * CALIBRATE_SIZE);
-
-    int64_t diff_ns[CALIBRATE_SIZE] = {0};
-
+static void
+start_calibration()
+{
+    // Take the start samples of the TSC and the system clock. The factor
+    // is calculated when we need it the first time, the longer the
+    // interval is, the more accurate the factor is.
     t0_ts = 0;
     t0_ns = 0;
 
@@ -161,6 +192,64 @@ quicktime_init()
     t0_ts += ts_remainder / CALIBRATE_SIZE;
     t0_ns += ns_remainder / CALIBRATE_SIZE;
 
+    calibrated = false;
+}
+
+int
+quicktime_set_clock(int clock)
+{
+    // Return -1 if the clock is not available on this machine
+    if (clock == quicktime_clock) {
+        return 0;
+    }
+
+    switch (clock) {
+    case QUICKTIME_CLOCK_TSC:
+        if (!quicktime_tsc_supported()) {
+            return -1;
+        }
+        quicktime_clock = clock;
+        start_calibration();
+        break;
+    case QUICKTIME_CLOCK_MONOTONIC_COARSE:
+#if _WIN32 || (!defined(__APPLE__) && !defined(CLOCK_MONOTONIC_COARSE))
+        return -1;
+#endif
+        // fall through
+    case QUICKTIME_CLOCK_MONOTONIC:
+        // The system clocks share the same start point with get_system_ns()
+        // so we know the factor already
+        quicktime_clock = clock;
+        t0_ts = 0;
+        t0_ns = 0;
+#if _WIN32
+        ts_to_ns_factor = 1e9 / qpc_freq.QuadPart;
+#else
+        ts_to_ns_factor = 1.0;
+#endif
+        calibrated = true;
+        break;
+    default:
+        return -1;
+    }
+
+    return 0;
+}
+
+void
+quicktime_init()
+{
+#if _WIN32
+    QueryPerformanceFrequency(&qpc_freq);
+#elif defined(__APPLE__)
+    mach_timebase_info(&timebase_info);
+#endif
+
+    start_ts = (int64_t*)malloc(sizeof(int64_t) * CALIBRATE_SIZE);
+    start_ns = (int64_t*)malloc(sizeof(int64_t) * CALIBRATE_SIZE);
+
+    int64_t diff_ns[CALIBRATE_SIZE] = {0};
+
     // Now let's find the base time
 
     for (int i = 0; i < CALIBRATE_SIZE; i++)
@@ -174,4 +263,10 @@ quicktime_init()
     qsort(diff_ns, CALIBRATE_SIZE, sizeof(int64_t), compare_int64);
 
     system_base_time = diff_ns[CALIBRATE_SIZE / 2];
+
+    // Use the TSC by default if we can, the system clock otherwise
+    quicktime_clock = -1;
+    if (quicktime_set_clock(QUICKTIME_CLOCK_TSC) != 0) {
+        quicktime_set_clock(QUICKTIME_CLOCK_MONOTONIC);
+    }
 }
@@ -21,21 +21,35 @@ extern mach_timebase_info_data_t timebase_info;
 #define QUICKTIME_RDTSC
 #if defined(_MSC_VER)
 #include <intrin.h>
+#define QUICKTIME_RDTSCP(aux) __rdtscp(aux)
 #elif defined(__clang__)
 // `__rdtsc` is available by default.
 // NB: This has to be first, because Clang will also define `__GNUC__`
+#define QUICKTIME_RDTSCP(aux) __builtin_ia32_rdtscp(aux)
 #elif defined(__GNUC__)
 #include <x86intrin.h>
+#define QUICKTIME_RDTSCP(aux) __rdtscp(aux)
 #else
 #undef QUICKTIME_RDTSC
 #endif
 #endif
 
+// The clock of the timestamps. Only the TSC needs calibration, the others
+// are in ns, or in QueryPerformanceCounter ticks on Windows
+enum QuickTimeClock {
+    QUICKTIME_CLOCK_TSC,
+    QUICKTIME_CLOCK_MONOTONIC,
+    QUICKTIME_CLOCK_MONOTONIC_COARSE,
+};
+
 extern double ts_to_ns_factor;
 extern int64_t system_base_time;
+extern int quicktime_clock;
 
 void quicktime_init();
 void quicktime_free();
+int quicktime_tsc_supported(void);
+int quicktime_set_clock(int clock);
 double system_ts_to_us(int64_t ts);
 int64_t system_ts_to_ns(int64_t ts);
 double dur_ts_to_us(int64_t dur);
@@ -51,19 +65,32 @@ inline int64_t
 get_system_ts(void)
 {
 #if defined(QUICKTIME_RDTSC)
-    return __rdtsc();
-#else
+    if (quicktime_clock == QUICKTIME_CLOCK_TSC) {
+        // rdtscp waits for the previous instructions, so the timestamp
+        // does not drift into the code before it
+        unsigned int aux;
+        return QUICKTIME_RDTSCP(&aux);
+    }
+#endif
 #if _WIN32
     LARGE_INTEGER counter = {0};
     QueryPerformanceCounter(&counter);
     return counter.QuadPart;
 #elif defined(__APPLE__)
+    if (quicktime_clock == QUICKTIME_CLOCK_MONOTONIC_COARSE) {
+        return clock_gettime_nsec_np(CLOCK_MONOTONIC_RAW_APPROX);
+    }
     return clock_gettime_nsec_np(CLOCK_MONOTONIC_RAW);
 #else
     struct timespec t;
-    clock_gettime(CLOCK_MONOTONIC, &t);
-    return (int64_t)(t.tv_sec * 1e9 + t.tv_nsec);
+#if defined(CLOCK_MONOTONIC_COARSE)
+    if (quicktime_clock == QUICKTIME_CLOCK_MONOTONIC_COARSE) {
+        clock_gettime(CLOCK_MONOTONIC_COARSE, &t);
+        return (int64_t)t.tv_sec * 1000000000 + t.tv_nsec;
+    }
 #endif
+    clock_gettime(CLOCK_MONOTONIC, &t);
+    return (int64_t)t.tv_sec * 1000000000 + t.tv_nsec;
 #endif
 }
 
@@ -83,6 +110,26 @@ get_system_ns(void)
 #endif
 }
 
+inline int64_t
+get_thread_cpu_ns(void)
+{
+    // CPU time of the current thread, it does not increase when the
+    // thread is waiting for the GIL, I/O or a lock
+#if _WIN32
+    FILETIME creation_time, exit_time, kernel_time, user_time;
+    ULARGE_INTEGER kernel, user;
+    GetThreadTimes(GetCurrentThread(), &creation_time, &exit_time, &kernel_time, &user_time);
+    kernel.LowPart = kernel_time.dwLowDateTime;
+    kernel.HighPart = kernel_time.dwHighDateTime;
+    user.LowPart = user_time.dwLowDateTime;
+    user.HighPart = user_time.dwHighDateTime;
+    return (kernel.QuadPart + user.QuadPart) * 100;
+#else
+    struct timespec t;
+    clock_gettime(CLOCK_THREAD_CPUTIME_ID, &t);
+    return (int64_t)t.tv_sec * 1000000000 + t.tv_nsec;
+#endif
+}
 
 inline int64_t
 get_system_epoch_ns(void)
@@ -22,8 +22,16 @@
 #include "util.h"
 #include "eventnode.h"
 
+#if PY_VERSION_HEX < 0x030C0000
+#define PyUnstable_Code_GetExtra _PyCode_GetExtra
+#define PyUnstable_Code_SetExtra _PyCode_SetExtra
+#define PyUnstable_Eval_RequestCodeExtraIndex _PyEval_RequestCodeExtraIndex
+#endif
+
 
-TracerObject* curr_tracer = NULL;
+// The tracers that are collecting, indexed by their tool id
+TracerObject* active_tracers[SNAPTRACE_MAX_TRACERS] = {NULL};
+TracerObject* all_tracers = NULL;
 PyObject* threading_module = NULL;
 PyObject* multiprocessing_module = NULL;
 PyObject* json_module = NULL;
@@ -35,21 +43,56 @@ PyObject* sys_module = NULL;
 PyObject* sys_monitoring_missing = NULL;
 
 PyObject* curr_task_getters[2] = {0};
+// For the await flows of log_async, asyncio.Future and the methods that
+// make a future done
+PyObject* future_type = NULL;
+PyMethodDef* future_resolvers[3] = {0};
+
+// Each tracer that could record at the same time keeps its own state of the
+// code objects, otherwise the tracers would reset each other. The state is a
+// struct CodeState in the code object extra of the sys.monitoring tool id of
+// the tracer. What's in it is only valid with the generation of the tracer
+// that set it, the generations below are bumped when the options change.
+Py_ssize_t code_state_extra_index[SNAPTRACE_MAX_TRACERS];
+uintptr_t log_func_filter_generation = 0;
+uintptr_t tail_roots_generation = 0;
+uintptr_t trigger_functions_generation = 0;
+uintptr_t throttle_generation = 0;
+uintptr_t line_functions_generation = 0;
+uintptr_t line_stats_generation = 0;
+uintptr_t include_functions_generation = 0;
+
+#if PY_VERSION_HEX >= 0x030C0000
+// Watches the new functions for include_functions
+int include_function_watcher_id = -1;
+#endif
+
+static PyTypeObject TracerType;
+static PyObject* Tracer_New(PyTypeObject* type, PyObject* args, PyObject* kwargs);
 
 // =============================================================================
 // Utility function
 // =============================================================================
 
-int64_t prev_ts = 0;
+#if defined(_MSC_VER)
+#define SNAPTRACE_THREAD_LOCAL __declspec(thread)
+#else
+#define SNAPTRACE_THREAD_LOCAL __thread
+#endif
+
+// The last timestamp of the thread and its clock. The events of a thread
+// need different timestamps, the events of different threads don't.
+static SNAPTRACE_THREAD_LOCAL int64_t prev_ts = 0;
+static SNAPTRACE_THREAD_LOCAL int prev_ts_clock = -1;
 
 static inline int64_t
 get_ts()
 {
-#if defined(QUICKTIME_RDTSC)
-    return get_system_ts();
-#else
     int64_t curr_ts = get_system_ts();
-    if (curr_ts <= prev_ts) {
+    if (quicktime_clock == QUICKTIME_CLOCK_TSC) {
+        return curr_ts;
+    }
+    if (curr_ts <= prev_ts && prev_ts_clock == quicktime_clock) {
         // We use artificial timestamp to avoid timestamp conflict.
         // 20 ns should be a safe granularity because that's normally
         // how long clock_gettime() takes.
@@ -61,8 +104,101 @@ get_ts()
 #endif
     }
     prev_ts = curr_ts;
+    prev_ts_clock = quicktime_clock;
     return curr_ts;
-#endif
+}
+
+// =============================================================================
+// Memory allocation counting for log_memory
+// =============================================================================
+
+// The bytes allocated by the current thread since the hooks are installed.
+// Only the differences matter, the tracer rewinds it after its callbacks so
+// its own allocations are not counted.
+static SNAPTRACE_THREAD_LOCAL uint64_t thread_alloc_bytes = 0;
+
+static const PyMemAllocatorDomain alloc_hook_domains[] = {PYMEM_DOMAIN_MEM, PYMEM_DOMAIN_OBJ};
+static PyMemAllocatorEx alloc_hook_orig[2];
+static int alloc_hook_installed[2] = {0};
+
+static void*
+alloc_hook_malloc(void* ctx, size_t size)
+{
+    PyMemAllocatorEx* orig = (PyMemAllocatorEx*)ctx;
+    void* ptr = orig->malloc(orig->ctx, size);
+    if (ptr) {
+        thread_alloc_bytes += size;
+    }
+    return ptr;
+}
+
+static void*
+alloc_hook_calloc(void* ctx, size_t nelem, size_t elsize)
+{
+    PyMemAllocatorEx* orig = (PyMemAllocatorEx*)ctx;
+    void* ptr = orig->calloc(orig->ctx, nelem, elsize);
+    if (ptr) {
+        thread_alloc_bytes += nelem * elsize;
+    }
+    return ptr;
+}
+
+static void*
+alloc_hook_realloc(void* ctx, void* ptr, size_t new_size)
+{
+    // We don't know the old size, so the whole new block counts
+    PyMemAllocatorEx* orig = (PyMemAllocatorEx*)ctx;
+    void* new_ptr = orig->realloc(orig->ctx, ptr, new_size);
+    if (new_ptr) {
+        thread_alloc_bytes += new_size;
+    }
+    return new_ptr;
+}
+
+static void
+alloc_hook_free(void* ctx, void* ptr)
+{
+    PyMemAllocatorEx* orig = (PyMemAllocatorEx*)ctx;
+    orig->free(orig->ctx, ptr);
+}
+
+static void
+install_alloc_hooks(void)
+{
+    for (int i = 0; i < 2; i++) {
+        if (alloc_hook_installed[i]) {
+            continue;
+        }
+        PyMemAllocatorEx hook = {
+            &alloc_hook_orig[i], alloc_hook_malloc, alloc_hook_calloc, alloc_hook_realloc, alloc_hook_free
+        };
+        PyMem_GetAllocator(alloc_hook_domains[i], &alloc_hook_orig[i]);
+        PyMem_SetAllocator(alloc_hook_domains[i], &hook);
+        alloc_hook_installed[i] = 1;
+    }
+}
+
+static void
+uninstall_alloc_hooks(void)
+{
+    // Another tracer may still be logging memory
+    for (int i = 0; i < SNAPTRACE_MAX_TRACERS; i++) {
+        TracerObject* tracer = active_tracers[i];
+        if (tracer && tracer->collecting && CHECK_FLAG(tracer->check_flags, SNAPTRACE_LOG_MEMORY)) {
+            return;
+        }
+    }
+
+    for (int i = 0; i < 2; i++) {
+        PyMemAllocatorEx curr;
+        PyMem_GetAllocator(alloc_hook_domains[i], &curr);
+        // If someone else, like tracemalloc, wrapped our hook, we have to
+        // keep it. It still works, and we won't install it again.
+        if (alloc_hook_installed[i] && curr.malloc == alloc_hook_malloc) {
+            PyMem_SetAllocator(alloc_hook_domains[i], &alloc_hook_orig[i]);
+            alloc_hook_installed[i] = 0;
+        }
+    }
 }
 
 static inline struct EventNode*
@@ -72,6 +208,7 @@ get_next_node(TracerObject* self)
 
     SNAPTRACE_THREAD_PROTECT_START(self);
     node = self->buffer + self->buffer_tail_idx;
+    self->node_seq += 1;
     // This is actually faster than modulo
     self->buffer_tail_idx = self->buffer_tail_idx + 1;
     if (self->buffer_tail_idx >= self->buffer_size) {
@@ -83,70 +220,1687 @@ get_next_node(TracerObject* self)
             self->buffer_head_idx = 0;
         }
         clear_node(self->buffer + self->buffer_tail_idx);
+        if (self->node_memory) {
+            self->memory_usage -= self->node_memory[self->buffer_tail_idx];
+            self->node_memory[self->buffer_tail_idx] = 0;
+        }
     } else {
         self->total_entries += 1;
     }
-    SNAPTRACE_THREAD_PROTECT_END(self);
+    SNAPTRACE_THREAD_PROTECT_END(self);
+
+    return node;
+}
+
+// Memory of a node in the buffer, without the objects it keeps
+#define SNAPTRACE_NODE_MEMORY (sizeof(struct EventNode) + sizeof(uint32_t))
+
+static inline void
+account_node(TracerObject* self, struct EventNode* node)
+{
+    // Only used when the buffer is limited by memory. Record how much
+    // memory the finished node takes, and evict the oldest nodes until
+    // we are in the budget again.
+    if (!self->node_memory) {
+        return;
+    }
+
+    int64_t size = SNAPTRACE_NODE_MEMORY + estimate_node_memory(node);
+    if (size > UINT32_MAX) {
+        size = UINT32_MAX;
+    }
+
+    SNAPTRACE_THREAD_PROTECT_START(self);
+    long idx = node - self->buffer;
+    self->memory_usage += size - self->node_memory[idx];
+    self->node_memory[idx] = (uint32_t)size;
+    while (self->memory_usage > self->memory_limit && self->buffer_head_idx != idx) {
+        clear_node(self->buffer + self->buffer_head_idx);
+        self->memory_usage -= self->node_memory[self->buffer_head_idx];
+        self->node_memory[self->buffer_head_idx] = 0;
+        self->buffer_head_idx = self->buffer_head_idx + 1;
+        if (self->buffer_head_idx >= self->buffer_size) {
+            self->buffer_head_idx = 0;
+        }
+    }
+    SNAPTRACE_THREAD_PROTECT_END(self);
+}
+
+static inline void
+reset_buffer_accounting(TracerObject* self)
+{
+    if (self->node_memory) {
+        memset(self->node_memory, 0, self->buffer_size * sizeof(uint32_t));
+    }
+    self->memory_usage = 0;
+    // The entries are gone, nothing logged before could be folded into
+    self->node_seq += 1;
+}
+
+// =============================================================================
+// Tail-based recording
+// =============================================================================
+
+static struct EventNode*
+get_stage_node(TracerObject* self, struct ThreadInfo* info)
+{
+    // The entries under a tail root are staged in the thread. The stage
+    // grows until it's as large as the buffer, the buffer can't hold more
+    // entries anyway. Then the oldest entries are dropped like the buffer
+    // does, so the end of the root is always kept. Return NULL if there's
+    // no memory.
+    if (info->stage_len == info->stage_size) {
+        long size = info->stage_size ? info->stage_size * 2 : 64;
+        if (size > self->buffer_size - 1) {
+            size = self->buffer_size - 1;
+        }
+        if (size <= info->stage_len) {
+            if (info->stage_size == 0) {
+                return NULL;
+            }
+            struct EventNode* node = info->stage + info->stage_head;
+            clear_node(node);
+            info->stage_head = (info->stage_head + 1) % info->stage_size;
+            return node;
+        }
+        // The stage only wraps around when it can't grow
+        struct EventNode* stage = PyMem_Realloc(info->stage, size * sizeof(struct EventNode));
+        if (!stage) {
+            return NULL;
+        }
+        info->stage = stage;
+        info->stage_size = size;
+    }
+
+    return info->stage + (info->stage_head + info->stage_len++) % info->stage_size;
+}
+
+static inline struct EventNode*
+get_fee_node(TracerObject* self, struct ThreadInfo* info)
+{
+    if (info->tail_root) {
+        return get_stage_node(self, info);
+    }
+    return get_next_node(self);
+}
+
+static inline unsigned long
+event_tid(struct ThreadInfo* info)
+{
+    // The events in an async task are on the track of the task
+    return info->curr_task_tid ? info->curr_task_tid : info->tid;
+}
+
+static long
+finish_tail_root(TracerObject* self, struct ThreadInfo* info, int keep)
+{
+    // Move the staged entries to the buffer, or drop them all. Return
+    // the number of entries moved.
+    for (long i = 0; i < info->stage_len; i++) {
+        struct EventNode* staged = info->stage + (info->stage_head + i) % info->stage_size;
+        if (keep) {
+            struct EventNode* node = get_next_node(self);
+            // The node takes over the references of the staged one
+            *node = *staged;
+            account_node(self, node);
+        } else {
+            clear_node(staged);
+        }
+    }
+
+    long moved = keep ? info->stage_len : 0;
+    info->stage_head = 0;
+    info->stage_len = 0;
+    info->tail_root = NULL;
+
+    return moved;
+}
+
+// =============================================================================
+// Fold repeated calls
+// =============================================================================
+
+static inline uint64_t
+mix_shape(uint64_t shape, uint64_t value)
+{
+    shape ^= value + 0x9e3779b97f4a7c15ULL + (shape << 6) + (shape >> 2);
+    // 0 means no shape
+    return shape | 1;
+}
+
+static inline void
+fold_call_start(TracerObject* self, struct FunctionNode* fnode)
+{
+    fnode->shape = 1;
+    fnode->start_seq = self->node_seq;
+    fnode->written = 0;
+    fnode->last_child_shape = 0;
+}
+
+static inline int
+node_in_buffer(TracerObject* self, long idx)
+{
+    long size = self->buffer_size;
+    return (idx - self->buffer_head_idx + size) % size <
+           (self->buffer_tail_idx - self->buffer_head_idx + size) % size;
+}
+
+static int
+fold_call(TracerObject* self, struct FunctionNode* fnode, uint64_t func_id, int64_t dur)
+{
+    // Called when a function returns and it should be logged. If the
+    // subtree of it has the same shape as the subtree of the previous
+    // sibling, and nothing else is logged since that sibling, remove the
+    // entries of this subtree and fold this call into the sibling.
+    // Return 1 if it's folded.
+    struct FunctionNode* parent = fnode->prev;
+    int folded = 0;
+
+    fnode->shape = mix_shape(fnode->shape, func_id);
+
+    SNAPTRACE_THREAD_PROTECT_START(self);
+    if (parent->last_child_shape == fnode->shape &&
+            parent->last_child_seq == fnode->start_seq &&
+            self->node_seq - fnode->start_seq == fnode->written &&
+            fnode->written + 2 < (uint64_t)self->buffer_size &&
+            node_in_buffer(self, parent->last_child_idx)) {
+        struct EventNode* prev = self->buffer + parent->last_child_idx;
+        struct FEEExtra* extra = get_fee_extra(prev);
+        if (extra && !extra->fold) {
+            extra->fold = (struct FoldInfo*)PyMem_Calloc(1, sizeof(struct FoldInfo));
+            if (extra->fold) {
+                extra->fold->count = 1;
+                extra->fold->total = prev->data.fee.dur;
+                extra->fold->min = prev->data.fee.dur;
+                extra->fold->max = prev->data.fee.dur;
+            }
+        }
+
+        if (extra && extra->fold) {
+            long idx = parent->last_child_idx + 1;
+            for (uint64_t i = 0; i < fnode->written; i++) {
+                if (idx >= self->buffer_size) {
+                    idx = 0;
+                }
+                clear_node(self->buffer + idx);
+                if (self->node_memory) {
+                    self->memory_usage -= self->node_memory[idx];
+                    self->node_memory[idx] = 0;
+                }
+                if (self->total_entries > 0) {
+                    self->total_entries -= 1;
+                }
+                idx++;
+            }
+            self->buffer_tail_idx = parent->last_child_idx + 1;
+            if (self->buffer_tail_idx >= self->buffer_size) {
+                self->buffer_tail_idx = 0;
+            }
+            self->node_seq = fnode->start_seq;
+
+            extra->fold->count += 1;
+            extra->fold->total += dur;
+            if (dur < extra->fold->min) {
+                extra->fold->min = dur;
+            }
+            if (dur > extra->fold->max) {
+                extra->fold->max = dur;
+            }
+            // The folded entry spans all the calls
+            prev->data.fee.dur = fnode->ts + dur - prev->ts;
+            if (extra->has_cpu_time) {
+                extra->cpu_dur = fnode->cpu_ts + fnode->cpu_dur - extra->cpu_ts;
+            }
+            if (extra->has_alloc) {
+                extra->alloc_bytes += fnode->alloc_bytes;
+            }
+            folded = 1;
+        }
+    }
+    SNAPTRACE_THREAD_PROTECT_END(self);
+
+    return folded;
+}
+
+static inline void
+fold_call_logged(TracerObject* self, struct FunctionNode* fnode, struct EventNode* node)
+{
+    struct FunctionNode* parent = fnode->prev;
+    parent->shape = mix_shape(parent->shape, fnode->shape);
+    parent->written += fnode->written + 1;
+    parent->last_child_shape = fnode->shape;
+    parent->last_child_seq = self->node_seq;
+    parent->last_child_idx = node - self->buffer;
+}
+
+static inline void
+fold_call_dropped(struct FunctionNode* fnode)
+{
+    // The function itself is not logged, but its children are still in
+    // the buffer
+    struct FunctionNode* parent = fnode->prev;
+    parent->written += fnode->written;
+    parent->last_child_shape = 0;
+}
+
+static inline void
+log_cpu_time(struct EventNode* node, struct FunctionNode* fnode)
+{
+    struct FEEExtra* extra = get_fee_extra(node);
+    if (extra) {
+        extra->has_cpu_time = 1;
+        extra->cpu_ts = fnode->cpu_ts;
+        extra->cpu_dur = fnode->cpu_dur;
+    }
+}
+
+static inline void
+log_memory(struct EventNode* node, struct FunctionNode* fnode)
+{
+    struct FEEExtra* extra = get_fee_extra(node);
+    if (extra) {
+        extra->has_alloc = 1;
+        extra->alloc_bytes = fnode->alloc_bytes;
+    }
+}
+
+static void
+log_memory_counter(TracerObject* self, struct ThreadInfo* info, uint64_t alloc)
+{
+    // A counter of the bytes allocated by the thread, logged when it grows
+    // by SNAPTRACE_MEMORY_COUNTER_STEP so it does not flood the buffer
+    if (alloc - info->alloc_counter_bytes < SNAPTRACE_MEMORY_COUNTER_STEP) {
+        return;
+    }
+
+    PyObject* name = PyUnicode_FromString("allocated bytes");
+    PyObject* args = PyDict_New();
+    PyObject* key = PyUnicode_FromFormat("%lu", info->tid);
+    PyObject* value = PyLong_FromUnsignedLongLong(alloc);
+
+    if (!name || !args || !key || !value || PyDict_SetItem(args, key, value) < 0) {
+        PyErr_Clear();
+        Py_XDECREF(name);
+        Py_XDECREF(args);
+        Py_XDECREF(key);
+        Py_XDECREF(value);
+        return;
+    }
+    Py_DECREF(key);
+    Py_DECREF(value);
+
+    struct EventNode* node = get_fee_node(self, info);
+    if (!node) {
+        Py_DECREF(name);
+        Py_DECREF(args);
+        return;
+    }
+    node->ntype = COUNTER_NODE;
+    node->tid = info->tid;
+    node->ts = get_ts();
+    node->data.counter.name = name;
+    node->data.counter.args = args;
+    if (!info->tail_root) {
+        account_node(self, node);
+    }
+
+    info->alloc_counter_bytes = alloc;
+}
+
+// str arguments that are not longer than this are kept as they are
+#define SNAPTRACE_SIMPLE_STR_LENGTH 64
+
+static inline int
+is_simple_arg(PyObject* obj)
+{
+    // These objects are immutable and cheap to keep, and we know their
+    // repr won't change or run any user code
+    return obj == Py_None ||
+           PyBool_Check(obj) ||
+           PyLong_CheckExact(obj) ||
+           PyFloat_CheckExact(obj) ||
+           (PyUnicode_CheckExact(obj) && PyUnicode_GET_LENGTH(obj) <= SNAPTRACE_SIMPLE_STR_LENGTH);
+}
+
+static PyObject*
+limit_repr(PyObject* repr, long repr_limit)
+{
+    // Steal the reference of repr and return a new one that's not
+    // longer than repr_limit
+    if (repr_limit > 0 && PyUnicode_Check(repr) && PyUnicode_GET_LENGTH(repr) > repr_limit) {
+        PyObject* prefix = PyUnicode_Substring(repr, 0, repr_limit);
+        Py_DECREF(repr);
+        if (!prefix) {
+            return NULL;
+        }
+        repr = PyUnicode_FromFormat("%U...", prefix);
+        Py_DECREF(prefix);
+    }
+    return repr;
+}
+
+static PyObject*
+limited_str_repr(PyObject* obj, Py_ssize_t limit)
+{
+    // repr of the first limit characters. Add a quote to the end so the
+    // prefix is quoted the same way as the whole string
+    Py_ssize_t length = PyUnicode_GET_LENGTH(obj);
+    Py_UCS4 quote = '"';
+    if (PyUnicode_FindChar(obj, '\'', 0, length, 1) >= 0 &&
+            PyUnicode_FindChar(obj, '"', 0, length, 1) == -1) {
+        quote = '\'';
+    }
+    PyObject* prefix = PyUnicode_Substring(obj, 0, limit);
+    if (!prefix) {
+        return NULL;
+    }
+    PyObject* quoted = PyUnicode_FromFormat("%U%c", prefix, (int)quote);
+    Py_DECREF(prefix);
+    if (!quoted) {
+        return NULL;
+    }
+    PyObject* repr = PyObject_Repr(quoted);
+    Py_DECREF(quoted);
+    return repr;
+}
+
+static PyObject* limited_repr(PyObject* obj, Py_ssize_t limit);
+
+static PyObject*
+limited_container_repr(PyObject* obj, Py_ssize_t limit)
+{
+    // Build the repr of list, tuple and dict item by item and stop once
+    // it's longer than limit. Only the first limit characters are
+    // the same as the full repr, the rest is cut by limit_repr()
+    const char* open = PyDict_CheckExact(obj) ? "{" : PyList_CheckExact(obj) ? "[" : "(";
+    const char* close = PyDict_CheckExact(obj) ? "}" : PyList_CheckExact(obj) ? "]" : ")";
+    int status = Py_ReprEnter(obj);
+    if (status != 0) {
+        return status > 0 ? PyUnicode_FromFormat("%s...%s", open, close) : NULL;
+    }
+
+    PyObject* result = NULL;
+    PyObject* parts = PyList_New(0);
+    PyObject* part = NULL;
+    Py_ssize_t length = 1;
+    Py_ssize_t pos = 0;
+    Py_ssize_t i = 0;
+    PyObject* key = NULL;
+    PyObject* value = NULL;
+
+    if (!parts || Py_EnterRecursiveCall(" while getting the repr of an object")) {
+        goto exit;
+    }
+
+    while (length < limit) {
+        if (PyDict_CheckExact(obj)) {
+            if (!PyDict_Next(obj, &pos, &key, &value)) {
+                break;
+            }
+            Py_INCREF(key);
+            Py_INCREF(value);
+            PyObject* key_repr = limited_repr(key, limit - length);
+            if (key_repr) {
+                Py_ssize_t key_length = PyUnicode_GET_LENGTH(key_repr);
+                PyObject* value_repr = limited_repr(value, Py_MAX(limit - length - key_length - 2, 1));
+                if (value_repr) {
+                    part = PyUnicode_FromFormat("%U: %U", key_repr, value_repr);
+                    Py_DECREF(value_repr);
+                }
+                Py_DECREF(key_repr);
+            }
+            Py_CLEAR(key);
+            Py_CLEAR(value);
+        } else {
+            if (i >= Py_SIZE(obj)) {
+                break;
+            }
+            PyObject* item = Py_NewRef(PyList_CheckExact(obj) ? PyList_GET_ITEM(obj, i) : PyTuple_GET_ITEM(obj, i));
+            part = limited_repr(item, limit - length);
+            Py_DECREF(item);
+        }
+        if (!part) {
+            goto leave;
+        }
+        length += PyUnicode_GET_LENGTH(part) + 2;
+        if (PyList_Append(parts, part) < 0) {
+            goto leave;
+        }
+        Py_CLEAR(part);
+        i++;
+    }
+
+    PyObject* sep = PyUnicode_FromString(", ");
+    PyObject* body = sep ? PyUnicode_Join(sep, parts) : NULL;
+    Py_XDECREF(sep);
+    if (body) {
+        if (length >= limit && (PyDict_CheckExact(obj) ? i < PyDict_GET_SIZE(obj) : i < Py_SIZE(obj))) {
+            // Too long, what comes after the limit does not matter
+            result = PyUnicode_FromFormat("%s%U, ...", open, body);
+        } else if (PyTuple_CheckExact(obj) && i == 1) {
+            result = PyUnicode_FromFormat("(%U,)", body);
+        } else {
+            result = PyUnicode_FromFormat("%s%U%s", open, body, close);
+        }
+        Py_DECREF(body);
+    }
+
+leave:
+    Py_LeaveRecursiveCall();
+exit:
+    Py_XDECREF(part);
+    Py_XDECREF(parts);
+    Py_ReprLeave(obj);
+    return result;
+}
+
+static PyObject*
+limited_repr(PyObject* obj, Py_ssize_t limit)
+{
+    // Like PyObject_Repr(), but only the first limit characters are
+    // guaranteed to be right, so a huge str, list, tuple or dict is not
+    // converted as a whole only to be truncated
+    if (limit <= 0 || !obj) {
+        return PyObject_Repr(obj);
+    }
+    if (PyUnicode_CheckExact(obj)) {
+        if (PyUnicode_GET_LENGTH(obj) <= limit) {
+            return PyObject_Repr(obj);
+        }
+        return limited_str_repr(obj, limit);
+    }
+    if ((PyList_CheckExact(obj) || PyTuple_CheckExact(obj) || PyDict_CheckExact(obj)) &&
+            PyObject_Length(obj) > 0) {
+        return limited_container_repr(obj, limit);
+    }
+    return PyObject_Repr(obj);
+}
+
+static PyObject*
+get_repr(PyObject* obj, PyObject* log_func_repr, long repr_limit)
+{
+    PyObject* repr = NULL;
+    if (log_func_repr && obj) {
+        repr = PyObject_CallOneArg(log_func_repr, obj);
+    } else {
+        repr = limited_repr(obj, repr_limit);
+    }
+    if (repr) {
+        repr = limit_repr(repr, repr_limit);
+    }
+    if (!repr) {
+        repr = PyUnicode_FromString("Not Displayable");
+        PyErr_Clear();
+    }
+    return repr;
+}
+
+// How deep we look into containers to decide if an object is immutable
+#define SNAPTRACE_IMMUTABLE_DEPTH 3
+
+static int
+is_immutable_arg(PyObject* obj, int depth)
+{
+    // Whether the repr of obj can't change after we see it, so it's
+    // safe to keep a reference and repr it later
+    if (obj == Py_None ||
+            PyBool_Check(obj) ||
+            PyLong_CheckExact(obj) ||
+            PyFloat_CheckExact(obj) ||
+            PyComplex_CheckExact(obj) ||
+            PyUnicode_CheckExact(obj) ||
+            PyBytes_CheckExact(obj)) {
+        return 1;
+    }
+
+    if (depth <= 0) {
+        return 0;
+    }
+
+    if (PyTuple_CheckExact(obj)) {
+        for (Py_ssize_t i = 0; i < PyTuple_GET_SIZE(obj); i++) {
+            if (!is_immutable_arg(PyTuple_GET_ITEM(obj, i), depth - 1)) {
+                return 0;
+            }
+        }
+        return 1;
+    }
+
+    if (PyFrozenSet_CheckExact(obj)) {
+        int ret = 1;
+        PyObject* iter = PyObject_GetIter(obj);
+        PyObject* item = NULL;
+        if (!iter) {
+            PyErr_Clear();
+            return 0;
+        }
+        while (ret && (item = PyIter_Next(iter))) {
+            ret = is_immutable_arg(item, depth - 1);
+            Py_DECREF(item);
+        }
+        Py_DECREF(iter);
+        return ret;
+    }
+
+    // Frozen dataclass with only immutable fields
+    int ret = 0;
+    PyObject* type = (PyObject*)Py_TYPE(obj);
+    PyObject* params = NULL;
+    PyObject* frozen = NULL;
+    PyObject* fields = NULL;
+    if (PyObject_GetOptionalAttrString(type, "__dataclass_params__", &params) <= 0) {
+        goto cleanup;
+    }
+    if (PyObject_GetOptionalAttrString(params, "frozen", &frozen) <= 0 || frozen != Py_True) {
+        goto cleanup;
+    }
+    if (PyObject_GetOptionalAttrString(type, "__dataclass_fields__", &fields) <= 0 || !PyDict_Check(fields)) {
+        goto cleanup;
+    }
+
+    PyObject* name = NULL;
+    PyObject* field = NULL;
+    Py_ssize_t pos = 0;
+    ret = 1;
+    while (ret && PyDict_Next(fields, &pos, &name, &field)) {
+        PyObject* value = NULL;
+        if (PyObject_GetOptionalAttr(obj, name, &value) <= 0) {
+            ret = 0;
+        } else {
+            ret = is_immutable_arg(value, depth - 1);
+        }
+        Py_XDECREF(value);
+    }
+
+cleanup:
+    PyErr_Clear();
+    Py_XDECREF(params);
+    Py_XDECREF(frozen);
+    Py_XDECREF(fields);
+    return ret;
+}
+
+static PyObject*
+capture_value(TracerObject* self, PyObject* value)
+{
+    // Return what the node keeps for value. A str is the final repr.
+    // Anything else is repr'ed when we generate the report. Objects
+    // other than None, bool, int and float are wrapped in a 1-tuple so
+    // we know they are not a repr yet.
+    PyObject* keep = NULL;
+
+    if (value) {
+        if (CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_FUNC_DEFER_REPR)) {
+            if (is_immutable_arg(value, SNAPTRACE_IMMUTABLE_DEPTH)) {
+                keep = Py_NewRef(value);
+            } else if (self->log_func_snapshot) {
+                keep = PyObject_CallOneArg(self->log_func_snapshot, value);
+                if (!keep) {
+                    PyErr_Clear();
+                }
+            }
+        } else if (!self->log_func_repr && is_simple_arg(value)) {
+            keep = Py_NewRef(value);
+        }
+    }
+
+    if (!keep) {
+        return get_repr(value, self->log_func_repr, self->repr_limit);
+    }
+
+    if (keep == Py_None || PyBool_Check(keep) || PyLong_CheckExact(keep) || PyFloat_CheckExact(keep)) {
+        return keep;
+    }
+
+    PyObject* wrapper = PyTuple_Pack(1, keep);
+    Py_DECREF(keep);
+    if (!wrapper) {
+        PyErr_Clear();
+        return get_repr(value, self->log_func_repr, self->repr_limit);
+    }
+    // If the object can't be in a cycle, neither can the wrapper. Untrack
+    // it so the dict does not need to be tracked by gc either.
+    if (!PyObject_GC_IsTracked(PyTuple_GET_ITEM(wrapper, 0))) {
+        PyObject_GC_UnTrack(wrapper);
+    }
+    return wrapper;
+}
+
+static PyObject*
+format_value(TracerObject* self, PyObject* value)
+{
+    // Return the repr of the value kept by capture_value()
+    if (PyUnicode_Check(value)) {
+        return Py_NewRef(value);
+    }
+    if (PyTuple_CheckExact(value) && PyTuple_GET_SIZE(value) == 1) {
+        value = PyTuple_GET_ITEM(value, 0);
+    }
+    return get_repr(value, self->log_func_repr, self->repr_limit);
+}
+
+static void
+log_func_args(TracerObject* self, struct FunctionNode* node, PyFrameObject* frame)
+{
+    PyObject* func_arg_dict = PyDict_New();
+    PyCodeObject* code = PyFrame_GetCode(frame);
+    PyObject* names = PyCode_GetVarnames(code);
+
+#if PY_VERSION_HEX < 0x030C0000
+    // Before 3.12 there's no way to read a single variable from the frame
+    PyObject* locals = PyEval_GetLocals();
+#endif
+
+    int idx = 0;
+    if (!node->args) {
+        node->args = PyDict_New();
+    }
+
+    int name_length = code->co_argcount + code->co_kwonlyargcount;
+    if (code->co_flags & CO_VARARGS) {
+        name_length ++;
+    }
+
+    if (code->co_flags & CO_VARKEYWORDS) {
+        name_length ++;
+    }
+
+    while (idx < name_length) {
+        // Borrowed
+        PyObject* name = PyTuple_GET_ITEM(names, idx);
+        // New
+#if PY_VERSION_HEX >= 0x030C0000
+        PyObject* value = PyFrame_GetVar(frame, name);
+        if (!value) {
+            PyErr_Clear();
+        }
+#else
+        PyObject* value = Py_XNewRef(PyDict_GetItem(locals, name));
+#endif
+        PyObject* repr = capture_value(self, value);
+        PyDict_SetItem(func_arg_dict, name, repr);
+        Py_DECREF(repr);
+        Py_XDECREF(value);
+        idx++;
+    }
+
+    PyDict_SetItemString(node->args, "func_args", func_arg_dict);
+    // A dict that has another dict is always tracked by gc. There are a
+    // lot of them in the buffer and they make gc really slow. If we only
+    // have untracked objects in it, untrack it. It will be tracked again
+    // automatically if something else is added to it.
+    if (!PyObject_GC_IsTracked(func_arg_dict) && PyDict_GET_SIZE(node->args) == 1) {
+        PyObject_GC_UnTrack(node->args);
+    }
+    Py_DECREF(func_arg_dict);
+
+    Py_XDECREF(code);
+    Py_XDECREF(names);
+}
+
+static void
+format_func_args(TracerObject* self, PyObject* args)
+{
+    // Convert the objects kept by log_func_args() to their repr.
+    // The values that are already repr are left untouched, so it's
+    // fine to do it more than once.
+    PyObject* func_arg_dict = NULL;
+    PyObject* name = NULL;
+    PyObject* value = NULL;
+    Py_ssize_t pos = 0;
+
+    if (!args || !PyDict_Check(args)) {
+        return;
+    }
+
+    func_arg_dict = PyDict_GetItemString(args, "func_args");
+    if (!func_arg_dict || !PyDict_Check(func_arg_dict)) {
+        return;
+    }
+
+    while (PyDict_Next(func_arg_dict, &pos, &name, &value)) {
+        if (PyUnicode_Check(value)) {
+            continue;
+        }
+        PyObject* repr = format_value(self, value);
+        // Replacing the value of an existing key is safe during iteration
+        PyDict_SetItem(func_arg_dict, name, repr);
+        Py_DECREF(repr);
+    }
+}
+
+static PyObject*
+get_fee_args(TracerObject* self, struct FEEExtra* extra)
+{
+    // Return the args of a FEE node in the report, or NULL if there's none
+    format_func_args(self, extra->args);
+    if (extra->retval && !PyUnicode_Check(extra->retval)) {
+        Py_SETREF(extra->retval, format_value(self, extra->retval));
+    }
+
+    PyObject* arg_dict = Py_XNewRef(extra->args);
+    if (extra->retval) {
+        if (!arg_dict) {
+            arg_dict = PyDict_New();
+        }
+        PyDict_SetItemString(arg_dict, "return_value", extra->retval);
+    }
+    if (extra->fold) {
+        PyObject* folded = Py_BuildValue("{sKsdsdsd}",
+            "count", (unsigned long long)extra->fold->count,
+            "total", dur_ts_to_us(extra->fold->total),
+            "min", dur_ts_to_us(extra->fold->min),
+            "max", dur_ts_to_us(extra->fold->max));
+        if (folded) {
+            if (!arg_dict) {
+                arg_dict = PyDict_New();
+            }
+            PyDict_SetItemString(arg_dict, "folded", folded);
+            Py_DECREF(folded);
+        } else {
+            PyErr_Clear();
+        }
+    }
+    if (extra->has_alloc) {
+        PyObject* alloc_bytes = PyLong_FromUnsignedLongLong(extra->alloc_bytes);
+        if (alloc_bytes) {
+            if (!arg_dict) {
+                arg_dict = PyDict_New();
+            }
+            PyDict_SetItemString(arg_dict, "alloc_bytes", alloc_bytes);
+            Py_DECREF(alloc_bytes);
+        } else {
+            PyErr_Clear();
+        }
+    }
+    return arg_dict;
+}
+
+static const char*
+exception_event_name(int event)
+{
+    switch (event) {
+    case PY_MONITORING_EVENT_RAISE:
+        return "raise";
+    case PY_MONITORING_EVENT_RERAISE:
+        return "reraise";
+    case PY_MONITORING_EVENT_EXCEPTION_HANDLED:
+        return "handled";
+    default:
+        return "unknown";
+    }
+}
+
+static int
+get_exception_event(struct EventNode* node, PyObject** name, PyObject** args)
+{
+    // Format the exception node as the name and the args of an instant
+    // event. Return -1 with an exception set on failure
+    PyObject* exc_type = PyTuple_GET_ITEM(node->data.exception.exc, 0);
+    PyObject* exc_args = PyTuple_GET_ITEM(node->data.exception.exc, 1);
+    PyCodeObject* code = node->data.exception.code;
+    PyObject* message = NULL;
+
+    // The same as BaseException.__str__
+    if (!PyTuple_Check(exc_args) || PyTuple_GET_SIZE(exc_args) == 0) {
+        message = PyUnicode_FromString("");
+    } else if (PyTuple_GET_SIZE(exc_args) == 1) {
+        message = PyObject_Str(PyTuple_GET_ITEM(exc_args, 0));
+    } else {
+        message = PyObject_Str(exc_args);
+    }
+    if (!message) {
+        PyErr_Clear();
+        message = PyUnicode_FromString("<unprintable>");
+    }
+
+    // The handler of the exception does not have a line number, use the
+    // line of the except clause after it
+    int offset = (int)node->data.exception.offset;
+    int line = PyCode_Addr2Line(code, offset);
+    for (int i = 0; line < 0 && i < 8; i++) {
+        // Each instruction is 2 bytes
+        offset += 2;
+        line = PyCode_Addr2Line(code, offset);
+    }
+    if (line < 0) {
+        // Some cleanup code does not have any line number
+        line = code->co_firstlineno;
+    }
+
+    *name = PyObject_GetAttrString(exc_type, "__qualname__");
+    *args = Py_BuildValue("{sssNsN}",
+        "event", exception_event_name(node->type),
+        "message", message,
+        "location", PyUnicode_FromFormat("%U (%U:%d)",
+#if PY_VERSION_HEX >= 0x030B0000
+            code->co_qualname,
+#else
+            code->co_name,
+#endif
+            code->co_filename,
+            line));
+
+    if (!*name || !*args) {
+        Py_CLEAR(*name);
+        Py_CLEAR(*args);
+        return -1;
+    }
+    return 0;
+}
+
+static PyObject*
+get_line_event_name(struct EventNode* node)
+{
+    // qualname:line
+    PyCodeObject* code = node->data.line.code;
+    return PyUnicode_FromFormat("%U:%d",
+#if PY_VERSION_HEX >= 0x030B0000
+        code->co_qualname,
+#else
+        code->co_name,
+#endif
+        node->data.line.line);
+}
+
+static inline int
+match_dotted_name(const char* pattern, const char* name)
+{
+    // pattern matches name itself or anything inside it, so "a.b"
+    // matches "a.b" and "a.b.c", but not "a.bc"
+    size_t length = strlen(pattern);
+    return strncmp(name, pattern, length) == 0 && (name[length] == '\0' || name[length] == '.');
+}
+
+static int
+match_func_patterns(PyObject* patterns, PyCodeObject* code, PyObject* globals)
+{
+    // Whether the function matches any of the patterns, which could be
+    // a name, a qualname, a module, module.qualname or file:line.
+    // The module is from globals, or the current frame if it's NULL
+    const char* filename = PyUnicode_AsUTF8(code->co_filename);
+#if PY_VERSION_HEX >= 0x030B0000
+    const char* qualname = PyUnicode_AsUTF8(code->co_qualname);
+#else
+    const char* qualname = PyUnicode_AsUTF8(code->co_name);
+#endif
+    const char* name = PyUnicode_AsUTF8(code->co_name);
+    const char* module = NULL;
+    int matched = 0;
+
+    if (!filename || !qualname || !name) {
+        PyErr_Clear();
+        return 0;
+    }
+
+    if (globals) {
+        Py_INCREF(globals);
+    } else {
+        PyFrameObject* frame = PyEval_GetFrame();
+        if (frame) {
+            globals = PyFrame_GetGlobals(frame);
+        }
+    }
+    if (globals) {
+        PyObject* module_name = PyDict_GetItemString(globals, "__name__");
+        if (module_name && PyUnicode_Check(module_name)) {
+            module = PyUnicode_AsUTF8(module_name);
+        }
+    }
+
+    Py_ssize_t length = PyList_GET_SIZE(patterns);
+    for (Py_ssize_t i = 0; i < length && !matched; i++) {
+        const char* pattern = PyUnicode_AsUTF8(PyList_GET_ITEM(patterns, i));
+        if (!pattern) {
+            PyErr_Clear();
+            continue;
+        }
+
+        // file:line
+        const char* colon = strrchr(pattern, ':');
+        if (colon && colon[1] != '\0' && strspn(colon + 1, "0123456789") == strlen(colon + 1)) {
+            size_t pattern_length = colon - pattern;
+            size_t filename_length = strlen(filename);
+            if (atoi(colon + 1) == code->co_firstlineno &&
+                    filename_length >= pattern_length &&
+                    strncmp(filename + filename_length - pattern_length, pattern, pattern_length) == 0) {
+                // Only match a whole path component
+                if (filename_length == pattern_length) {
+                    matched = 1;
+                } else {
+                    char c = filename[filename_length - pattern_length - 1];
+                    matched = c == '/' || c == '\\';
+                }
+            }
+            continue;
+        }
+
+        // name, qualname, module, or module.qualname
+        if (match_dotted_name(pattern, qualname) || strcmp(pattern, name) == 0) {
+            matched = 1;
+        } else if (module) {
+            size_t module_length = strlen(module);
+            if (match_dotted_name(pattern, module)) {
+                matched = 1;
+            } else if (strncmp(pattern, module, module_length) == 0 && pattern[module_length] == '.' &&
+                       match_dotted_name(pattern + module_length + 1, qualname)) {
+                matched = 1;
+            }
+        }
+    }
+
+    Py_XDECREF(globals);
+
+    return matched;
+}
+
+// The call statistics of a function to decide whether to throttle it
+struct ThrottleStats {
+    uintptr_t generation;
+    int64_t window_start;
+    int64_t window_dur;
+    int64_t dropped_dur;
+    uint32_t window_calls;
+    uint32_t dropped_calls;
+    int throttled;
+    int listed;
+};
+
+struct LineStats;
+
+// The state of a code object for a tracer. The matches of the patterns are
+// cached as (generation << 1) | matched
+struct CodeState {
+    uintptr_t log_func_filter;
+    uintptr_t tail_roots;
+    uintptr_t trigger_functions;
+    uintptr_t line_functions;
+    uintptr_t include_functions;
+    struct ThrottleStats throttle;
+    struct LineStats* line_stats;
+};
+
+static void
+free_code_state(void* extra)
+{
+    struct CodeState* state = (struct CodeState*)extra;
+    if (state) {
+        PyMem_Free(state->line_stats);
+        PyMem_Free(state);
+    }
+}
+
+static struct CodeState*
+get_code_state(TracerObject* self, PyCodeObject* code, int create)
+{
+    // Return NULL if the tracer is not recording, or if the state does not
+    // exist and create is 0
+#if PY_VERSION_HEX >= 0x030C0000
+    if (self->tool_id < SNAPTRACE_TOOL_ID) {
+        // Without a tool id, the state could be another tracer's
+        return NULL;
+    }
+    Py_ssize_t index = code_state_extra_index[self->tool_id - SNAPTRACE_TOOL_ID];
+#else
+    // Only one tracer can record before 3.12
+    Py_ssize_t index = code_state_extra_index[0];
+#endif
+    void* extra = NULL;
+
+    if (PyUnstable_Code_GetExtra((PyObject*)code, index, &extra) < 0) {
+        PyErr_Clear();
+        return NULL;
+    }
+
+    if (!extra && create) {
+        // Freed by the code object with free_code_state()
+        extra = PyMem_Calloc(1, sizeof(struct CodeState));
+        if (!extra) {
+            return NULL;
+        }
+        if (PyUnstable_Code_SetExtra((PyObject*)code, index, extra) < 0) {
+            PyErr_Clear();
+            PyMem_Free(extra);
+            return NULL;
+        }
+    }
+
+    return (struct CodeState*)extra;
+}
+
+static int
+match_func_patterns_cached(PyObject* patterns, PyCodeObject* code, PyObject* globals,
+                           uintptr_t* cache, uintptr_t generation)
+{
+    // The result is only computed once for each code object, and cached
+    // with the generation of patterns. It's computed every time if there's
+    // no cache.
+    if (cache && *cache && (*cache >> 1) == generation) {
+        return *cache & 1;
+    }
+
+    int matched = match_func_patterns(patterns, code, globals);
+    if (cache) {
+        *cache = (generation << 1) | matched;
+    }
+
+    return matched;
+}
+
+static inline int
+should_log_func_detail(TracerObject* self, PyCodeObject* code)
+{
+    // Whether to log the args and return value of the function
+    if (!CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_FUNC_FILTER)) {
+        return 1;
+    }
+
+    struct CodeState* state = get_code_state(self, code, 1);
+
+    return match_func_patterns_cached(self->log_func_filter, code, NULL,
+                                      state ? &state->log_func_filter : NULL,
+                                      self->log_func_filter_generation);
+}
+
+static inline int
+is_tail_root(TracerObject* self, PyCodeObject* code)
+{
+    if (!self->tail_roots) {
+        return 0;
+    }
+
+    struct CodeState* state = get_code_state(self, code, 1);
+
+    return match_func_patterns_cached(self->tail_roots, code, NULL,
+                                      state ? &state->tail_roots : NULL,
+                                      self->tail_roots_generation);
+}
+
+static inline int
+is_trigger_function(TracerObject* self, PyCodeObject* code)
+{
+    struct CodeState* state = get_code_state(self, code, 1);
+
+    return match_func_patterns_cached(self->trigger_functions, code, NULL,
+                                      state ? &state->trigger_functions : NULL,
+                                      self->trigger_functions_generation);
+}
+
+static inline int
+is_line_function(TracerObject* self, PyCodeObject* code)
+{
+    if (!self->line_functions) {
+        return 0;
+    }
+
+    struct CodeState* state = get_code_state(self, code, 1);
+
+    return match_func_patterns_cached(self->line_functions, code, NULL,
+                                      state ? &state->line_functions : NULL,
+                                      self->line_functions_generation);
+}
+
+static inline int
+is_include_function(TracerObject* self, PyCodeObject* code)
+{
+    // Every function is included without include_functions
+    if (!self->include_functions) {
+        return 1;
+    }
+
+    struct CodeState* state = get_code_state(self, code, 1);
+
+    return match_func_patterns_cached(self->include_functions, code, NULL,
+                                      state ? &state->include_functions : NULL,
+                                      self->include_functions_generation);
+}
+
+// How often we re-evaluate whether a function should be throttled
+#define SNAPTRACE_THROTTLE_WINDOW_NS 100000000
+
+static struct ThrottleStats*
+get_throttle_stats(TracerObject* self, PyCodeObject* code, int create)
+{
+    struct CodeState* state = get_code_state(self, code, create);
+    if (!state) {
+        return NULL;
+    }
+
+    struct ThrottleStats* stats = &state->throttle;
+    if (stats->generation == self->throttle_generation) {
+        return stats;
+    }
+
+    if (!create) {
+        return NULL;
+    }
+
+    memset(stats, 0, sizeof(struct ThrottleStats));
+    stats->generation = self->throttle_generation;
+    stats->window_start = get_ts();
+
+    return stats;
+}
+
+static inline int
+is_throttled(TracerObject* self, PyCodeObject* code)
+{
+    if (self->throttle_rate <= 0) {
+        return 0;
+    }
+    struct ThrottleStats* stats = get_throttle_stats(self, code, 0);
+    return stats && stats->throttled;
+}
+
+static void
+log_throttle_summary(TracerObject* self, struct ThreadInfo* info, PyCodeObject* code, struct ThrottleStats* stats, int64_t ts)
+{
+    // A counter of the calls that are dropped since the last summary
+    PyObject* name = PyUnicode_FromFormat(
+        "throttled %U (%U:%d)",
+#if PY_VERSION_HEX >= 0x030B0000
+        code->co_qualname,
+#else
+        code->co_name,
+#endif
+        code->co_filename,
+        code->co_firstlineno);
+    PyObject* args = Py_BuildValue("{sksd}",
+        "calls", (unsigned long)stats->dropped_calls,
+        "dur", dur_ts_to_us(stats->dropped_dur));
+
+    if (!name || !args) {
+        PyErr_Clear();
+        Py_XDECREF(name);
+        Py_XDECREF(args);
+        return;
+    }
+
+    struct EventNode* node = get_fee_node(self, info);
+    if (!node) {
+        Py_DECREF(name);
+        Py_DECREF(args);
+        return;
+    }
+    node->ntype = COUNTER_NODE;
+    node->tid = info->tid;
+    node->ts = ts;
+    node->data.counter.name = name;
+    node->data.counter.args = args;
+    if (!info->tail_root) {
+        account_node(self, node);
+    }
+
+    stats->dropped_calls = 0;
+    stats->dropped_dur = 0;
+}
+
+static int
+throttle_function(TracerObject* self, struct ThreadInfo* info, PyCodeObject* code, int64_t start, int64_t dur)
+{
+    // Update the statistics of the function and return 1 if this call
+    // should be dropped
+    struct ThrottleStats* stats = get_throttle_stats(self, code, 1);
+    int64_t end = start + dur;
+
+    if (!stats) {
+        return 0;
+    }
+
+    int64_t elapsed = dur_ts_to_ns(end - stats->window_start);
+    if (elapsed >= SNAPTRACE_THROTTLE_WINDOW_NS) {
+        // Throttle the function if it's called too often and it's
+        // too short in average
+        int throttled = stats->window_calls * 1e9 / elapsed >= self->throttle_rate &&
+                        dur_ts_to_ns(stats->window_dur) < self->throttle_duration * stats->window_calls;
+        if (stats->throttled) {
+            log_throttle_summary(self, info, code, stats, end);
+        }
+        if (throttled && !stats->listed) {
+            // Keep the throttled functions so we can log the last summary
+            // when the tracer stops
+            if (!self->throttled_codes) {
+                self->throttled_codes = PyList_New(0);
+            }
+            if (self->throttled_codes && PyList_Append(self->throttled_codes, (PyObject*)code) == 0) {
+                stats->listed = 1;
+            }
+            PyErr_Clear();
+        }
+        stats->throttled = throttled;
+        stats->window_start = end;
+        stats->window_calls = 0;
+        stats->window_dur = 0;
+    }
+
+    stats->window_calls += 1;
+    stats->window_dur += dur;
+
+    if (stats->throttled) {
+        stats->dropped_calls += 1;
+        stats->dropped_dur += dur;
+        return 1;
+    }
+
+    return 0;
+}
+
+static void
+flush_throttle_summary(TracerObject* self, struct ThreadInfo* info)
+{
+    if (!self->throttled_codes) {
+        return;
+    }
+
+    int64_t ts = get_ts();
+    for (Py_ssize_t i = 0; i < PyList_GET_SIZE(self->throttled_codes); i++) {
+        PyCodeObject* code = (PyCodeObject*)PyList_GET_ITEM(self->throttled_codes, i);
+        struct ThrottleStats* stats = get_throttle_stats(self, code, 0);
+        if (stats) {
+            if (stats->dropped_calls) {
+                log_throttle_summary(self, info, code, stats, ts);
+            }
+            stats->listed = 0;
+        }
+    }
+
+    Py_CLEAR(self->throttled_codes);
+}
+
+static void set_local_events(TracerObject* self, PyCodeObject* code, int enable);
+
+// The time and hits of each line of a function in line_functions
+struct LineStats {
+    uintptr_t generation;
+    int first_line;
+    int line_count;
+    struct {
+        uint64_t hits;
+        int64_t dur;
+    } lines[];
+};
+
+static int
+get_line_range(PyCodeObject* code, int* first_line, int* line_count)
+{
+    // co_firstlineno is the first line, but the last line is only
+    // known from co_lines()
+    int first = code->co_firstlineno;
+    int last = first;
+    PyObject* item = NULL;
+    PyObject* iter = NULL;
+    PyObject* lines = PyObject_CallMethod((PyObject*)code, "co_lines", NULL);
+
+    if (!lines) {
+        return -1;
+    }
+    iter = PyObject_GetIter(lines);
+    Py_DECREF(lines);
+    if (!iter) {
+        return -1;
+    }
+
+    while ((item = PyIter_Next(iter))) {
+        // (start, end, line), line could be None
+        if (PyTuple_Check(item) && PyTuple_GET_SIZE(item) == 3 &&
+                PyLong_Check(PyTuple_GET_ITEM(item, 2))) {
+            int line = PyLong_AsLong(PyTuple_GET_ITEM(item, 2));
+            if (line < first) {
+                first = line;
+            } else if (line > last) {
+                last = line;
+            }
+        }
+        Py_DECREF(item);
+    }
+    Py_DECREF(iter);
+
+    if (PyErr_Occurred()) {
+        return -1;
+    }
+
+    *first_line = first;
+    *line_count = last - first + 1;
+
+    return 0;
+}
+
+static struct LineStats*
+get_line_stats(TracerObject* self, PyCodeObject* code, int create)
+{
+    struct CodeState* state = get_code_state(self, code, create);
+    if (!state) {
+        return NULL;
+    }
+
+    struct LineStats* stats = state->line_stats;
+    if (stats && stats->generation == self->line_stats_generation) {
+        return stats;
+    }
+
+    if (!create) {
+        return NULL;
+    }
+
+    if (!stats) {
+        int first_line = 0;
+        int line_count = 0;
+        if (get_line_range(code, &first_line, &line_count) < 0) {
+            PyErr_Clear();
+            return NULL;
+        }
+        // Freed with the state by free_code_state()
+        stats = (struct LineStats*)PyMem_Calloc(1, sizeof(struct LineStats) + line_count * sizeof(stats->lines[0]));
+        if (!stats) {
+            return NULL;
+        }
+        stats->first_line = first_line;
+        stats->line_count = line_count;
+        state->line_stats = stats;
+    } else {
+        memset(stats->lines, 0, stats->line_count * sizeof(stats->lines[0]));
+    }
+
+    // The line events are only enabled on the functions we trace, and
+    // we need to disable them when the tracer stops
+    if (!self->line_codes) {
+        self->line_codes = PyList_New(0);
+    }
+    if (!self->line_codes || PyList_Append(self->line_codes, (PyObject*)code) < 0) {
+        PyErr_Clear();
+        return NULL;
+    }
+    stats->generation = self->line_stats_generation;
+    set_local_events(self, code, 1);
+
+    return stats;
+}
+
+static void
+finish_line(TracerObject* self, struct ThreadInfo* info, struct FunctionNode* fnode, int64_t ts)
+{
+    // The line lasts until the next line starts or the function returns
+    struct LineStats* stats = fnode->line_stats;
+
+    if (fnode->line <= 0) {
+        return;
+    }
+
+    int idx = fnode->line - stats->first_line;
+    if (idx >= 0 && idx < stats->line_count) {
+        stats->lines[idx].hits += 1;
+        stats->lines[idx].dur += ts - fnode->line_ts;
+    }
+
+    if (CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_LINE_EVENTS)) {
+        struct EventNode* node = get_fee_node(self, info);
+        if (node) {
+            node->ntype = LINE_NODE;
+            node->tid = event_tid(info);
+            node->ts = fnode->line_ts;
+            node->data.line.code = (PyCodeObject*)Py_NewRef(fnode->func);
+            node->data.line.line = fnode->line;
+            node->data.line.dur = ts - fnode->line_ts;
+            if (!info->tail_root) {
+                account_node(self, node);
+            }
+        }
+    }
+
+    fnode->line = 0;
+}
+
+static void
+log_line_summary(TracerObject* self, struct ThreadInfo* info, PyCodeObject* code, struct LineStats* stats, int64_t ts)
+{
+    // An instant event with {line: {"hits": hits, "dur": dur}} of the
+    // lines that are executed
+    PyObject* name = NULL;
+    PyObject* args = PyDict_New();
+
+    if (!args) {
+        PyErr_Clear();
+        return;
+    }
+
+    for (int i = 0; i < stats->line_count; i++) {
+        if (stats->lines[i].hits == 0) {
+            continue;
+        }
+        PyObject* line = PyUnicode_FromFormat("%d", stats->first_line + i);
+        PyObject* line_args = Py_BuildValue("{sKsd}",
+            "hits", (unsigned long long)stats->lines[i].hits,
+            "dur", dur_ts_to_us(stats->lines[i].dur));
+        if (!line || !line_args || PyDict_SetItem(args, line, line_args) < 0) {
+            PyErr_Clear();
+        }
+        Py_XDECREF(line);
+        Py_XDECREF(line_args);
+    }
+
+    if (PyDict_GET_SIZE(args) == 0) {
+        Py_DECREF(args);
+        return;
+    }
+
+    name = PyUnicode_FromFormat(
+        "lines %U (%U:%d)",
+#if PY_VERSION_HEX >= 0x030B0000
+        code->co_qualname,
+#else
+        code->co_name,
+#endif
+        code->co_filename,
+        code->co_firstlineno);
+    PyObject* scope = PyUnicode_FromString("p");
+
+    if (!name || !scope) {
+        PyErr_Clear();
+        Py_XDECREF(name);
+        Py_XDECREF(scope);
+        Py_DECREF(args);
+        return;
+    }
+
+    struct EventNode* node = get_fee_node(self, info);
+    if (!node) {
+        Py_DECREF(name);
+        Py_DECREF(scope);
+        Py_DECREF(args);
+        return;
+    }
+    node->ntype = INSTANT_NODE;
+    node->tid = info->tid;
+    node->ts = ts;
+    node->data.instant.name = name;
+    node->data.instant.args = args;
+    node->data.instant.scope = scope;
+    if (!info->tail_root) {
+        account_node(self, node);
+    }
+}
+
+static void
+flush_line_stats(TracerObject* self, struct ThreadInfo* info)
+{
+    if (!self->line_codes) {
+        return;
+    }
+
+    int64_t ts = get_ts();
+    for (Py_ssize_t i = 0; i < PyList_GET_SIZE(self->line_codes); i++) {
+        PyCodeObject* code = (PyCodeObject*)PyList_GET_ITEM(self->line_codes, i);
+        struct LineStats* stats = get_line_stats(self, code, 0);
+        if (stats) {
+            log_line_summary(self, info, code, stats, ts);
+        }
+        set_local_events(self, code, 0);
+    }
+
+    Py_CLEAR(self->line_codes);
+}
+
+static void
+set_local_events(TracerObject* self, PyCodeObject* code, int enable)
+{
+    // sys.monitoring.set_local_events(self->tool_id, code, events)
+    // with the events of include_functions and line_functions the code
+    // is in, or no events if enable is 0
+#if PY_VERSION_HEX >= 0x030C0000
+    int events = 0;
+
+    if (enable) {
+        if (self->include_codes && PySet_Contains(self->include_codes, (PyObject*)code) > 0) {
+            events |= SNAPTRACE_INCLUDE_EVENTS;
+            if (CHECK_FLAG(self->check_flags, SNAPTRACE_IGNORE_C_FUNCTION)) {
+                events &= ~SNAPTRACE_C_EVENTS;
+            }
+        }
+        if (get_line_stats(self, code, 0)) {
+            events |= SNAPTRACE_LINE_EVENTS;
+        }
+    }
+
+    PyObject* monitoring = PyObject_GetAttrString(sys_module, "monitoring");
+    if (monitoring) {
+        PyObject* ret = PyObject_CallMethod(monitoring, "set_local_events", "iOi",
+                                            self->tool_id, (PyObject*)code, events);
+        Py_XDECREF(ret);
+        Py_DECREF(monitoring);
+    }
+    PyErr_Clear();
+#endif
+}
+
+static void
+set_all_local_events(TracerObject* self, int enable)
+{
+    // Turn the local events off on pause and back on on resume
+    if (self->line_codes) {
+        for (Py_ssize_t i = 0; i < PyList_GET_SIZE(self->line_codes); i++) {
+            set_local_events(self, (PyCodeObject*)PyList_GET_ITEM(self->line_codes, i), enable);
+        }
+    }
+
+    if (self->include_codes) {
+        PyObject* iter = PyObject_GetIter(self->include_codes);
+        PyObject* code = NULL;
+        if (!iter) {
+            PyErr_Clear();
+            return;
+        }
+        while ((code = PyIter_Next(iter))) {
+            set_local_events(self, (PyCodeObject*)code, enable);
+            Py_DECREF(code);
+        }
+        Py_DECREF(iter);
+        PyErr_Clear();
+    }
+}
+
+#if PY_VERSION_HEX >= 0x030C0000
+static void
+include_function(TracerObject* self, PyFunctionObject* func)
+{
+    // Enable the local events on the function if it's in include_functions
+    PyCodeObject* code = (PyCodeObject*)PyFunction_GET_CODE(func);
+
+    struct CodeState* state = get_code_state(self, code, 1);
+
+    if (!match_func_patterns_cached(self->include_functions, code, PyFunction_GET_GLOBALS(func),
+                                    state ? &state->include_functions : NULL,
+                                    self->include_functions_generation)) {
+        return;
+    }
+
+    if (!self->include_codes) {
+        self->include_codes = PySet_New(NULL);
+        if (!self->include_codes) {
+            PyErr_Clear();
+            return;
+        }
+    }
 
-    return node;
+    if (PySet_Contains(self->include_codes, (PyObject*)code) != 0) {
+        // Already enabled, or error
+        PyErr_Clear();
+        return;
+    }
+
+    if (PySet_Add(self->include_codes, (PyObject*)code) < 0) {
+        PyErr_Clear();
+        return;
+    }
+    set_local_events(self, code, 1);
 }
 
-static void
-log_func_args(struct FunctionNode* node, PyFrameObject* frame, PyObject* log_func_repr)
+static int
+include_function_watcher(PyFunction_WatchEvent event, PyFunctionObject* func, PyObject* new_value)
 {
-    PyObject* func_arg_dict = PyDict_New();
-    PyCodeObject* code = PyFrame_GetCode(frame);
-    PyObject* names = PyCode_GetVarnames(code);
-
-#if PY_VERSION_HEX >= 0x030D0000
-    PyObject* locals = PyEval_GetFrameLocals();
-#else
-    PyObject* locals = PyEval_GetLocals();
-#endif
+    // The functions defined after the tracer starts
+    if (event == PyFunction_EVENT_CREATE) {
+        for (int i = 0; i < SNAPTRACE_MAX_TRACERS; i++) {
+            TracerObject* tracer = active_tracers[i];
+            if (tracer && tracer->collecting && tracer->include_functions) {
+                include_function(tracer, func);
+            }
+        }
+    }
+    return 0;
+}
 
-    int idx = 0;
-    if (!node->args) {
-        node->args = PyDict_New();
+static int
+start_include_functions(TracerObject* self)
+{
+    // Enable the local events on the existing functions that match
+    // include_functions, and watch the new functions
+    PyObject* gc_module = PyImport_ImportModule("gc");
+    if (!gc_module) {
+        return -1;
+    }
+    PyObject* objects = PyObject_CallMethod(gc_module, "get_objects", NULL);
+    Py_DECREF(gc_module);
+    if (!objects) {
+        return -1;
     }
 
-    int name_length = code->co_argcount + code->co_kwonlyargcount;
-    if (code->co_flags & CO_VARARGS) {
-        name_length ++;
+    for (Py_ssize_t i = 0; i < PyList_GET_SIZE(objects); i++) {
+        PyObject* obj = PyList_GET_ITEM(objects, i);
+        if (PyFunction_Check(obj)) {
+            include_function(self, (PyFunctionObject*)obj);
+        }
     }
+    Py_DECREF(objects);
 
-    if (code->co_flags & CO_VARKEYWORDS) {
-        name_length ++;
+    if (include_function_watcher_id < 0) {
+        include_function_watcher_id = PyFunction_AddWatcher(include_function_watcher);
+        if (include_function_watcher_id < 0) {
+            return -1;
+        }
     }
 
-    while (idx < name_length) {
-        // Borrowed
-        PyObject* name = PyTuple_GET_ITEM(names, idx);
-        PyObject* repr = NULL;
-        // New
-        if (log_func_repr) {
-            repr = PyObject_CallOneArg(log_func_repr, PyDict_GetItem(locals, name));
-        } else {
-            repr = PyObject_Repr(PyDict_GetItem(locals, name));
+    return 0;
+}
+
+static void
+stop_include_functions(TracerObject* self)
+{
+    Py_CLEAR(self->include_codes);
+    // The other tracers may still need the watcher
+    for (int i = 0; i < SNAPTRACE_MAX_TRACERS; i++) {
+        TracerObject* tracer = active_tracers[i];
+        if (tracer && tracer != self && tracer->include_functions) {
+            return;
         }
-        if (!repr) {
-            repr = PyUnicode_FromString("Not Displayable");
+    }
+    if (include_function_watcher_id >= 0) {
+        if (PyFunction_ClearWatcher(include_function_watcher_id) < 0) {
             PyErr_Clear();
         }
-        PyDict_SetItem(func_arg_dict, name, repr);
-        Py_DECREF(repr);
-        idx++;
+        include_function_watcher_id = -1;
     }
-
-#if PY_VERSION_HEX >= 0x030D0000
-    Py_DECREF(locals);
-#endif
-
-    PyDict_SetItemString(node->args, "func_args", func_arg_dict);
-    Py_DECREF(func_arg_dict);
-
-    Py_XDECREF(code);
-    Py_XDECREF(names);
 }
+#endif
 
 static void
 verbose_printf(TracerObject* self, int v, const char* fmt, ...)
@@ -160,6 +1914,22 @@ verbose_printf(TracerObject* self, int v, const char* fmt, ...)
     }
 }
 
+// A snapshot is only accessed by the thread that saves it, so we can let
+// the other threads run once in a while during a long load or dump. The
+// file being dumped is flushed without GIL as well, writing a large file
+// could block on I/O.
+#define SNAPTRACE_SNAPSHOT_YIELD_INTERVAL 1000
+
+static inline void
+snapshot_yield(FILE* fptr)
+{
+    Py_BEGIN_ALLOW_THREADS
+    if (fptr) {
+        fflush(fptr);
+    }
+    Py_END_ALLOW_THREADS
+}
+
 void
 clear_stack(struct FunctionNode** stack_top) {
     Py_CLEAR((*stack_top)->args);
@@ -187,7 +1957,8 @@ snaptrace_createthreadinfo(TracerObject* self) {
     if (pthread_threadid_np(NULL, &tid)) {
         info->tid = (unsigned long)pthread_self();
     } else {
-        info->tid = tid;
+        // The tid is stored in 32 bits in the event nodes
+        info->tid = (uint32_t)tid;
     }
 #elif defined(__FreeBSD__)
     info->tid = pthread_getthreadid_np();
@@ -234,77 +2005,416 @@ snaptrace_createthreadinfo(TracerObject* self) {
         node = node->next;
     }
 
-    if (!found_node) {
-        node = (struct MetadataNode*) PyMem_Calloc(1, sizeof(struct MetadataNode));
-        if (!node) {
-            PyErr_SetString(PyExc_RuntimeError, "Out of memory!");
-            info = NULL;
-            goto cleanup;
+    if (!found_node) {
+        node = (struct MetadataNode*) PyMem_Calloc(1, sizeof(struct MetadataNode));
+        if (!node) {
+            PyErr_SetString(PyExc_RuntimeError, "Out of memory!");
+            info = NULL;
+            goto cleanup;
+        }
+        node->name = thread_name;
+        node->tid = info->tid;
+        node->thread_info = info;
+        info->metadata_node = node;
+        node->next = self->metadata_head;
+        self->metadata_head = node;
+    }
+
+    info->curr_task = NULL;
+    info->curr_task_tid = 0;
+    info->curr_task_frame = NULL;
+    info->last_task_tid = 0;
+
+cleanup:
+
+    SNAPTRACE_THREAD_PROTECT_END(self);
+    PyGILState_Release(state);
+
+    return info;
+}
+
+static struct ThreadInfo*
+get_thread_info(TracerObject* self)
+{
+    // self is non-NULL value
+    struct ThreadInfo* info = NULL;
+#if _WIN32
+    info = TlsGetValue(self->dwTlsIndex);
+#else
+    info = pthread_getspecific(self->thread_key);
+#endif
+    if (!info) {
+        info = snaptrace_createthreadinfo(self);
+    }
+    return info;
+}
+
+static void
+snaptrace_threaddestructor(void* key) {
+    struct ThreadInfo* info = key;
+    struct FunctionNode* tmp = NULL;
+    if (info) {
+        PyGILState_STATE state = PyGILState_Ensure();
+        info->paused = 0;
+        info->curr_stack_depth = 0;
+        info->ignore_stack_depth = 0;
+        info->tid = 0;
+        if (info->stack_top) {
+            while (info->stack_top->prev) {
+                info->stack_top = info->stack_top->prev;
+            }
+            while (info->stack_top) {
+                tmp = info->stack_top;
+                Py_CLEAR(tmp->args);
+                Py_CLEAR(tmp->func);
+                info->stack_top = info->stack_top->next;
+                PyMem_FREE(tmp);
+            }
+        }
+        info->stack_top = NULL;
+        Py_CLEAR(info->curr_task);
+        Py_CLEAR(info->curr_task_frame);
+        for (long i = 0; i < info->stage_len; i++) {
+            clear_node(info->stage + (info->stage_head + i) % info->stage_size);
+        }
+        PyMem_FREE(info->stage);
+        info->metadata_node->thread_info = NULL;
+        PyMem_FREE(info);
+        PyGILState_Release(state);
+    }
+}
+
+// =============================================================================
+// Async tasks for log_async
+// =============================================================================
+
+// Every task gets the next tid when it's first seen, so the tids never
+// collide, even for a task that reuses the memory of a finished one
+static unsigned long last_task_tid = SNAPTRACE_TASK_TID_BASE;
+
+static PyObject*
+forget_task(PyObject* task_tids, PyObject* ref)
+{
+    // The callback of the weak reference to a task that is gone
+    if (PyDict_DelItem(task_tids, ref) < 0) {
+        PyErr_Clear();
+    }
+    Py_RETURN_NONE;
+}
+
+static PyMethodDef forget_task_def = {"forget_task", (PyCFunction)forget_task, METH_O, "forget a task that is gone"};
+
+static PyObject*
+get_task_name(PyObject* task)
+{
+    // asyncio tasks have get_name(), trio tasks have name
+    PyObject* name = NULL;
+    if (PyObject_HasAttrString(task, "get_name")) {
+        name = PyObject_CallMethod(task, "get_name", NULL);
+    } else if (PyObject_HasAttrString(task, "name")) {
+        name = PyObject_GetAttrString(task, "name");
+    }
+    if (name && !PyUnicode_Check(name)) {
+        Py_SETREF(name, PyObject_Str(name));
+    }
+    if (!name) {
+        PyErr_Clear();
+        name = PyUnicode_FromString("Task");
+    }
+    return name;
+}
+
+static unsigned long
+get_task_tid(TracerObject* self, PyObject* task)
+{
+    // Return the tid of the task, or 0 on failure. The name of the task
+    // is taken when it's first seen. The tasks are kept by weak references
+    // so we don't keep them alive.
+    PyObject* key = NULL;
+    PyObject* tid = NULL;
+    PyObject* name = NULL;
+    unsigned long task_tid = 0;
+
+    if (!self->task_tids) {
+        self->task_tids = PyDict_New();
+        if (!self->task_tids) {
+            goto cleanup;
+        }
+    }
+    if (!self->task_names) {
+        self->task_names = PyDict_New();
+        if (!self->task_names) {
+            goto cleanup;
+        }
+    }
+
+    key = PyWeakref_NewRef(task, NULL);
+    if (!key) {
+        // The task does not support weak references, keep it then
+        PyErr_Clear();
+        key = Py_NewRef(task);
+    }
+
+    tid = PyDict_GetItemWithError(self->task_tids, key);
+    if (tid) {
+        task_tid = PyLong_AsUnsignedLong(tid);
+        tid = NULL;
+        goto cleanup;
+    } else if (PyErr_Occurred()) {
+        goto cleanup;
+    }
+
+    if (PyWeakref_Check(key)) {
+        PyObject* callback = PyCFunction_New(&forget_task_def, self->task_tids);
+        if (!callback) {
+            goto cleanup;
+        }
+        Py_SETREF(key, PyWeakref_NewRef(task, callback));
+        Py_DECREF(callback);
+        if (!key) {
+            goto cleanup;
+        }
+    }
+
+    tid = PyLong_FromUnsignedLong(last_task_tid + 1);
+    name = get_task_name(task);
+    if (tid && name &&
+            PyDict_SetItem(self->task_tids, key, tid) == 0 &&
+            PyDict_SetItem(self->task_names, tid, name) == 0) {
+        task_tid = ++last_task_tid;
+    }
+
+cleanup:
+    Py_XDECREF(key);
+    Py_XDECREF(tid);
+    Py_XDECREF(name);
+    if (PyErr_Occurred()) {
+        PyErr_Clear();
+        task_tid = 0;
+    }
+    return task_tid;
+}
+
+static void
+log_task_switch(TracerObject* self, struct ThreadInfo* info, unsigned long task_tid)
+{
+    // An instant event on the thread when it runs a different task
+    PyObject* tid = PyLong_FromUnsignedLong(task_tid);
+    PyObject* task_name = tid ? PyDict_GetItemWithError(self->task_names, tid) : NULL;
+    PyObject* args = task_name ? Py_BuildValue("{sOsO}", "task", task_name, "tid", tid) : NULL;
+    PyObject* name = PyUnicode_FromString("task switch");
+    PyObject* scope = PyUnicode_FromString("t");
+    struct EventNode* node = NULL;
+
+    Py_XDECREF(tid);
+    if (!args || !name || !scope) {
+        goto error;
+    }
+
+    node = get_fee_node(self, info);
+    if (!node) {
+        goto error;
+    }
+    node->ntype = INSTANT_NODE;
+    node->tid = info->tid;
+    node->ts = get_ts();
+    node->data.instant.name = name;
+    node->data.instant.args = args;
+    node->data.instant.scope = scope;
+    if (!info->tail_root) {
+        account_node(self, node);
+    }
+    return;
+
+error:
+    PyErr_Clear();
+    Py_XDECREF(args);
+    Py_XDECREF(name);
+    Py_XDECREF(scope);
+}
+
+// Every await flow gets a new id
+static uint64_t last_flow_id = 0;
+
+static inline int
+is_future_resolver(PyCFunctionObject* cfunc)
+{
+    for (size_t i = 0; i < sizeof(future_resolvers)/sizeof(future_resolvers[0]); i++) {
+        if (future_resolvers[i] && cfunc->m_ml == future_resolvers[i]) {
+            return 1;
+        }
+    }
+    return 0;
+}
+
+static void
+wake_future(TracerObject* self, PyObject* future, int64_t ts, unsigned long tid)
+{
+    // Remember where the future is done if any task is waiting for it.
+    // A task could be done at the end of any of its steps, the last one
+    // before the waiting tasks are resumed is where it's done.
+    PyObject* wake = PyDict_GetItemWithError(self->awaited_futures, future);
+    if (wake) {
+        PyList_SetItem(wake, 1, PyLong_FromLongLong(ts));
+        PyList_SetItem(wake, 2, PyLong_FromUnsignedLong(tid));
+    }
+    PyErr_Clear();
+}
+
+static void
+await_future(TracerObject* self, struct ThreadInfo* info, PyObject* future)
+{
+    // The current task is suspended until the future is done
+    PyObject* tid = NULL;
+    PyObject* wake = NULL;
+
+    if (!self->task_awaits) {
+        self->task_awaits = PyDict_New();
+        if (!self->task_awaits) {
+            goto cleanup;
+        }
+    }
+    if (!self->awaited_futures) {
+        self->awaited_futures = PyDict_New();
+        if (!self->awaited_futures) {
+            goto cleanup;
+        }
+    }
+
+    tid = PyLong_FromUnsignedLong(info->curr_task_tid);
+    if (!tid || PyDict_SetItem(self->task_awaits, tid, future) < 0) {
+        goto cleanup;
+    }
+
+    wake = PyDict_GetItemWithError(self->awaited_futures, future);
+    if (wake) {
+        // Other tasks are waiting for it as well
+        long waiters = PyLong_AsLong(PyList_GET_ITEM(wake, 0));
+        PyList_SetItem(wake, 0, PyLong_FromLong(waiters + 1));
+    } else if (!PyErr_Occurred()) {
+        wake = Py_BuildValue("[lOO]", 1L, Py_None, Py_None);
+        if (wake) {
+            PyDict_SetItem(self->awaited_futures, future, wake);
+            Py_DECREF(wake);
+        }
+    }
+
+cleanup:
+    Py_XDECREF(tid);
+    PyErr_Clear();
+}
+
+static void
+end_task_step(TracerObject* self, struct ThreadInfo* info, PyObject* retval, int64_t ts)
+{
+    // The task could be done, and the tasks waiting for it are woken up.
+    // If the task yields a future to the event loop, it's waiting for it.
+    if (!info->curr_task) {
+        return;
+    }
+    if (self->awaited_futures) {
+        wake_future(self, info->curr_task, ts, info->curr_task_tid);
+    }
+    if (retval && future_type && PyObject_TypeCheck(retval, (PyTypeObject*)future_type)) {
+        PyObject* blocking = PyObject_GetAttrString(retval, "_asyncio_future_blocking");
+        if (blocking == Py_True) {
+            await_future(self, info, retval);
+        }
+        Py_XDECREF(blocking);
+        PyErr_Clear();
+    }
+}
+
+static int
+resume_task(TracerObject* self, struct ThreadInfo* info, int64_t* wake_ts, unsigned long* wake_tid)
+{
+    // Return 1 if the current task was waiting for a future that's done,
+    // with where it's done
+    int woken = 0;
+    PyObject* tid = NULL;
+    PyObject* future = NULL;
+
+    if (!self->task_awaits) {
+        return 0;
+    }
+
+    tid = PyLong_FromUnsignedLong(info->curr_task_tid);
+    if (!tid) {
+        goto cleanup;
+    }
+    future = Py_XNewRef(PyDict_GetItemWithError(self->task_awaits, tid));
+    if (!future || PyDict_DelItem(self->task_awaits, tid) < 0) {
+        goto cleanup;
+    }
+
+    PyObject* wake = PyDict_GetItemWithError(self->awaited_futures, future);
+    if (wake) {
+        if (PyList_GET_ITEM(wake, 1) != Py_None) {
+            *wake_ts = PyLong_AsLongLong(PyList_GET_ITEM(wake, 1));
+            *wake_tid = PyLong_AsUnsignedLong(PyList_GET_ITEM(wake, 2));
+            woken = 1;
+        }
+        long waiters = PyLong_AsLong(PyList_GET_ITEM(wake, 0)) - 1;
+        if (waiters > 0) {
+            PyList_SetItem(wake, 0, PyLong_FromLong(waiters));
+        } else {
+            PyDict_DelItem(self->awaited_futures, future);
         }
-        node->name = thread_name;
-        node->tid = info->tid;
-        node->thread_info = info;
-        info->metadata_node = node;
-        node->next = self->metadata_head;
-        self->metadata_head = node;
     }
 
-    info->curr_task = NULL;
-    info->curr_task_frame = NULL;
-
 cleanup:
-
-    SNAPTRACE_THREAD_PROTECT_END(self);
-    PyGILState_Release(state);
-
-    return info;
+    Py_XDECREF(tid);
+    Py_XDECREF(future);
+    if (PyErr_Occurred()) {
+        PyErr_Clear();
+        woken = 0;
+    }
+    return woken;
 }
 
-static struct ThreadInfo*
-get_thread_info(TracerObject* self)
+static void
+log_await_flow(TracerObject* self, struct ThreadInfo* info, int64_t wake_ts, unsigned long wake_tid, int64_t ts)
 {
-    // self is non-NULL value
-    struct ThreadInfo* info = NULL;
-#if _WIN32
-    info = TlsGetValue(self->dwTlsIndex);
-#else
-    info = pthread_getspecific(self->thread_key);
-#endif
-    if (!info) {
-        info = snaptrace_createthreadinfo(self);
+    // A flow from where the future is done to where the task waiting for
+    // it is resumed
+    uint64_t id = ++last_flow_id;
+    char phs[2] = {'s', 'f'};
+    int64_t tss[2] = {wake_ts, ts};
+    unsigned long tids[2] = {wake_tid, info->curr_task_tid};
+
+    for (int i = 0; i < 2; i++) {
+        struct EventNode* node = get_fee_node(self, info);
+        if (!node) {
+            PyErr_Clear();
+            return;
+        }
+        node->ntype = FLOW_NODE;
+        node->ph = phs[i];
+        node->tid = tids[i];
+        node->ts = tss[i];
+        node->data.flow.id = id;
+        if (!info->tail_root) {
+            account_node(self, node);
+        }
     }
-    return info;
 }
 
 static void
-snaptrace_threaddestructor(void* key) {
-    struct ThreadInfo* info = key;
-    struct FunctionNode* tmp = NULL;
-    if (info) {
-        PyGILState_STATE state = PyGILState_Ensure();
-        info->paused = 0;
-        info->curr_stack_depth = 0;
-        info->ignore_stack_depth = 0;
-        info->tid = 0;
-        if (info->stack_top) {
-            while (info->stack_top->prev) {
-                info->stack_top = info->stack_top->prev;
-            }
-            while (info->stack_top) {
-                tmp = info->stack_top;
-                Py_CLEAR(tmp->args);
-                Py_CLEAR(tmp->func);
-                info->stack_top = info->stack_top->next;
-                PyMem_FREE(tmp);
-            }
+collect_task_name(TracerObject* self, PyObject* task_dict, unsigned long tid)
+{
+    // Keep the names of the tasks in the report in task_dict, {tid: name}
+    if (tid <= SNAPTRACE_TASK_TID_BASE || !self->task_names) {
+        return;
+    }
+    PyObject* key = PyLong_FromUnsignedLong(tid);
+    if (key && !PyDict_Contains(task_dict, key)) {
+        PyObject* name = PyDict_GetItemWithError(self->task_names, key);
+        if (name) {
+            PyDict_SetItem(task_dict, key, name);
         }
-        info->stack_top = NULL;
-        Py_CLEAR(info->curr_task);
-        Py_CLEAR(info->curr_task_frame);
-        info->metadata_node->thread_info = NULL;
-        PyMem_FREE(info);
-        PyGILState_Release(state);
     }
+    Py_XDECREF(key);
+    PyErr_Clear();
 }
 
 // =============================================================================
@@ -312,13 +2422,38 @@ snaptrace_threaddestructor(void* key) {
 // =============================================================================
 
 // This function is called before we actually start tracing.
+static inline int
+sample_next(uint64_t step, uint64_t* credit)
+{
+    // The credit grows by sample_rate for each invocation and we sample
+    // one when it reaches 1, so the invocations are sampled evenly, and
+    // it's exactly 1 out of N if sample_rate is 1 / N
+    if (step >= SNAPTRACE_SAMPLE_SCALE) {
+        return 1;
+    }
+    *credit += step;
+    if (*credit < SNAPTRACE_SAMPLE_SCALE) {
+        return 0;
+    }
+    *credit -= SNAPTRACE_SAMPLE_SCALE;
+    return 1;
+}
+
+static inline int
+sample_invocation(TracerObject* self, struct ThreadInfo* info)
+{
+    return sample_next(self->sample_step, &info->sample_credit);
+}
+
 //   * Prepare the thread info and create one if not exist
 //   * Check if we should trace based on all the flags
 //     * -1: Error
 //     * 0: Not trace
 //     * 1: Trace
+//   * With trigger_functions, the frames outside of the trigger functions
+//     are not counted at all, so the thread info is not returned for them
 int
-prepare_before_trace(TracerObject* self, int is_call, struct ThreadInfo** info_out) {
+prepare_before_trace(TracerObject* self, int is_call, PyCodeObject* code, struct ThreadInfo** info_out) {
 
     if (!self->collecting) {
         return 0;
@@ -332,6 +2467,19 @@ prepare_before_trace(TracerObject* self, int is_call, struct ThreadInfo** info_o
         return -1;
     }
 
+    if (CHECK_FLAG(self->check_flags, SNAPTRACE_TRIGGER_FUNCTIONS) && info->curr_stack_depth == 0) {
+        // curr_stack_depth only counts the frames since the outermost
+        // trigger function, so the depth is relative to the trigger
+        if (!is_call || !code || !is_trigger_function(self, code)) {
+            return 0;
+        }
+        if (!sample_invocation(self, info)) {
+            // Ignore the whole invocation
+            *info_out = info;
+            return 0;
+        }
+    }
+
     *info_out = info;
 
     if (info->paused) {
@@ -363,8 +2511,17 @@ int
 tracer_pycall_callback(TracerObject* self, PyCodeObject* code)
 {
     struct ThreadInfo* info = NULL;
+    uint64_t alloc = thread_alloc_bytes;
+    int woken = 0;
+    int64_t wake_ts = 0;
+    unsigned long wake_tid = 0;
+
+    if (!is_include_function(self, code)) {
+        // Not traced at all, as if there's no event
+        return 0;
+    }
 
-    if (prepare_before_trace(self, 1, &info) <= 0) {
+    if (prepare_before_trace(self, 1, code, &info) <= 0) {
         // For now we think -1 and 0 should both return because we should not
         // have the -1 case.
         goto cleanup_ignore;
@@ -414,24 +2571,41 @@ tracer_pycall_callback(TracerObject* self, PyCodeObject* code)
     }
 
     if (CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_ASYNC) &&
-            info->curr_task == NULL &&
+            info->curr_task_frame == NULL &&
             (code->co_flags & CO_COROUTINE) != 0) {
-        PyObject* curr_task = Py_None;
+        // The event loop resumes a task, find out which one only once for
+        // the whole step
+        PyObject* curr_task = NULL;
         info->paused = 1;
         for (size_t i = 0; i < sizeof(curr_task_getters)/sizeof(curr_task_getters[0]); i++) {
             if (curr_task_getters[i] != NULL) {
                 curr_task = PyObject_CallNoArgs(curr_task_getters[i]);
                 if (!curr_task) {
                     PyErr_Clear();  // RuntimeError, probably
-                    curr_task = Py_None;
                 } else if (curr_task != Py_None) {
                     break;  // got a valid task
+                } else {
+                    Py_CLEAR(curr_task);
                 }
             }
         }
+        info->curr_task_tid = curr_task ? get_task_tid(self, curr_task) : 0;
         info->paused = 0;
-        info->curr_task = Py_NewRef(curr_task);
+        info->curr_task = curr_task;
         info->curr_task_frame = (PyFrameObject*)Py_NewRef(PyEval_GetFrame());
+        if (info->curr_task_tid && info->curr_task_tid != info->last_task_tid) {
+            log_task_switch(self, info, info->curr_task_tid);
+            info->last_task_tid = info->curr_task_tid;
+        }
+        if (info->curr_task_tid) {
+            woken = resume_task(self, info, &wake_ts, &wake_tid);
+        }
+    }
+
+    int tail_root = !info->tail_root && is_tail_root(self, code);
+    if (tail_root && !CHECK_FLAG(self->check_flags, SNAPTRACE_TRIGGER_FUNCTIONS) &&
+            !sample_invocation(self, info)) {
+        goto cleanup_ignore;
     }
 
     // If it's a call, we need a new node, and we need to update the stack
@@ -441,9 +2615,36 @@ tracer_pycall_callback(TracerObject* self, PyCodeObject* code)
     }
     info->stack_top = info->stack_top->next;
     info->stack_top->ts = get_ts();
+    if (CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_CPU_TIME)) {
+        // Read the CPU time inside the wall time so tdur <= dur
+        info->stack_top->cpu_ts = get_thread_cpu_ns();
+    }
+    if (woken) {
+        log_await_flow(self, info, wake_ts, wake_tid, info->stack_top->ts);
+    }
     info->stack_top->func = Py_NewRef(code);
-    if (CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_FUNCTION_ARGS)) {
-        log_func_args(info->stack_top, PyEval_GetFrame(), self->log_func_repr);
+    if (is_line_function(self, code)) {
+        info->stack_top->line_stats = get_line_stats(self, code, 1);
+        info->stack_top->line = 0;
+    } else {
+        info->stack_top->line_stats = NULL;
+    }
+    if (CHECK_FLAG(self->check_flags, SNAPTRACE_FOLD_LOOPS)) {
+        fold_call_start(self, info->stack_top);
+    }
+    if (tail_root) {
+        info->tail_root = info->stack_top;
+    }
+    if (CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_FUNCTION_ARGS) &&
+            should_log_func_detail(self, code) &&
+            !is_throttled(self, code)) {
+        log_func_args(self, info->stack_top, PyEval_GetFrame());
+    }
+
+    if (CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_MEMORY)) {
+        // Rewind the counter so the allocations of the tracer don't count
+        thread_alloc_bytes = alloc;
+        info->stack_top->alloc_start = alloc;
     }
 
     info->curr_stack_depth += 1;
@@ -464,8 +2665,14 @@ int
 tracer_ccall_callback(TracerObject* self, PyCodeObject* code, PyObject* arg)
 {
     struct ThreadInfo* info = NULL;
+    uint64_t alloc = thread_alloc_bytes;
+
+    if (!is_include_function(self, code)) {
+        // Not traced at all, as if there's no event
+        return 0;
+    }
 
-    if (prepare_before_trace(self, 1, &info) <= 0) {
+    if (prepare_before_trace(self, 1, NULL, &info) <= 0) {
         // For now we think -1 and 0 should both return because we should not
         // have the -1 case.
         goto cleanup_ignore;
@@ -477,6 +2684,11 @@ tracer_ccall_callback(TracerObject* self, PyCodeObject* code, PyObject* arg)
         goto cleanup_ignore;
     }
 
+    if (CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_ASYNC) &&
+            self->awaited_futures && is_future_resolver(cfunc)) {
+        wake_future(self, cfunc->m_self, get_ts(), event_tid(info));
+    }
+
     // If it's a call, we need a new node, and we need to update the stack
     if (!info->stack_top->next) {
         info->stack_top->next = (struct FunctionNode*) PyMem_Calloc(1, sizeof(struct FunctionNode));
@@ -484,9 +2696,25 @@ tracer_ccall_callback(TracerObject* self, PyCodeObject* code, PyObject* arg)
     }
     info->stack_top = info->stack_top->next;
     info->stack_top->ts = get_ts();
+    if (CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_CPU_TIME)) {
+        // Read the CPU time inside the wall time so tdur <= dur
+        info->stack_top->cpu_ts = get_thread_cpu_ns();
+    }
     info->stack_top->func = Py_NewRef(arg);
-    if (CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_FUNCTION_ARGS)) {
-        log_func_args(info->stack_top, PyEval_GetFrame(), self->log_func_repr);
+    info->stack_top->line_stats = NULL;
+    if (CHECK_FLAG(self->check_flags, SNAPTRACE_FOLD_LOOPS)) {
+        fold_call_start(self, info->stack_top);
+    }
+    // log_func_filter only works on Python functions
+    if (CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_FUNCTION_ARGS) &&
+            !CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_FUNC_FILTER)) {
+        log_func_args(self, info->stack_top, PyEval_GetFrame());
+    }
+
+    if (CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_MEMORY)) {
+        // Rewind the counter so the allocations of the tracer don't count
+        thread_alloc_bytes = alloc;
+        info->stack_top->alloc_start = alloc;
     }
 
     info->curr_stack_depth += 1;
@@ -507,8 +2735,14 @@ int
 tracer_pyreturn_callback(TracerObject* self, PyCodeObject* code, PyObject* arg)
 {
     struct ThreadInfo* info = NULL;
+    uint64_t alloc = thread_alloc_bytes;
+
+    if (!is_include_function(self, code)) {
+        // Not traced at all, as if there's no event
+        return 0;
+    }
 
-    if (prepare_before_trace(self, 0, &info) <= 0) {
+    if (prepare_before_trace(self, 0, code, &info) <= 0) {
         // For now we think -1 and 0 should both return because we should not
         // have the -1 case.
         goto cleanup_ignore;
@@ -517,9 +2751,25 @@ tracer_pyreturn_callback(TracerObject* self, PyCodeObject* code, PyObject* arg)
     struct FunctionNode* stack_top = info->stack_top;
     if (stack_top->prev) {
         // if stack_top has prev, it's not the fake node so it's at least root
-        int64_t dur = get_ts() - info->stack_top->ts;
+        if (CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_CPU_TIME)) {
+            stack_top->cpu_dur = get_thread_cpu_ns() - stack_top->cpu_ts;
+        }
+        if (CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_MEMORY)) {
+            stack_top->alloc_bytes = alloc - stack_top->alloc_start;
+        }
+        int64_t end = get_ts();
+        int64_t dur = end - info->stack_top->ts;
+        if (stack_top->line_stats) {
+            finish_line(self, info, stack_top, end);
+        }
         int log_this_entry = self->min_duration == 0 || dur_ts_to_ns(dur) >= self->min_duration;
 
+        if (self->throttle_rate > 0 &&
+                PyCode_Check(stack_top->func) &&
+                throttle_function(self, info, (PyCodeObject*)stack_top->func, stack_top->ts, dur)) {
+            log_this_entry = 0;
+        }
+
         if (log_this_entry) {
             PyCodeObject* call_code = (PyCodeObject*) stack_top->func;
 
@@ -530,32 +2780,65 @@ tracer_pyreturn_callback(TracerObject* self, PyCodeObject* code, PyObject* arg)
                 return 0;
             }
 
-            struct EventNode* node = get_next_node(self);
+            if (CHECK_FLAG(self->check_flags, SNAPTRACE_FOLD_LOOPS) &&
+                    !info->tail_root &&
+                    fold_call(self, stack_top, (uintptr_t)code, dur)) {
+                goto finish_return;
+            }
+
+            struct EventNode* node = get_fee_node(self, info);
+            if (!node) {
+                goto finish_return;
+            }
 
             node->ntype = FEE_NODE;
             node->ts = info->stack_top->ts;
             node->data.fee.dur = dur;
-            node->tid = info->tid;
-            node->data.fee.type = PyTrace_RETURN;
+            node->tid = event_tid(info);
+            node->type = PyTrace_RETURN;
             node->data.fee.code = (PyCodeObject*)Py_NewRef(code);
-            // steal the reference when return
-            node->data.fee.args = Py_XNewRef(stack_top->args);
-            if (CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_RETURN_VALUE)) {
-                PyObject* repr = NULL;
-                if (self->log_func_repr) {
-                    repr = PyObject_CallOneArg(self->log_func_repr, arg);
-                } else {
-                    repr = PyObject_Repr(arg);
+            node->data.fee.extra = NULL;
+            if (CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_CPU_TIME)) {
+                log_cpu_time(node, stack_top);
+            }
+            if (CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_MEMORY)) {
+                log_memory(node, stack_top);
+            }
+            if (stack_top->args) {
+                struct FEEExtra* extra = get_fee_extra(node);
+                if (extra) {
+                    // steal the reference when return
+                    extra->args = stack_top->args;
+                    stack_top->args = NULL;
                 }
-                if (!repr) {
-                    repr = PyUnicode_FromString("Not Displayable");
-                    PyErr_Clear();
+            }
+            if (CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_RETURN_VALUE) && should_log_func_detail(self, code)) {
+                PyObject* repr = capture_value(self, arg);
+                struct FEEExtra* extra = get_fee_extra(node);
+                if (extra) {
+                    extra->retval = repr;
+                } else {
+                    Py_DECREF(repr);
                 }
-                node->data.fee.retval = repr;
             }
 
-            if (CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_ASYNC)) {
-                node->data.fee.asyncio_task = Py_XNewRef(info->curr_task);
+            if (!info->tail_root) {
+                account_node(self, node);
+                if (CHECK_FLAG(self->check_flags, SNAPTRACE_FOLD_LOOPS)) {
+                    fold_call_logged(self, stack_top, node);
+                }
+            }
+        } else if (CHECK_FLAG(self->check_flags, SNAPTRACE_FOLD_LOOPS) && !info->tail_root) {
+            fold_call_dropped(stack_top);
+        }
+finish_return:
+        if (stack_top == info->tail_root) {
+            long moved = finish_tail_root(self, info, dur_ts_to_ns(dur) >= self->tail_duration);
+            if (CHECK_FLAG(self->check_flags, SNAPTRACE_FOLD_LOOPS)) {
+                // The moved entries can't be folded, but the parent needs
+                // to know they are there
+                stack_top->written = moved;
+                fold_call_dropped(stack_top);
             }
         }
         // Finish return whether to log the data
@@ -564,9 +2847,17 @@ tracer_pyreturn_callback(TracerObject* self, PyCodeObject* code, PyObject* arg)
         Py_CLEAR(stack_top->args);
         Py_CLEAR(stack_top->func);
 
+        if (CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_MEMORY)) {
+            log_memory_counter(self, info, alloc);
+            thread_alloc_bytes = alloc;
+        }
+
         if (CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_ASYNC) &&
-                info->curr_task &&
+                info->curr_task_frame &&
                 PyEval_GetFrame() == info->curr_task_frame) {
+            // Inside the slice of the coroutine so the flow is bound to it
+            end_task_step(self, info, arg, end > stack_top->ts ? end - 1 : end);
+            info->curr_task_tid = 0;
             Py_CLEAR(info->curr_task);
             Py_CLEAR(info->curr_task_frame);
         }
@@ -597,8 +2888,14 @@ int
 tracer_creturn_callback(TracerObject* self, PyCodeObject* code, PyObject* arg)
 {
     struct ThreadInfo* info = NULL;
+    uint64_t alloc = thread_alloc_bytes;
+
+    if (!is_include_function(self, code)) {
+        // Not traced at all, as if there's no event
+        return 0;
+    }
 
-    if (prepare_before_trace(self, 0, &info) <= 0) {
+    if (prepare_before_trace(self, 0, NULL, &info) <= 0) {
         // For now we think -1 and 0 should both return because we should not
         // have the -1 case.
         goto cleanup_ignore;
@@ -607,6 +2904,12 @@ tracer_creturn_callback(TracerObject* self, PyCodeObject* code, PyObject* arg)
     struct FunctionNode* stack_top = info->stack_top;
     if (stack_top->prev) {
         // if stack_top has prev, it's not the fake node so it's at least root
+        if (CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_CPU_TIME)) {
+            stack_top->cpu_dur = get_thread_cpu_ns() - stack_top->cpu_ts;
+        }
+        if (CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_MEMORY)) {
+            stack_top->alloc_bytes = alloc - stack_top->alloc_start;
+        }
         int64_t dur = get_ts() - info->stack_top->ts;
         int log_this_entry = self->min_duration == 0 || dur_ts_to_ns(dur) >= self->min_duration;
 
@@ -620,31 +2923,58 @@ tracer_creturn_callback(TracerObject* self, PyCodeObject* code, PyObject* arg)
                 return 0;
             }
 
-            struct EventNode* node = get_next_node(self);
+            // The info is cached and only allocated the first time we see
+            // the function, it's very unlikely to fail
+            struct CFunctionInfo* cfunc_info = get_cfunction_info(cfunc);
+            if (!cfunc_info) {
+                self->collecting = 0;
+                PyErr_WarnEx(PyExc_RuntimeWarning,
+                    "VizTracer: Out of memory, tracing is stopped", 1);
+                return 0;
+            }
+
+            if (CHECK_FLAG(self->check_flags, SNAPTRACE_FOLD_LOOPS) &&
+                    !info->tail_root &&
+                    fold_call(self, stack_top, (uintptr_t)cfunc_info, dur)) {
+                goto finish_return;
+            }
+
+            struct EventNode* node = get_fee_node(self, info);
+            if (!node) {
+                goto finish_return;
+            }
 
             node->ntype = FEE_NODE;
             node->ts = info->stack_top->ts;
             node->data.fee.dur = dur;
-            node->tid = info->tid;
-            node->data.fee.type = PyTrace_C_RETURN;
-            node->data.fee.ml_name = cfunc->m_ml->ml_name;
-            if (cfunc->m_module) {
-                // The function belongs to a module
-                node->data.fee.m_module = Py_NewRef(cfunc->m_module);
-            } else {
-                // The function is a class method
-                node->data.fee.m_module = NULL;
-                if (cfunc->m_self) {
-                    // It's not a static method, has __self__
-                    node->data.fee.tp_name = cfunc->m_self->ob_type->tp_name;
-                } else {
-                    // It's a static method, does not have __self__
-                    node->data.fee.tp_name = NULL;
-                }
+            node->tid = event_tid(info);
+            node->type = PyTrace_C_RETURN;
+            node->data.fee.cfunc = cfunc_info;
+            node->data.fee.extra = NULL;
+            if (CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_CPU_TIME)) {
+                log_cpu_time(node, stack_top);
+            }
+            if (CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_MEMORY)) {
+                log_memory(node, stack_top);
             }
 
-            if (CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_ASYNC)) {
-                node->data.fee.asyncio_task = Py_XNewRef(info->curr_task);
+            if (!info->tail_root) {
+                account_node(self, node);
+                if (CHECK_FLAG(self->check_flags, SNAPTRACE_FOLD_LOOPS)) {
+                    fold_call_logged(self, stack_top, node);
+                }
+            }
+        } else if (CHECK_FLAG(self->check_flags, SNAPTRACE_FOLD_LOOPS) && !info->tail_root) {
+            fold_call_dropped(stack_top);
+        }
+finish_return:
+        if (stack_top == info->tail_root) {
+            long moved = finish_tail_root(self, info, dur_ts_to_ns(dur) >= self->tail_duration);
+            if (CHECK_FLAG(self->check_flags, SNAPTRACE_FOLD_LOOPS)) {
+                // The moved entries can't be folded, but the parent needs
+                // to know they are there
+                stack_top->written = moved;
+                fold_call_dropped(stack_top);
             }
         }
         // Finish return whether to log the data
@@ -652,6 +2982,11 @@ tracer_creturn_callback(TracerObject* self, PyCodeObject* code, PyObject* arg)
 
         Py_CLEAR(stack_top->args);
         Py_CLEAR(stack_top->func);
+
+        if (CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_MEMORY)) {
+            log_memory_counter(self, info, alloc);
+            thread_alloc_bytes = alloc;
+        }
     }
 
 
@@ -833,6 +3168,99 @@ _creturn_callback(PyObject* self, PyObject *const *args, Py_ssize_t nargs)
     Py_RETURN_NONE;
 }
 
+static int
+tracer_exception_callback(TracerObject* self, PyCodeObject* code, PyObject* offset, PyObject* exc, int event)
+{
+    struct ThreadInfo* info = NULL;
+
+    if (prepare_before_trace(self, 0, NULL, &info) <= 0) {
+        return 0;
+    }
+
+    if (!PyExceptionInstance_Check(exc)) {
+        return 0;
+    }
+
+    PyObject* exc_data = PyTuple_Pack(2, (PyObject*)Py_TYPE(exc), ((PyBaseExceptionObject*)exc)->args);
+    if (!exc_data) {
+        PyErr_Clear();
+        return 0;
+    }
+
+    struct EventNode* node = get_fee_node(self, info);
+    if (!node) {
+        Py_DECREF(exc_data);
+        return 0;
+    }
+    node->ntype = EXCEPTION_NODE;
+    node->type = event;
+    node->tid = event_tid(info);
+    node->ts = get_ts();
+    node->data.exception.code = (PyCodeObject*)Py_NewRef(code);
+    node->data.exception.offset = PyLong_AsLongLong(offset);
+    node->data.exception.exc = exc_data;
+    if (!info->tail_root) {
+        account_node(self, node);
+    }
+
+    return 0;
+}
+
+PyObject*
+_raise_callback(PyObject* self, PyObject *const *args, Py_ssize_t nargs)
+{
+    tracer_exception_callback((TracerObject*)self, (PyCodeObject*)args[0], args[1], args[2], PY_MONITORING_EVENT_RAISE);
+    Py_RETURN_NONE;
+}
+
+PyObject*
+_reraise_callback(PyObject* self, PyObject *const *args, Py_ssize_t nargs)
+{
+    tracer_exception_callback((TracerObject*)self, (PyCodeObject*)args[0], args[1], args[2], PY_MONITORING_EVENT_RERAISE);
+    Py_RETURN_NONE;
+}
+
+PyObject*
+_exception_handled_callback(PyObject* self, PyObject *const *args, Py_ssize_t nargs)
+{
+    tracer_exception_callback((TracerObject*)self, (PyCodeObject*)args[0], args[1], args[2], PY_MONITORING_EVENT_EXCEPTION_HANDLED);
+    Py_RETURN_NONE;
+}
+
+static int
+tracer_line_callback(TracerObject* self, PyCodeObject* code, int line)
+{
+    struct ThreadInfo* info = NULL;
+
+    if (prepare_before_trace(self, 0, code, &info) <= 0) {
+        return 0;
+    }
+
+    struct FunctionNode* fnode = info->stack_top;
+    if (!fnode->prev || !fnode->line_stats || fnode->func != (PyObject*)code) {
+        // The function is not traced
+        return 0;
+    }
+
+    finish_line(self, info, fnode, get_ts());
+    fnode->line = line;
+    // Don't count the time spent in the tracer to the line
+    fnode->line_ts = get_ts();
+
+    return 0;
+}
+
+PyObject*
+_line_callback(PyObject* self, PyObject *const *args, Py_ssize_t nargs)
+{
+    int line = PyLong_AsLong(args[1]);
+    int ret = tracer_line_callback((TracerObject*)self, (PyCodeObject*)args[0], line);
+    if (ret != 0) {
+        return NULL;
+    }
+    Py_RETURN_NONE;
+}
+
 static struct {
     unsigned int event;
     PyMethodDef callback_method;
@@ -855,10 +3283,37 @@ static struct {
         {"_creturn_callback", (PyCFunction)_creturn_callback, METH_FASTCALL, NULL}},
     {PY_MONITORING_EVENT_C_RAISE,
         {"_creturn_callback", (PyCFunction)_creturn_callback, METH_FASTCALL, NULL}},
+    {PY_MONITORING_EVENT_RAISE,
+        {"_raise_callback", (PyCFunction)_raise_callback, METH_FASTCALL, NULL}},
+    {PY_MONITORING_EVENT_RERAISE,
+        {"_reraise_callback", (PyCFunction)_reraise_callback, METH_FASTCALL, NULL}},
+    {PY_MONITORING_EVENT_EXCEPTION_HANDLED,
+        {"_exception_handled_callback", (PyCFunction)_exception_handled_callback, METH_FASTCALL, NULL}},
+    {PY_MONITORING_EVENT_LINE,
+        {"_line_callback", (PyCFunction)_line_callback, METH_FASTCALL, NULL}},
     {0,
         {NULL, NULL, 0, NULL}}
 };
 
+static int
+callback_enabled(TracerObject* self, unsigned int event)
+{
+    switch (event) {
+    case PY_MONITORING_EVENT_CALL:
+    case PY_MONITORING_EVENT_C_RETURN:
+    case PY_MONITORING_EVENT_C_RAISE:
+        return !CHECK_FLAG(self->check_flags, SNAPTRACE_IGNORE_C_FUNCTION);
+    case PY_MONITORING_EVENT_RAISE:
+    case PY_MONITORING_EVENT_RERAISE:
+    case PY_MONITORING_EVENT_EXCEPTION_HANDLED:
+        return CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_EXCEPTION);
+    case PY_MONITORING_EVENT_LINE:
+        return self->line_functions != NULL;
+    default:
+        return 1;
+    }
+}
+
 int
 enable_monitoring(TracerObject* self)
 {
@@ -869,13 +3324,40 @@ enable_monitoring(TracerObject* self)
         goto cleanup;
     }
 
+    if (self->tool_id < 0) {
+        // Take the first tool id that is not used by another tracer, or
+        // by another tool. A tool id named viztracer without a tracer is
+        // left by a tracer that did not stop, we can take it over.
+        for (int i = 0; i < SNAPTRACE_MAX_TRACERS; i++) {
+            if (active_tracers[i]) {
+                continue;
+            }
+            PyObject* curr_tool = PyObject_CallMethod(monitoring, "get_tool", "i", SNAPTRACE_TOOL_ID + i);
+            if (!curr_tool) {
+                goto cleanup;
+            }
+            int available = curr_tool == Py_None ||
+                            (PyUnicode_Check(curr_tool) && PyUnicode_CompareWithASCIIString(curr_tool, "viztracer") == 0);
+            Py_DECREF(curr_tool);
+            if (available) {
+                self->tool_id = SNAPTRACE_TOOL_ID + i;
+                active_tracers[i] = self;
+                break;
+            }
+        }
+        if (self->tool_id < 0) {
+            PyErr_SetString(PyExc_RuntimeError, "No sys.monitoring tool id is available for the tracer");
+            goto cleanup;
+        }
+    }
+
     PyObject* ret = PyObject_CallMethod(monitoring, "use_tool_id",
-                                        "is", SNAPTRACE_TOOL_ID, "viztracer");
+                                        "is", self->tool_id, "viztracer");
     if (!ret) {
         PyErr_Clear();
-        PyObject_CallMethod(monitoring, "free_tool_id", "i", SNAPTRACE_TOOL_ID);
+        PyObject_CallMethod(monitoring, "free_tool_id", "i", self->tool_id);
         ret = PyObject_CallMethod(monitoring, "use_tool_id",
-                                  "is", SNAPTRACE_TOOL_ID, "viztracer");
+                                  "is", self->tool_id, "viztracer");
         if (!ret) {
             goto cleanup;
         }
@@ -883,17 +3365,14 @@ enable_monitoring(TracerObject* self)
     Py_DECREF(ret);
 
     for (int i = 0; callback_table[i].callback_method.ml_meth != 0; i++) {
-        if (CHECK_FLAG(self->check_flags, SNAPTRACE_IGNORE_C_FUNCTION) && 
-                (callback_table[i].event == PY_MONITORING_EVENT_CALL ||
-                 callback_table[i].event == PY_MONITORING_EVENT_C_RETURN ||
-                 callback_table[i].event == PY_MONITORING_EVENT_C_RAISE)) {
+        if (!callback_enabled(self, callback_table[i].event)) {
             continue;
         }
         unsigned int event = (1 << callback_table[i].event);
         PyObject* callback = PyCFunction_New(&callback_table[i].callback_method, (PyObject*)self);
 
         PyObject* regsiter_result = PyObject_CallMethod(monitoring, "register_callback",
-                                                        "iiO", SNAPTRACE_TOOL_ID, event, callback);
+                                                        "iiO", self->tool_id, event, callback);
         Py_DECREF(callback);
 
         if (!regsiter_result) {
@@ -903,13 +3382,23 @@ enable_monitoring(TracerObject* self)
         all_events |= event;
     }
 
+    // The local events are enabled on the code objects of line_functions
+    // and include_functions
+    unsigned int local_events = SNAPTRACE_LINE_EVENTS;
+    if (self->include_functions) {
+        local_events |= SNAPTRACE_INCLUDE_EVENTS;
+    }
     PyObject* event_result = PyObject_CallMethod(monitoring, "set_events",
-                                                 "ii", SNAPTRACE_TOOL_ID, all_events);
+                                                 "ii", self->tool_id,
+                                                 all_events & ~local_events);
     if (!event_result) {
         goto cleanup;
     }
     Py_DECREF(event_result);
 
+    // Resumed from pause
+    set_all_local_events(self, 1);
+
 cleanup:
 
     Py_XDECREF(monitoring);
@@ -921,15 +3410,32 @@ cleanup:
     return 0;
 }
 
+#if PY_VERSION_HEX >= 0x030C0000
+static void
+release_tool_id(TracerObject* self)
+{
+    if (self->tool_id >= 0) {
+        if (active_tracers[self->tool_id - SNAPTRACE_TOOL_ID] == self) {
+            active_tracers[self->tool_id - SNAPTRACE_TOOL_ID] = NULL;
+        }
+        self->tool_id = -1;
+    }
+}
+#endif
+
 int disable_monitoring(TracerObject* self)
 {
+    if (self->tool_id < 0) {
+        return 0;
+    }
+
     PyObject* monitoring = PyObject_GetAttrString(sys_module, "monitoring");
     if (!monitoring) {
         PyErr_SetString(PyExc_RuntimeError, "Failed to access sys.monitoring");
         goto cleanup;
     }
 
-    PyObject* curr_tool = PyObject_CallMethod(monitoring, "get_tool", "i", SNAPTRACE_TOOL_ID);
+    PyObject* curr_tool = PyObject_CallMethod(monitoring, "get_tool", "i", self->tool_id);
 
     if (!curr_tool) {
         goto cleanup;
@@ -942,23 +3448,22 @@ int disable_monitoring(TracerObject* self)
     }
 
     PyObject* event_result = PyObject_CallMethod(monitoring, "set_events",
-                                                 "ii", SNAPTRACE_TOOL_ID, 0);
+                                                 "ii", self->tool_id, 0);
     if (!event_result) {
         goto cleanup;
     }
     Py_DECREF(event_result);
 
+    set_all_local_events(self, 0);
+
     for (int i = 0; callback_table[i].callback_method.ml_meth != 0; i++) {
-        if (CHECK_FLAG(self->check_flags, SNAPTRACE_IGNORE_C_FUNCTION) && 
-                (callback_table[i].event == PY_MONITORING_EVENT_CALL ||
-                 callback_table[i].event == PY_MONITORING_EVENT_C_RETURN ||
-                 callback_table[i].event == PY_MONITORING_EVENT_C_RAISE)) {
+        if (!callback_enabled(self, callback_table[i].event)) {
             continue;
         }
         unsigned int event = (1 << callback_table[i].event);
 
         PyObject* regsiter_result = PyObject_CallMethod(monitoring, "register_callback",
-                                                        "iiO", SNAPTRACE_TOOL_ID, event, Py_None);
+                                                        "iiO", self->tool_id, event, Py_None);
         if (!regsiter_result) {
             goto cleanup;
         }
@@ -966,7 +3471,7 @@ int disable_monitoring(TracerObject* self)
     }
 
     PyObject* ret = PyObject_CallMethod(monitoring, "free_tool_id",
-                                        "i", SNAPTRACE_TOOL_ID);
+                                        "i", self->tool_id);
     if (!ret) {
         goto cleanup;
     }
@@ -1001,52 +3506,53 @@ tracer__flush_unfinished(TracerObject* self, int flush_as_finish)
             continue;
         }
 
+        if (info->tail_root) {
+            // Keep the entries if the root has been long enough
+            int64_t dur = get_ts() - info->tail_root->ts;
+            finish_tail_root(self, info, dur_ts_to_ns(dur) >= self->tail_duration);
+        }
+
         struct FunctionNode* func_node = info->stack_top;
 
         while (func_node->prev && info->curr_stack_depth > 0) {
             // Fake a FEE node to get the name
-            struct EventNode* fee_node = get_next_node(self);
-
-            fee_node->ntype = FEE_NODE;
-            fee_node->ts = func_node->ts;
-            fee_node->tid = meta_node->tid;
+            struct CFunctionInfo* cfunc_info = NULL;
 
-            if (flush_as_finish) {
-                fee_node->data.fee.dur = get_ts() - func_node->ts;
-            } else {
-                fee_node->data.fee.dur = 0;
+            if (PyCFunction_Check(func_node->func)) {
+                cfunc_info = get_cfunction_info((PyCFunctionObject*) func_node->func);
             }
 
-            if (PyCode_Check(func_node->func)) {
-                PyCodeObject* code = (PyCodeObject*) func_node->func;
-                if (flush_as_finish) {
-                    fee_node->data.fee.type = PyTrace_RETURN;
-                } else {
-                    fee_node->data.fee.type = PyTrace_CALL;
-                }
-                fee_node->data.fee.code = (PyCodeObject*)Py_NewRef(code);
-            } else if (PyCFunction_Check(func_node->func)) {
-                PyCFunctionObject* cfunc = (PyCFunctionObject*) func_node->func;
+            if (PyCode_Check(func_node->func) || cfunc_info) {
+                struct EventNode* fee_node = get_next_node(self);
+
+                fee_node->ntype = FEE_NODE;
+                fee_node->ts = func_node->ts;
+                fee_node->tid = meta_node->tid;
+                fee_node->data.fee.extra = NULL;
+
                 if (flush_as_finish) {
-                    fee_node->data.fee.type = PyTrace_C_RETURN;
+                    fee_node->data.fee.dur = get_ts() - func_node->ts;
                 } else {
-                    fee_node->data.fee.type = PyTrace_C_CALL;
+                    fee_node->data.fee.dur = 0;
                 }
-                fee_node->data.fee.ml_name = cfunc->m_ml->ml_name;
-                if (cfunc->m_module) {
-                    // The function belongs to a module
-                    fee_node->data.fee.m_module = Py_NewRef(cfunc->m_module);
+
+                if (cfunc_info) {
+                    if (flush_as_finish) {
+                        fee_node->type = PyTrace_C_RETURN;
+                    } else {
+                        fee_node->type = PyTrace_C_CALL;
+                    }
+                    fee_node->data.fee.cfunc = cfunc_info;
                 } else {
-                    // The function is a class method
-                    fee_node->data.fee.m_module = NULL;
-                    if (cfunc->m_self) {
-                        // It's not a static method, has __self__
-                        fee_node->data.fee.tp_name = cfunc->m_self->ob_type->tp_name;
+                    if (flush_as_finish) {
+                        fee_node->type = PyTrace_RETURN;
                     } else {
-                        // It's a static method, does not have __self__
-                        fee_node->data.fee.tp_name = NULL;
+                        fee_node->type = PyTrace_CALL;
                     }
+                    fee_node->data.fee.code = (PyCodeObject*)Py_NewRef(func_node->func);
                 }
+
+                account_node(self, fee_node);
             }
 
             // Clean up the node
@@ -1066,17 +3572,35 @@ tracer__flush_unfinished(TracerObject* self, int flush_as_finish)
 static PyObject*
 tracer_start(TracerObject* self, PyObject* Py_UNUSED(unused))
 {
-    if (curr_tracer) {
+    if (self->is_snapshot) {
+        PyErr_SetString(PyExc_RuntimeError, "Can't start a snapshot of the buffer");
+        return NULL;
+    }
+
+#if PY_VERSION_HEX < 0x030C0000
+    // There's only one profile function, the tracers can't record at the
+    // same time before sys.monitoring
+    if (active_tracers[0] && active_tracers[0] != self) {
         printf("Warning! Overwrite tracer! You should not have two VizTracer recording at the same time!\n");
-    } else {
-        curr_tracer = self;
+    }
+    active_tracers[0] = self;
+#endif
+
+    if (CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_MEMORY)) {
+        install_alloc_hooks();
     }
 
     self->collecting = 1;
+    // Start the statistics for throttling over for each session
+    self->throttle_generation = ++throttle_generation;
+    self->line_stats_generation = ++line_stats_generation;
 #if PY_VERSION_HEX >= 0x030C0000
     if (enable_monitoring(self) != 0) {
         return NULL;
     };
+    if (self->include_functions && start_include_functions(self) != 0) {
+        return NULL;
+    }
 #else
     // Python: threading.setprofile(tracefunc)
     {
@@ -1112,17 +3636,27 @@ tracer_stop(TracerObject* self, PyObject* stop_option)
         } else {
             tracer__flush_unfinished(self, 0);
         }
+        flush_throttle_summary(self, info);
+        flush_line_stats(self, info);
+        // The futures can't be done in this session anymore
+        Py_CLEAR(self->task_awaits);
+        Py_CLEAR(self->awaited_futures);
         info->curr_stack_depth = 0;
         info->ignore_stack_depth = 0;
         info->paused = 0;
     }
 
-    curr_tracer = NULL;
+    uninstall_alloc_hooks();
 #if PY_VERSION_HEX >= 0x030C0000
     if (disable_monitoring(self) != 0) {
         return NULL;
     }
+    stop_include_functions(self);
+    release_tool_id(self);
 #else
+    if (active_tracers[0] == self) {
+        active_tracers[0] = NULL;
+    }
     PyEval_SetProfile(NULL, NULL);
     // threading.setprofile(None)
     PyObject* result = PyObject_CallMethod(threading_module, "setprofile", "O", Py_None);
@@ -1200,8 +3734,10 @@ tracer_load(TracerObject* self, PyObject* Py_UNUSED(unused))
     PyObject* pid = NULL;
     PyObject* cat_fee = PyUnicode_FromString("FEE");
     PyObject* cat_instant = PyUnicode_FromString("INSTANT");
+    PyObject* cat_line = PyUnicode_FromString("LINE");
     PyObject* ph_B = PyUnicode_FromString("B");
     PyObject* ph_i = PyUnicode_FromString("i");
+    PyObject* scope_t = PyUnicode_FromString("t");
     PyObject* ph_X = PyUnicode_FromString("X");
     PyObject* ph_C = PyUnicode_FromString("C");
     PyObject* ph_M = PyUnicode_FromString("M");
@@ -1212,11 +3748,12 @@ tracer_load(TracerObject* self, PyObject* Py_UNUSED(unused))
     PyObject* key_tid = PyUnicode_FromString("tid");
     PyObject* key_ts = PyUnicode_FromString("ts");
     PyObject* key_dur = PyUnicode_FromString("dur");
+    PyObject* key_tts = PyUnicode_FromString("tts");
+    PyObject* key_tdur = PyUnicode_FromString("tdur");
     PyObject* key_name = PyUnicode_FromString("name");
     PyObject* key_args = PyUnicode_FromString("args");
     PyObject* key_s = PyUnicode_FromString("s");
     PyObject* key_id = PyUnicode_FromString("id");
-    PyObject* key_return_value = PyUnicode_FromString("return_value");
 
     unsigned long counter = 0;
     unsigned long prev_counter = 0;
@@ -1310,30 +3847,9 @@ tracer_load(TracerObject* self, PyObject* Py_UNUSED(unused))
         PyObject* ts = PyFloat_FromDouble(system_ts_to_us(node->ts));
 
         PyDict_SetItem(dict, key_pid, pid);
-        if (CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_ASYNC)) {
-            if (curr->data.fee.asyncio_task == NULL) {
-                PyDict_SetItem(dict, key_tid, tid);
-            } else {
-                PyObject* task_id = PyLong_FromUnsignedLongLong(((uintptr_t)curr->data.fee.asyncio_task) & 0xffffff);
-                PyDict_SetItem(dict, key_tid, task_id);
-                if (!PyDict_Contains(task_dict, task_id)) {
-                    PyObject* task_name = NULL;
-                    if (PyObject_HasAttrString(curr->data.fee.asyncio_task, "get_name")) {
-                        PyObject* task_name_method = PyObject_GetAttrString(curr->data.fee.asyncio_task, "get_name");
-                        task_name = PyObject_CallNoArgs(task_name_method);
-                        Py_DECREF(task_name_method);
-                    } else if (PyObject_HasAttrString(curr->data.fee.asyncio_task, "name")) {
-                        task_name = PyObject_GetAttrString(curr->data.fee.asyncio_task, "name");
-                    } else {
-                        task_name = PyUnicode_FromString("Task");
-                    }
-                    PyDict_SetItem(task_dict, task_id, task_name);
-                    Py_DECREF(task_name);
-                }
-                Py_DECREF(task_id);
-            }
-        } else {
-            PyDict_SetItem(dict, key_tid, tid);
+        PyDict_SetItem(dict, key_tid, tid);
+        if (task_dict) {
+            collect_task_name(self, task_dict, node->tid);
         }
         Py_DECREF(tid);
         PyDict_SetItem(dict, key_ts, ts);
@@ -1343,7 +3859,7 @@ tracer_load(TracerObject* self, PyObject* Py_UNUSED(unused))
         case FEE_NODE:
             name = get_name_from_fee_node(node, func_name_dict);
 
-            if (node->data.fee.type == PyTrace_CALL || node->data.fee.type == PyTrace_C_CALL) {
+            if (node->type == PyTrace_CALL || node->type == PyTrace_C_CALL) {
                 PyDict_SetItem(dict, key_ph, ph_B);
             } else {
                 PyDict_SetItem(dict, key_ph, ph_X);
@@ -1351,15 +3867,20 @@ tracer_load(TracerObject* self, PyObject* Py_UNUSED(unused))
                 PyDict_SetItem(dict, key_dur, dur);
                 Py_DECREF(dur);
             }
+            if (node->data.fee.extra && node->data.fee.extra->has_cpu_time) {
+                PyObject* tts = PyFloat_FromDouble(node->data.fee.extra->cpu_ts / 1000.0);
+                PyObject* tdur = PyFloat_FromDouble(node->data.fee.extra->cpu_dur / 1000.0);
+                PyDict_SetItem(dict, key_tts, tts);
+                PyDict_SetItem(dict, key_tdur, tdur);
+                Py_DECREF(tts);
+                Py_DECREF(tdur);
+            }
             PyDict_SetItem(dict, key_name, name);
             Py_DECREF(name);
 
-            PyObject* arg_dict = Py_XNewRef(node->data.fee.args);
-            if (node->data.fee.retval) {
-                if (!arg_dict) {
-                    arg_dict = PyDict_New();
-                }
-                PyDict_SetItem(arg_dict, key_return_value, node->data.fee.retval);
+            PyObject* arg_dict = NULL;
+            if (node->data.fee.extra) {
+                arg_dict = get_fee_args(self, node->data.fee.extra);
             }
             if (arg_dict) {
                 PyDict_SetItem(dict, key_args, arg_dict);
@@ -1381,13 +3902,69 @@ tracer_load(TracerObject* self, PyObject* Py_UNUSED(unused))
             PyDict_SetItem(dict, key_args, node->data.counter.args);
             break;
         case OBJECT_NODE:
-            PyDict_SetItem(dict, key_ph, node->data.object.ph);
+            ;
+            PyObject* ph = PyUnicode_FromStringAndSize(&node->ph, 1);
+            PyDict_SetItem(dict, key_ph, ph);
+            Py_DECREF(ph);
             PyDict_SetItem(dict, key_id, node->data.object.id);
             PyDict_SetItem(dict, key_name, node->data.object.name);
             if (!(node->data.object.args == Py_None)) {
                 PyDict_SetItem(dict, key_args, node->data.object.args);
             }
             break;
+        case FLOW_NODE:
+            {
+                PyObject* flow_ph = PyUnicode_FromStringAndSize(&node->ph, 1);
+                PyObject* flow_id = PyLong_FromUnsignedLongLong(node->data.flow.id);
+                PyObject* flow_name = PyUnicode_FromString("await");
+                PyDict_SetItem(dict, key_ph, flow_ph);
+                PyDict_SetItem(dict, key_id, flow_id);
+                PyDict_SetItem(dict, key_cat, flow_name);
+                PyDict_SetItem(dict, key_name, flow_name);
+                if (node->ph == 'f') {
+                    // Bind to the slice of the resumed task, not the next one
+                    PyObject* bp = PyUnicode_FromString("e");
+                    PyDict_SetItemString(dict, "bp", bp);
+                    Py_DECREF(bp);
+                }
+                Py_DECREF(flow_ph);
+                Py_DECREF(flow_id);
+                Py_DECREF(flow_name);
+            }
+            break;
+        case EXCEPTION_NODE:
+            PyDict_SetItem(dict, key_ph, ph_i);
+            PyDict_SetItem(dict, key_cat, cat_instant);
+            PyDict_SetItem(dict, key_s, scope_t);
+            {
+                PyObject* exc_name = NULL;
+                PyObject* exc_args = NULL;
+                if (get_exception_event(node, &exc_name, &exc_args) == 0) {
+                    PyDict_SetItem(dict, key_name, exc_name);
+                    PyDict_SetItem(dict, key_args, exc_args);
+                    Py_DECREF(exc_name);
+                    Py_DECREF(exc_args);
+                } else {
+                    PyErr_Clear();
+                }
+            }
+            break;
+        case LINE_NODE:
+            PyDict_SetItem(dict, key_ph, ph_X);
+            PyDict_SetItem(dict, key_cat, cat_line);
+            {
+                PyObject* dur = PyFloat_FromDouble(dur_ts_to_us(node->data.line.dur));
+                PyDict_SetItem(dict, key_dur, dur);
+                Py_DECREF(dur);
+                name = get_line_event_name(node);
+                if (name) {
+                    PyDict_SetItem(dict, key_name, name);
+                    Py_DECREF(name);
+                } else {
+                    PyErr_Clear();
+                }
+            }
+            break;
         case RAW_NODE:
             // We still need to tid from node and we need the pid
             tid = PyLong_FromLong(node->tid);
@@ -1418,9 +3995,12 @@ tracer_load(TracerObject* self, PyObject* Py_UNUSED(unused))
             verbose_printf(self, 1, "Loading data, %lu / %lu\r", counter, self->total_entries);
             prev_counter = counter;
         }
+        if (self->is_snapshot && counter % SNAPTRACE_SNAPSHOT_YIELD_INTERVAL == 0) {
+            snapshot_yield(NULL);
+        }
     }
 
-    if (CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_ASYNC)) {
+    if (task_dict) {
         Py_ssize_t pos = 0;
         PyObject* key = NULL;
         PyObject* value = NULL;
@@ -1439,15 +4019,19 @@ tracer_load(TracerObject* self, PyObject* Py_UNUSED(unused))
             PyDict_SetItem(dict, key_args, args);
             Py_DECREF(args);
             PyList_Append(lst, dict);
+            Py_DECREF(dict);
         }
+        Py_DECREF(task_dict);
     }
 
     verbose_printf(self, 1, "Loading finish                                        \n");
     Py_DECREF(pid);
     Py_DECREF(cat_fee);
     Py_DECREF(cat_instant);
+    Py_DECREF(cat_line);
     Py_DECREF(ph_B);
     Py_DECREF(ph_i);
+    Py_DECREF(scope_t);
     Py_DECREF(ph_X);
     Py_DECREF(ph_C);
     Py_DECREF(ph_M);
@@ -1459,13 +4043,15 @@ tracer_load(TracerObject* self, PyObject* Py_UNUSED(unused))
     Py_DECREF(key_tid);
     Py_DECREF(key_ts);
     Py_DECREF(key_dur);
+    Py_DECREF(key_tts);
+    Py_DECREF(key_tdur);
     Py_DECREF(key_name);
     Py_DECREF(key_args);
     Py_DECREF(key_s);
     Py_DECREF(key_id);
-    Py_DECREF(key_return_value);
 
     self->buffer_tail_idx = self->buffer_head_idx;
+    reset_buffer_accounting(self);
     SNAPTRACE_THREAD_PROTECT_END(self);
     return lst;
 }
@@ -1493,6 +4079,7 @@ tracer_dump(TracerObject* self, PyObject* args, PyObject* kw)
     SNAPTRACE_THREAD_PROTECT_START(self);
     struct EventNode* curr = self->buffer + self->buffer_head_idx;
     unsigned long pid = 0;
+    unsigned long counter = 0;
     uint8_t overflowed = ((self->buffer_tail_idx + 1) % self->buffer_size) == self->buffer_head_idx;
     struct MetadataNode* metadata_node = NULL;
     PyObject* task_dict = NULL;
@@ -1557,26 +4144,8 @@ tracer_dump(TracerObject* self, PyObject* args, PyObject* kw)
         long long ts_long = system_ts_to_ns(node->ts);
         unsigned long tid = node->tid;
 
-        if (CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_ASYNC)) {
-            if (curr->data.fee.asyncio_task != NULL) {
-                tid = (unsigned long)(((uintptr_t)curr->data.fee.asyncio_task) & 0xffffff);
-                PyObject* task_id = PyLong_FromLong(tid);
-                if (!PyDict_Contains(task_dict, task_id)) {
-                    PyObject* task_name = NULL;
-                    if (PyObject_HasAttrString(curr->data.fee.asyncio_task, "get_name")) {
-                        PyObject* task_name_method = PyObject_GetAttrString(curr->data.fee.asyncio_task, "get_name");
-                        task_name = PyObject_CallNoArgs(task_name_method);
-                        Py_DECREF(task_name_method);
-                    } else if (PyObject_HasAttrString(curr->data.fee.asyncio_task, "name")) {
-                        task_name = PyObject_GetAttrString(curr->data.fee.asyncio_task, "name");
-                    } else {
-                        task_name = PyUnicode_FromString("Task");
-                    }
-                    PyDict_SetItem(task_dict, task_id, task_name);
-                    Py_DECREF(task_name);
-                }
-                Py_DECREF(task_id);
-            }
+        if (task_dict) {
+            collect_task_name(self, task_dict, tid);
         }
         if (node->ntype != RAW_NODE) {
             // printf("%f") is about 10x slower than print("%d")
@@ -1588,23 +4157,23 @@ tracer_dump(TracerObject* self, PyObject* args, PyObject* kw)
             ;
             long long dur_long = dur_ts_to_ns(node->data.fee.dur);
             char ph = 'X';
-            if (node->data.fee.type == PyTrace_CALL || node->data.fee.type == PyTrace_C_CALL) {
+            if (node->type == PyTrace_CALL || node->type == PyTrace_C_CALL) {
                 ph = 'B';
             }
-            fprintf(fptr, "\"ph\":\"%c\",\"cat\":\"fee\",\"dur\":%lld.%03lld,\"name\":\"", ph, dur_long / 1000, dur_long % 1000);
+            fprintf(fptr, "\"ph\":\"%c\",\"cat\":\"fee\",\"dur\":%lld.%03lld,", ph, dur_long / 1000, dur_long % 1000);
+            if (node->data.fee.extra && node->data.fee.extra->has_cpu_time) {
+                long long tts_long = node->data.fee.extra->cpu_ts;
+                long long tdur_long = node->data.fee.extra->cpu_dur;
+                fprintf(fptr, "\"tts\":%lld.%03lld,\"tdur\":%lld.%03lld,",
+                        tts_long / 1000, tts_long % 1000, tdur_long / 1000, tdur_long % 1000);
+            }
+            fprintf(fptr, "\"name\":\"");
             fprintfeename(fptr, node, sanitize_function_name);
             fputc('\"', fptr);
 
             PyObject* arg_dict = NULL;
-            if (node->data.fee.args) {
-                arg_dict = node->data.fee.args;
-                Py_INCREF(arg_dict);
-            }
-            if (node->data.fee.retval) {
-                if (!arg_dict) {
-                    arg_dict = PyDict_New();
-                }
-                PyDict_SetItemString(arg_dict, "return_value", node->data.fee.retval);
+            if (node->data.fee.extra) {
+                arg_dict = get_fee_args(self, node->data.fee.extra);
             }
             if (arg_dict) {
                 fprintf(fptr, ",\"args\":");
@@ -1629,8 +4198,8 @@ tracer_dump(TracerObject* self, PyObject* args, PyObject* kw)
             fprintjson(fptr, node->data.counter.args);
             break;
         case OBJECT_NODE:
-            fprintf(fptr, "\"ph\":\"%s\",\"id\":\"%s\",\"name\":\"",
-                    PyUnicode_AsUTF8(node->data.object.ph), PyUnicode_AsUTF8(node->data.object.id));
+            fprintf(fptr, "\"ph\":\"%c\",\"id\":\"%s\",\"name\":\"",
+                    node->ph, PyUnicode_AsUTF8(node->data.object.id));
             fprint_escape(fptr, PyUnicode_AsUTF8(node->data.object.name));
             fputc('\"', fptr);
             if (!(node->data.object.args == Py_None)) {
@@ -1638,6 +4207,43 @@ tracer_dump(TracerObject* self, PyObject* args, PyObject* kw)
                 fprintjson(fptr, node->data.object.args);
             }
             break;
+        case FLOW_NODE:
+            fprintf(fptr, "\"ph\":\"%c\",\"id\":%llu,\"cat\":\"await\",\"name\":\"await\"",
+                    node->ph, (unsigned long long)node->data.flow.id);
+            if (node->ph == 'f') {
+                fprintf(fptr, ",\"bp\":\"e\"");
+            }
+            break;
+        case EXCEPTION_NODE:
+            ;
+            PyObject* exc_name = NULL;
+            PyObject* exc_args = NULL;
+            fprintf(fptr, "\"ph\":\"i\",\"cat\":\"instant\",\"s\":\"t\"");
+            if (get_exception_event(node, &exc_name, &exc_args) == 0) {
+                fprintf(fptr, ",\"name\":\"");
+                fprint_escape(fptr, PyUnicode_AsUTF8(exc_name));
+                fprintf(fptr, "\",\"args\":");
+                fprintjson(fptr, exc_args);
+                Py_DECREF(exc_name);
+                Py_DECREF(exc_args);
+            } else {
+                PyErr_Clear();
+            }
+            break;
+        case LINE_NODE:
+            ;
+            long long line_dur_long = dur_ts_to_ns(node->data.line.dur);
+            PyObject* line_name = get_line_event_name(node);
+            fprintf(fptr, "\"ph\":\"X\",\"cat\":\"line\",\"dur\":%lld.%03lld,\"name\":\"",
+                    line_dur_long / 1000, line_dur_long % 1000);
+            if (line_name) {
+                fprint_escape(fptr, PyUnicode_AsUTF8(line_name));
+                Py_DECREF(line_name);
+            } else {
+                PyErr_Clear();
+            }
+            fputc('\"', fptr);
+            break;
         case RAW_NODE:
             // We still need to tid from node and we need the pid
             ;
@@ -1664,22 +4270,28 @@ tracer_dump(TracerObject* self, PyObject* args, PyObject* kw)
         if (curr == self->buffer + self->buffer_size) {
             curr = self->buffer;
         }
+
+        counter += 1;
+        if (self->is_snapshot && counter % SNAPTRACE_SNAPSHOT_YIELD_INTERVAL == 0) {
+            snapshot_yield(fptr);
+        }
     }
 
-    if (CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_ASYNC)) {
+    if (task_dict) {
         Py_ssize_t pos = 0;
         PyObject* key = NULL;
         PyObject* value = NULL;
         while (PyDict_Next(task_dict, &pos, &key, &value)) {
-            PyObject* tid_repr = PyObject_Repr(key);
-            fprintf(fptr, "{\"ph\":\"M\",\"pid\":%lu,\"tid\":%s,\"name\":\"thread_name\",\"args\":{\"name\":\"%s\"}},",
-                    pid, PyUnicode_AsUTF8(tid_repr), PyUnicode_AsUTF8(value));
-            Py_DECREF(tid_repr);
+            fprintf(fptr, "{\"ph\":\"M\",\"pid\":%lu,\"tid\":%lu,\"name\":\"thread_name\",\"args\":{\"name\":\"",
+                    pid, PyLong_AsUnsignedLong(key));
+            fprint_escape(fptr, PyUnicode_AsUTF8(value));
+            fprintf(fptr, "\"}},");
         }
         Py_DECREF(task_dict);
     }
 
     self->buffer_tail_idx = self->buffer_head_idx;
+    reset_buffer_accounting(self);
     fseek(fptr, -1, SEEK_CUR);
     fprintf(fptr, "], \"viztracer_metadata\": {\"overflow\":%s", overflowed? "true": "false");
 
@@ -1690,7 +4302,13 @@ tracer_dump(TracerObject* self, PyObject* args, PyObject* kw)
     }
 
     fprintf(fptr, "}}");
-    fclose(fptr);
+    if (self->is_snapshot) {
+        Py_BEGIN_ALLOW_THREADS
+        fclose(fptr);
+        Py_END_ALLOW_THREADS
+    } else {
+        fclose(fptr);
+    }
     SNAPTRACE_THREAD_PROTECT_END(self);
     Py_RETURN_NONE;
 }
@@ -1708,10 +4326,139 @@ tracer_clear(TracerObject* self, PyObject* Py_UNUSED(unused))
         }
     }
     self->buffer_tail_idx = self->buffer_head_idx;
+    reset_buffer_accounting(self);
 
     Py_RETURN_NONE;
 }
 
+static PyObject*
+tracer_swapbuffer(TracerObject* self, PyObject* Py_UNUSED(unused))
+{
+    // Move all the recorded data to a new Tracer object and give this
+    // tracer a fresh buffer, so it can keep recording while the data is
+    // saved by another thread. This is the only thing that happens on the
+    // tracing side, so it's cheap.
+    struct EventNode* buffer = NULL;
+    struct MetadataNode* metadata_node = NULL;
+    struct MetadataNode** metadata_tail = NULL;
+    TracerObject* snapshot = NULL;
+    int failed = 0;
+
+    if (self->is_snapshot) {
+        PyErr_SetString(PyExc_RuntimeError, "Can't swap the buffer of a snapshot");
+        return NULL;
+    }
+
+    buffer = (struct EventNode*) PyMem_Calloc(self->buffer_size, sizeof(struct EventNode));
+    if (!buffer) {
+        return PyErr_NoMemory();
+    }
+
+    snapshot = (TracerObject*) Tracer_New(&TracerType, NULL, NULL);
+    if (!snapshot) {
+        PyMem_FREE(buffer);
+        return NULL;
+    }
+
+    snapshot->is_snapshot = 1;
+    // The thread key is shared so it's always valid, snapshot never
+    // creates thread info because it can't be started
+#if _WIN32
+    snapshot->dwTlsIndex = self->dwTlsIndex;
+    snapshot->fix_pid = self->fix_pid > 0 ? self->fix_pid : (long)GetCurrentProcessId();
+#else
+    snapshot->thread_key = self->thread_key;
+    snapshot->fix_pid = self->fix_pid > 0 ? self->fix_pid : (long)getpid();
+#endif
+    snapshot->check_flags = self->check_flags;
+    snapshot->verbose = self->verbose;
+    snapshot->repr_limit = self->repr_limit;
+    // Deferred values are repr'ed when the snapshot is loaded
+    snapshot->log_func_repr = Py_XNewRef(self->log_func_repr);
+    snapshot->process_name = Py_XNewRef(self->process_name);
+    // The names of the tasks are only added, the snapshot can share them
+    snapshot->task_names = Py_XNewRef(self->task_names);
+    snapshot->buffer_size = self->buffer_size;
+
+    SNAPTRACE_THREAD_PROTECT_START(self);
+
+    // Thread names are still needed by the live tracer, copy them
+    metadata_tail = &snapshot->metadata_head;
+    metadata_node = self->metadata_head;
+    while (metadata_node) {
+        struct MetadataNode* node = (struct MetadataNode*) PyMem_Calloc(1, sizeof(struct MetadataNode));
+        if (!node) {
+            failed = 1;
+            break;
+        }
+        node->tid = metadata_node->tid;
+        node->name = Py_NewRef(metadata_node->name);
+        *metadata_tail = node;
+        metadata_tail = &node->next;
+        metadata_node = metadata_node->next;
+    }
+
+    if (!failed) {
+        snapshot->buffer = self->buffer;
+        snapshot->buffer_head_idx = self->buffer_head_idx;
+        snapshot->buffer_tail_idx = self->buffer_tail_idx;
+        snapshot->total_entries = self->total_entries;
+        snapshot->sync_marker = self->sync_marker;
+
+        self->buffer = buffer;
+        self->buffer_head_idx = 0;
+        self->buffer_tail_idx = 0;
+        self->total_entries = 0;
+        reset_buffer_accounting(self);
+    }
+
+    SNAPTRACE_THREAD_PROTECT_END(self);
+
+    if (failed) {
+        // snapshot does not have a buffer yet, give it the new one so it
+        // can be deallocated normally
+        snapshot->buffer = buffer;
+        Py_DECREF(snapshot);
+        return PyErr_NoMemory();
+    }
+
+    return (PyObject*) snapshot;
+}
+
+static PyObject*
+tracer_getentrycount(TracerObject* self, PyObject* Py_UNUSED(unused))
+{
+    long count = self->buffer_tail_idx - self->buffer_head_idx;
+    if (count < 0) {
+        count += self->buffer_size;
+    }
+    return PyLong_FromLong(count);
+}
+
+static PyObject*
+tracer_memoryusage(TracerObject* self, PyObject* Py_UNUSED(unused))
+{
+    int64_t usage = 0;
+
+    SNAPTRACE_THREAD_PROTECT_START(self);
+    if (self->node_memory) {
+        usage = self->memory_usage;
+    } else {
+        // Not tracked when there's no memory limit, walk the buffer
+        long idx = self->buffer_head_idx;
+        while (idx != self->buffer_tail_idx) {
+            usage += sizeof(struct EventNode) + estimate_node_memory(self->buffer + idx);
+            idx = idx + 1;
+            if (idx >= self->buffer_size) {
+                idx = 0;
+            }
+        }
+    }
+    SNAPTRACE_THREAD_PROTECT_END(self);
+
+    return PyLong_FromLongLong(usage);
+}
+
 static PyObject* 
 tracer_setpid(TracerObject* self, PyObject* args)
 {
@@ -1760,6 +4507,10 @@ tracer_resetstack(TracerObject* self, PyObject* Py_UNUSED(unused))
     info->curr_stack_depth = 0;
     info->ignore_stack_depth = 0;
 
+    if (info->tail_root) {
+        finish_tail_root(self, info, 0);
+    }
+
     struct FunctionNode* stack_top = info->stack_top;
     clear_stack(&stack_top);
     info->stack_top = stack_top;
@@ -1815,13 +4566,20 @@ tracer_addinstant(TracerObject* self, PyObject* args, PyObject* kw)
         Py_INCREF(scope);
     }
 
-    node = get_next_node(self);
+    node = get_fee_node(self, info);
+    if (!node) {
+        Py_DECREF(scope);
+        return PyErr_NoMemory();
+    }
     node->ntype = INSTANT_NODE;
     node->tid = info->tid;
     node->ts = get_ts();
     node->data.instant.name = Py_NewRef(name);
     node->data.instant.args = Py_NewRef(instant_args);
     node->data.instant.scope = scope;
+    if (!info->tail_root) {
+        account_node(self, node);
+    }
 
     Py_RETURN_NONE;
 }
@@ -1881,12 +4639,18 @@ tracer_addcounter(TracerObject* self, PyObject* args, PyObject* kw)
         return NULL;
     }
 
-    node = get_next_node(self);
+    node = get_fee_node(self, info);
+    if (!node) {
+        return PyErr_NoMemory();
+    }
     node->ntype = COUNTER_NODE;
     node->tid = info->tid;
     node->ts = get_ts();
     node->data.counter.name = Py_NewRef(name);
     node->data.counter.args = Py_NewRef(counter_args);
+    if (!info->tail_root) {
+        account_node(self, node);
+    }
 
     Py_RETURN_NONE;
 }
@@ -1921,14 +4685,25 @@ tracer_addobject(TracerObject* self, PyObject* args, PyObject* kw)
         object_args = Py_None;
     }
 
-    node = get_next_node(self);
+    if (!PyUnicode_Check(ph) || PyUnicode_GetLength(ph) != 1 || PyUnicode_READ_CHAR(ph, 0) > 127) {
+        PyErr_SetString(PyExc_ValueError, "ph should be a single character");
+        return NULL;
+    }
+
+    node = get_fee_node(self, info);
+    if (!node) {
+        return PyErr_NoMemory();
+    }
     node->ntype = OBJECT_NODE;
     node->tid = info->tid;
     node->ts = get_ts();
-    node->data.object.ph = Py_NewRef(ph);
+    node->ph = (char)PyUnicode_READ_CHAR(ph, 0);
     node->data.object.id = Py_NewRef(id);
     node->data.object.name = Py_NewRef(name);
     node->data.object.args = Py_NewRef(object_args);
+    if (!info->tail_root) {
+        account_node(self, node);
+    }
 
     Py_RETURN_NONE;
 }
@@ -1951,10 +4726,16 @@ tracer_addraw(TracerObject* self, PyObject* args, PyObject* kw)
         return NULL;
     }
 
-    node = get_next_node(self);
+    node = get_fee_node(self, info);
+    if (!node) {
+        return PyErr_NoMemory();
+    }
     node->tid = info->tid;
     node->ntype = RAW_NODE;
     node->data.raw = Py_NewRef(raw);
+    if (!info->tail_root) {
+        account_node(self, node);
+    }
 
     Py_RETURN_NONE;
 }
@@ -1999,6 +4780,8 @@ tracer_getfunctionarg(TracerObject* self, PyObject* Py_UNUSED(unused))
         Py_RETURN_NONE;
     }
 
+    format_func_args(self, fnode->args);
+
     return Py_NewRef(fnode->args);
 }
 
@@ -2032,6 +4815,9 @@ static PyMethodDef Tracer_methods[] = {
     {"load", (PyCFunction)tracer_load, METH_NOARGS, "load buffer"},
     {"dump", (PyCFunction)tracer_dump, METH_VARARGS|METH_KEYWORDS, "dump buffer to file"},
     {"clear", (PyCFunction)tracer_clear, METH_NOARGS, "clear buffer"},
+    {"swap_buffer", (PyCFunction)tracer_swapbuffer, METH_NOARGS, "detach the buffer as a snapshot and use a new one"},
+    {"get_entry_count", (PyCFunction)tracer_getentrycount, METH_NOARGS, "get the number of entries in the buffer"},
+    {"memory_usage", (PyCFunction)tracer_memoryusage, METH_NOARGS, "get the estimated memory used by the entries in the buffer"},
     {"setpid", (PyCFunction)tracer_setpid, METH_VARARGS, "set fixed pid"},
     {"add_instant", (PyCFunction)tracer_addinstant, METH_VARARGS|METH_KEYWORDS, "add instant event"},
     {"add_counter", (PyCFunction)tracer_addcounter, METH_VARARGS|METH_KEYWORDS, "add counter event"},
@@ -2059,7 +4845,10 @@ Tracer_New(PyTypeObject* type, PyObject* args, PyObject* kwargs)
 {
     TracerObject* self = (TracerObject*) type->tp_alloc(type, 0);
     if (self) {
+        self->next_tracer = all_tracers;
+        all_tracers = self;
         self->collecting = 0;
+        self->tool_id = -1;
         self->fix_pid = 0;
         self->total_entries = 0;
         self->check_flags = 0;
@@ -2067,6 +4856,8 @@ Tracer_New(PyTypeObject* type, PyObject* args, PyObject* kwargs)
         self->lib_file_path = NULL;
         self->max_stack_depth = 0;
         self->include_files = NULL;
+        self->log_func_filter = NULL;
+        self->log_func_filter_generation = 0;
         self->exclude_files = NULL;
         self->min_duration = 0;
         self->buffer = NULL;
@@ -2074,6 +4865,35 @@ Tracer_New(PyTypeObject* type, PyObject* args, PyObject* kwargs)
         self->buffer_tail_idx = 0;
         self->sync_marker = 0;
         self->metadata_head = NULL;
+        self->is_snapshot = 0;
+        self->repr_limit = 0;
+        self->log_func_repr = NULL;
+        self->log_func_snapshot = NULL;
+        self->throttle_rate = 0;
+        self->throttle_duration = 0;
+        self->throttle_generation = 0;
+        self->throttled_codes = NULL;
+        self->tail_roots = NULL;
+        self->tail_roots_generation = 0;
+        self->tail_duration = 0;
+        self->trigger_functions = NULL;
+        self->trigger_functions_generation = 0;
+        self->line_functions = NULL;
+        self->line_functions_generation = 0;
+        self->line_stats_generation = 0;
+        self->line_codes = NULL;
+        self->include_functions = NULL;
+        self->include_functions_generation = 0;
+        self->include_codes = NULL;
+        self->task_tids = NULL;
+        self->task_names = NULL;
+        self->task_awaits = NULL;
+        self->awaited_futures = NULL;
+        self->sample_rate = 1;
+        self->sample_step = SNAPTRACE_SAMPLE_SCALE;
+        self->memory_limit = 0;
+        self->memory_usage = 0;
+        self->node_memory = NULL;
     }
 
     return (PyObject*) self;
@@ -2082,11 +4902,27 @@ Tracer_New(PyTypeObject* type, PyObject* args, PyObject* kwargs)
 static int
 Tracer_Init(TracerObject* self, PyObject* args, PyObject* kwargs)
 {
-    if (!PyArg_ParseTuple(args, "l", &self->buffer_size)) {
+    long long memory_limit = 0;
+
+    if (!PyArg_ParseTuple(args, "l|L", &self->buffer_size, &memory_limit)) {
         PyErr_SetString(PyExc_TypeError, "You need to specify buffer size when initializing Tracer");
         return -1;
     }
 
+    if (memory_limit < 0) {
+        PyErr_SetString(PyExc_ValueError, "memory limit can't be negative");
+        return -1;
+    } else if (memory_limit > 0) {
+        // The buffer is sized by memory, it can hold as many entries as
+        // the limit allows if no entry keeps any object
+        self->memory_limit = memory_limit;
+        self->buffer_size = memory_limit / SNAPTRACE_NODE_MEMORY;
+        if (self->buffer_size < 1) {
+            PyErr_SetString(PyExc_ValueError, "memory limit is too small for any entry");
+            return -1;
+        }
+    }
+
     // We need an extra slot for circular buffer
     self->buffer_size += 1;
     self->buffer = (struct EventNode*) PyMem_Calloc(self->buffer_size, sizeof(struct EventNode));
@@ -2095,6 +4931,14 @@ Tracer_Init(TracerObject* self, PyObject* args, PyObject* kwargs)
         return -1;
     }
 
+    if (self->memory_limit) {
+        self->node_memory = (uint32_t*) PyMem_Calloc(self->buffer_size, sizeof(uint32_t));
+        if (!self->node_memory) {
+            PyErr_NoMemory();
+            return -1;
+        }
+    }
+
 #if _WIN32
     if ((self->dwTlsIndex = TlsAlloc()) == TLS_OUT_OF_INDEXES) {
         printf("Error on TLS!\n");
@@ -2114,12 +4958,39 @@ static void
 Tracer_dealloc(TracerObject* self)
 {
     tracer_clear(self, NULL);
+    for (int i = 0; i < SNAPTRACE_MAX_TRACERS; i++) {
+        if (active_tracers[i] == self) {
+            active_tracers[i] = NULL;
+        }
+    }
+    for (TracerObject** tracer = &all_tracers; *tracer; tracer = &(*tracer)->next_tracer) {
+        if (*tracer == self) {
+            *tracer = self->next_tracer;
+            break;
+        }
+    }
     if (self->lib_file_path) {
         PyMem_FREE(self->lib_file_path);
     }
     Py_XDECREF(self->include_files);
+    Py_XDECREF(self->log_func_filter);
+    Py_XDECREF(self->log_func_repr);
+    Py_XDECREF(self->log_func_snapshot);
+    Py_XDECREF(self->throttled_codes);
+    Py_XDECREF(self->tail_roots);
+    Py_XDECREF(self->trigger_functions);
+    Py_XDECREF(self->line_functions);
+    Py_XDECREF(self->line_codes);
+    Py_XDECREF(self->include_functions);
+    Py_XDECREF(self->include_codes);
+    Py_XDECREF(self->task_tids);
+    Py_XDECREF(self->task_names);
+    Py_XDECREF(self->task_awaits);
+    Py_XDECREF(self->awaited_futures);
     Py_XDECREF(self->exclude_files);
+    Py_XDECREF(self->process_name);
     PyMem_FREE(self->buffer);
+    PyMem_FREE(self->node_memory);
 
     struct MetadataNode* node = self->metadata_head;
     struct MetadataNode* prev = NULL;
@@ -2154,6 +5025,204 @@ static PyTypeObject TracerType = {
     .tp_getset = Tracer_getsetters,
 };
 
+// ================================================================
+// snaptrace.SparseWrapper
+// ================================================================
+
+// The native wrapper of @log_sparse without stack_depth. It logs the
+// function as a FEE entry when the tracer is in log_sparse mode.
+typedef struct {
+    PyObject_HEAD
+    PyObject* func;
+    PyCodeObject* code;
+    // NULL to use the global tracer when called
+    TracerObject* tracer;
+    uint64_t sample_step;
+    uint64_t sample_credit;
+    PyObject* dict;
+    vectorcallfunc vectorcall;
+} SparseWrapperObject;
+
+static PyObject* builtins_dict = NULL;
+
+static PyObject*
+SparseWrapper_vectorcall(SparseWrapperObject* self, PyObject* const* args, size_t nargsf, PyObject* kwnames)
+{
+    TracerObject* tracer = self->tracer;
+
+    if (!tracer) {
+        PyObject* global_tracer = PyDict_GetItemString(builtins_dict, "__viz_tracer__");
+        if (global_tracer && PyObject_TypeCheck(global_tracer, &TracerType)) {
+            tracer = (TracerObject*)global_tracer;
+        }
+    }
+
+    // When the tracer is collecting, the function is traced as usual
+    if (!tracer || tracer->collecting ||
+            !CHECK_FLAG(tracer->check_flags, SNAPTRACE_LOG_SPARSE) ||
+            !sample_next(self->sample_step, &self->sample_credit)) {
+        return PyObject_Vectorcall(self->func, args, nargsf, kwnames);
+    }
+
+    // The tracer could be unregistered in the function
+    Py_INCREF(tracer);
+
+    int64_t start = get_ts();
+    PyObject* ret = PyObject_Vectorcall(self->func, args, nargsf, kwnames);
+    int64_t dur = get_ts() - start;
+
+    if (ret) {
+        struct ThreadInfo* info = get_thread_info(tracer);
+        if (!info) {
+            PyErr_SetString(PyExc_RuntimeError, "VizTracer: Failed to get thread info. This should not happen.");
+            Py_DECREF(ret);
+            Py_DECREF(tracer);
+            return NULL;
+        }
+
+        struct EventNode* node = get_next_node(tracer);
+        node->ntype = FEE_NODE;
+        node->ts = start;
+        node->data.fee.dur = dur;
+        node->tid = info->tid;
+        node->type = PyTrace_RETURN;
+        node->data.fee.code = (PyCodeObject*)Py_NewRef(self->code);
+        node->data.fee.extra = NULL;
+        account_node(tracer, node);
+    }
+
+    Py_DECREF(tracer);
+
+    return ret;
+}
+
+static PyObject*
+SparseWrapper_New(PyTypeObject* type, PyObject* args, PyObject* kwargs)
+{
+    PyObject* func = NULL;
+    PyObject* tracer = Py_None;
+    double sample_rate = 1;
+    static char* kwlist[] = {"func", "tracer", "sample_rate", NULL};
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|Od", kwlist, &func, &tracer, &sample_rate)) {
+        return NULL;
+    }
+
+    if (tracer != Py_None && !PyObject_TypeCheck(tracer, &TracerType)) {
+        PyErr_SetString(PyExc_TypeError, "tracer must be a Tracer or None");
+        return NULL;
+    }
+
+    if (sample_rate < 0 || sample_rate > 1) {
+        PyErr_SetString(PyExc_ValueError, "sample_rate should be between 0 and 1");
+        return NULL;
+    }
+
+    PyObject* code = PyObject_GetAttrString(func, "__code__");
+    if (!code) {
+        return NULL;
+    }
+    if (!PyCode_Check(code)) {
+        PyErr_SetString(PyExc_TypeError, "func.__code__ must be a code object");
+        Py_DECREF(code);
+        return NULL;
+    }
+
+    SparseWrapperObject* self = (SparseWrapperObject*)type->tp_alloc(type, 0);
+    if (!self) {
+        Py_DECREF(code);
+        return NULL;
+    }
+
+    self->func = Py_NewRef(func);
+    self->code = (PyCodeObject*)code;
+    self->tracer = tracer == Py_None ? NULL : (TracerObject*)Py_NewRef(tracer);
+    double step = sample_rate * SNAPTRACE_SAMPLE_SCALE;
+    self->sample_step = (uint64_t)step;
+    if (self->sample_step < step) {
+        self->sample_step += 1;
+    }
+    self->sample_credit = 0;
+    self->dict = NULL;
+    self->vectorcall = (vectorcallfunc)SparseWrapper_vectorcall;
+
+    return (PyObject*)self;
+}
+
+static PyObject*
+SparseWrapper_descr_get(PyObject* self, PyObject* obj, PyObject* type)
+{
+    // Bind to the instance like a function
+    if (obj == NULL || obj == Py_None) {
+        return Py_NewRef(self);
+    }
+    return PyMethod_New(self, obj);
+}
+
+static PyObject*
+SparseWrapper_reduce(SparseWrapperObject* self, PyObject* Py_UNUSED(unused))
+{
+    // Pickled by reference like the function, the wrapper is what's
+    // found with the name in the module
+    return PyObject_GetAttrString(self->func, "__qualname__");
+}
+
+static int
+SparseWrapper_traverse(SparseWrapperObject* self, visitproc visit, void* arg)
+{
+    Py_VISIT(self->func);
+    Py_VISIT(self->tracer);
+    Py_VISIT(self->dict);
+    return 0;
+}
+
+static int
+SparseWrapper_clear(SparseWrapperObject* self)
+{
+    Py_CLEAR(self->func);
+    Py_CLEAR(self->code);
+    Py_CLEAR(self->tracer);
+    Py_CLEAR(self->dict);
+    return 0;
+}
+
+static void
+SparseWrapper_dealloc(SparseWrapperObject* self)
+{
+    PyObject_GC_UnTrack(self);
+    SparseWrapper_clear(self);
+    Py_TYPE(self)->tp_free((PyObject*)self);
+}
+
+static PyMethodDef SparseWrapper_methods[] = {
+    {"__reduce__", (PyCFunction)SparseWrapper_reduce, METH_NOARGS, "pickle the wrapper by reference"},
+    {NULL, NULL, 0, NULL}
+};
+
+static PyGetSetDef SparseWrapper_getsetters[] = {
+    {"__dict__", PyObject_GenericGetDict, PyObject_GenericSetDict},
+    {NULL}
+};
+
+static PyTypeObject SparseWrapperType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name = "snaptrace.SparseWrapper",
+    .tp_doc = "SparseWrapper",
+    .tp_basicsize = sizeof(SparseWrapperObject),
+    .tp_itemsize = 0,
+    .tp_flags = Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_GC | Py_TPFLAGS_HAVE_VECTORCALL,
+    .tp_new = SparseWrapper_New,
+    .tp_dealloc = (destructor)SparseWrapper_dealloc,
+    .tp_traverse = (traverseproc)SparseWrapper_traverse,
+    .tp_clear = (inquiry)SparseWrapper_clear,
+    .tp_call = PyVectorcall_Call,
+    .tp_vectorcall_offset = offsetof(SparseWrapperObject, vectorcall),
+    .tp_descr_get = SparseWrapper_descr_get,
+    .tp_dictoffset = offsetof(SparseWrapperObject, dict),
+    .tp_methods = SparseWrapper_methods,
+    .tp_getset = SparseWrapper_getsetters,
+};
+
 // ================================================================
 // snaptrace Module Functions
 // ================================================================
@@ -2161,6 +5230,7 @@ static PyTypeObject TracerType = {
 void
 snaptrace_free(void* Py_UNUSED(unused)) {
     quicktime_free();
+    clear_cfunction_info();
     Py_CLEAR(threading_module);
     Py_CLEAR(multiprocessing_module);
     Py_CLEAR(asyncio_module);
@@ -2168,8 +5238,10 @@ snaptrace_free(void* Py_UNUSED(unused)) {
     Py_CLEAR(curr_task_getters[0]);
     Py_CLEAR(trio_lowlevel_module);
     Py_CLEAR(curr_task_getters[1]);
+    Py_CLEAR(future_type);
     Py_CLEAR(json_module);
     Py_CLEAR(sys_module);
+    Py_CLEAR(builtins_dict);
 }
 
 // ================================================================
@@ -2197,6 +5269,10 @@ PyInit_snaptrace(void)
         return NULL;
     }
 
+    if (PyType_Ready(&SparseWrapperType) < 0) {
+        return NULL;
+    }
+
     m = PyModule_Create(&snaptracemodule);
 
     if (!m) {
@@ -2214,16 +5290,33 @@ PyInit_snaptrace(void)
         return NULL;
     }
 
+    Py_INCREF(&SparseWrapperType);
+    if (PyModule_AddObject(m, "SparseWrapper", (PyObject*) &SparseWrapperType) < 0) {
+        Py_DECREF(&SparseWrapperType);
+        Py_DECREF(m);
+        return NULL;
+    }
+
     threading_module = PyImport_ImportModule("threading");
     multiprocessing_module = PyImport_ImportModule("multiprocessing");
-    if ((trio_module = PyImport_ImportModule("trio"))) {
-        trio_lowlevel_module = PyImport_AddModule("trio.lowlevel");
-        curr_task_getters[1] = PyObject_GetAttrString(trio_lowlevel_module, "current_task");
-    } else {
-        PyErr_Clear();
-    }
     json_module = PyImport_ImportModule("json");
 
+    PyObject* builtins_module = PyImport_ImportModule("builtins");
+    if (!builtins_module) {
+        Py_DECREF(m);
+        return NULL;
+    }
+    builtins_dict = Py_NewRef(PyModule_GetDict(builtins_module));
+    Py_DECREF(builtins_module);
+
+    for (int i = 0; i < SNAPTRACE_MAX_TRACERS; i++) {
+        code_state_extra_index[i] = PyUnstable_Eval_RequestCodeExtraIndex(free_code_state);
+        if (code_state_extra_index[i] < 0) {
+            Py_DECREF(m);
+            return NULL;
+        }
+    }
+
 #if PY_VERSION_HEX >= 0x030C0000
     sys_module = PyImport_ImportModule("sys");
     PyObject* monitoring = PyObject_GetAttrString(sys_module, "monitoring");
@@ -59,13 +59,50 @@
 #define SNAPTRACE_IGNORE_FROZEN (1 << 7)
 #define SNAPTRACE_LOG_ASYNC (1 << 8)
 #define SNAPTRACE_TRACE_SELF (1 << 9)
+#define SNAPTRACE_LOG_FUNC_FILTER (1 << 10)
+#define SNAPTRACE_LOG_FUNC_DEFER_REPR (1 << 11)
+#define SNAPTRACE_FOLD_LOOPS (1 << 12)
+#define SNAPTRACE_TRIGGER_FUNCTIONS (1 << 13)
+#define SNAPTRACE_LOG_SPARSE (1 << 14)
+#define SNAPTRACE_LOG_CPU_TIME (1 << 15)
+#define SNAPTRACE_LOG_MEMORY (1 << 16)
+#define SNAPTRACE_LOG_EXCEPTION (1 << 17)
+#define SNAPTRACE_LOG_LINE_EVENTS (1 << 18)
 
 #define SET_FLAG(reg, flag) ((reg) |= (flag))
 #define UNSET_FLAG(reg, flag) ((reg) &= (~(flag)))
 
 #define CHECK_FLAG(reg, flag) (((reg) & (flag)) != 0) 
 
+// The tracers use the sys.monitoring tool ids from SNAPTRACE_TOOL_ID, so
+// up to SNAPTRACE_MAX_TRACERS tracers can record at the same time
 #define SNAPTRACE_TOOL_ID 2
+#define SNAPTRACE_MAX_TRACERS 3
+
+// The async tasks are shown as threads in the report, their tids start
+// from here so they don't collide with the real threads
+#define SNAPTRACE_TASK_TID_BASE (1UL << 30)
+
+#define SNAPTRACE_SAMPLE_SCALE ((uint64_t)1 << 32)
+
+// log_memory logs a counter every time the thread allocates this many bytes
+#define SNAPTRACE_MEMORY_COUNTER_STEP (64 * 1024)
+
+// The events that are only enabled on the code objects of line_functions
+#define SNAPTRACE_LINE_EVENTS (1 << PY_MONITORING_EVENT_LINE)
+
+// C_RETURN and C_RAISE can't be enabled without CALL
+#define SNAPTRACE_C_EVENTS ((1 << PY_MONITORING_EVENT_CALL) | \
+                            (1 << PY_MONITORING_EVENT_C_RETURN) | \
+                            (1 << PY_MONITORING_EVENT_C_RAISE))
+
+// The events that are only enabled on the code objects of include_functions.
+// PY_THROW and PY_UNWIND can't be local, they are filtered in the callbacks.
+#define SNAPTRACE_INCLUDE_EVENTS ((1 << PY_MONITORING_EVENT_PY_START) | \
+                                  (1 << PY_MONITORING_EVENT_PY_RESUME) | \
+                                  (1 << PY_MONITORING_EVENT_PY_RETURN) | \
+                                  (1 << PY_MONITORING_EVENT_PY_YIELD) | \
+                                  SNAPTRACE_C_EVENTS)
 
 struct FunctionNode {
     struct FunctionNode* next;
@@ -74,6 +111,27 @@ struct FunctionNode {
     PyObject* args;
     // PyCodeObject* for Python function, PyCFunctionObject* for C function
     PyObject* func;
+    // For fold_loops. shape is the hash of the logged subtree so far,
+    // written is the number of entries logged in the subtree, and the
+    // last child is the latest logged child, which the next child could
+    // be folded into.
+    uint64_t shape;
+    uint64_t start_seq;
+    uint64_t written;
+    uint64_t last_child_shape;
+    uint64_t last_child_seq;
+    long last_child_idx;
+    // Thread CPU time in ns, for log_cpu_time
+    int64_t cpu_ts;
+    int64_t cpu_dur;
+    // Bytes allocated by the thread, for log_memory
+    uint64_t alloc_start;
+    uint64_t alloc_bytes;
+    // The line statistics of the function if it's in line_functions, and
+    // the line being executed with the time it started
+    struct LineStats* line_stats;
+    int line;
+    int64_t line_ts;
 };
 
 struct ThreadInfo {
@@ -82,9 +140,25 @@ struct ThreadInfo {
     int ignore_stack_depth;
     unsigned long tid;
     struct FunctionNode* stack_top;
+    // For log_async, the task running on this thread with its tid and the
+    // frame it's resumed with, and the tid of the last task that ran
     PyObject* curr_task;
+    unsigned long curr_task_tid;
     PyFrameObject* curr_task_frame;
+    unsigned long last_task_tid;
     struct MetadataNode* metadata_node;
+    // For tail_roots, the outermost root function being called, and the
+    // entries staged until we know whether the root is slow enough. The
+    // stage is a ring from stage_head when it's as large as the buffer.
+    struct FunctionNode* tail_root;
+    struct EventNode* stage;
+    long stage_size;
+    long stage_head;
+    long stage_len;
+    // For sample_rate, in units of 1 / SNAPTRACE_SAMPLE_SCALE
+    uint64_t sample_credit;
+    // For log_memory, the allocated bytes in the last counter
+    uint64_t alloc_counter_bytes;
 };
 
 struct MetadataNode {
@@ -94,7 +168,7 @@ struct MetadataNode {
     struct ThreadInfo* thread_info;
 };
 
-typedef struct {
+typedef struct TracerObject {
     PyObject_HEAD
 #if _WIN32
     DWORD dwTlsIndex;
@@ -102,6 +176,8 @@ typedef struct {
     pthread_key_t thread_key;
 #endif
     int collecting;
+    // The sys.monitoring tool id while collecting, -1 otherwise
+    int tool_id;
     // When we do fork_save(), we want to keep the pid. This is a 
     // mechanism for child process to keep the parent's pid. If 
     // this value is 0, then the program gets pid before parsing,
@@ -115,20 +191,89 @@ typedef struct {
     PyObject* process_name;
     PyObject* include_files;
     PyObject* exclude_files;
+    // Only log args and return value of the functions that match these
+    PyObject* log_func_filter;
+    uintptr_t log_func_filter_generation;
     PyObject* log_func_repr;
+    // Called on mutable args and return values to keep a copy when repr
+    // is deferred
+    PyObject* log_func_snapshot;
+    // Max length of the repr of args and return values, 0 for no limit
+    long repr_limit;
     double min_duration;
+    // Drop the calls of a function if it's called more than throttle_rate
+    // times per second and its average duration is less than
+    // throttle_duration in ns
+    double throttle_rate;
+    double throttle_duration;
+    uintptr_t throttle_generation;
+    // Functions that have been throttled in this session
+    PyObject* throttled_codes;
+    // Only keep the entries under these functions if the function takes
+    // at least tail_duration in ns
+    PyObject* tail_roots;
+    uintptr_t tail_roots_generation;
+    double tail_duration;
+    // Only record in a thread while it's in one of these functions
+    PyObject* trigger_functions;
+    uintptr_t trigger_functions_generation;
+    // Trace the lines of these functions
+    PyObject* line_functions;
+    uintptr_t line_functions_generation;
+    uintptr_t line_stats_generation;
+    // Functions that have the line events enabled in this session
+    PyObject* line_codes;
+    // Only trace these functions, with the local events on them
+    PyObject* include_functions;
+    uintptr_t include_functions_generation;
+    // Functions that have the local events enabled in this session
+    PyObject* include_codes;
+    // The async tasks that are seen, {weakref to task: tid}, and the names
+    // of them, {tid: name}
+    PyObject* task_tids;
+    PyObject* task_names;
+    // The futures the tasks are waiting for in this session, {tid: future},
+    // and where the futures are done, {future: [waiters, ts, tid]}
+    PyObject* task_awaits;
+    PyObject* awaited_futures;
+    // Only trace this ratio of the invocations of trigger_functions, or
+    // tail_roots if there's no trigger_functions
+    double sample_rate;
+    uint64_t sample_step;
     struct EventNode* buffer;
     long buffer_size;
     long buffer_head_idx;
     long buffer_tail_idx;
+    // Increased for every entry written to the buffer
+    uint64_t node_seq;
     int64_t sync_marker;
     struct MetadataNode* metadata_head;
+    // A snapshot is a Tracer that only owns a buffer detached from the
+    // live tracer by swap_buffer(). It can be loaded or dumped, but not
+    // started.
+    int is_snapshot;
+    // When the buffer is limited by memory instead of entries, node_memory
+    // keeps the estimated memory of each entry in the buffer so we can
+    // evict the oldest entries to stay in memory_limit
+    int64_t memory_limit;
+    int64_t memory_usage;
+    uint32_t* node_memory;
+    // All the tracers alive are linked, including the snapshots, so we
+    // know which ones keep timestamps in their buffers
+    struct TracerObject* next_tracer;
 } TracerObject;
 
+extern TracerObject* active_tracers[SNAPTRACE_MAX_TRACERS];
+extern TracerObject* all_tracers;
 extern PyObject* threading_module;
 extern PyObject* multiprocessing_module;
 extern PyObject* json_module;
 extern PyObject* asyncio_module;
 extern PyObject* asyncio_tasks_module;
+extern uintptr_t log_func_filter_generation;
+extern uintptr_t tail_roots_generation;
+extern uintptr_t trigger_functions_generation;
+extern uintptr_t line_functions_generation;
+extern uintptr_t include_functions_generation;
 
 #endif
@@ -3,10 +3,15 @@
 
 #include "pythoncapi_compat.h"
 #include "snaptrace.h"
+#include "quicktime.h"
 
 extern PyObject* asyncio_module;
 extern PyObject* asyncio_tasks_module;
+extern PyObject* trio_module;
+extern PyObject* trio_lowlevel_module;
 extern PyObject* curr_task_getters[2];
+extern PyObject* future_type;
+extern PyMethodDef* future_resolvers[3];
 
 // ================================================================
 // Tracer members
@@ -382,6 +387,26 @@ Tracer_log_async_setter(TracerObject* self, PyObject* value, void* closure)
             if (PyObject_HasAttrString(asyncio_tasks_module, "current_task")) {
                 curr_task_getters[0] = PyObject_GetAttrString(asyncio_tasks_module, "current_task");
             }
+            // A task waiting for a future is woken up by one of these
+            const char* resolvers[] = {"set_result", "set_exception", "cancel"};
+            future_type = PyObject_GetAttrString(PyImport_AddModule("asyncio.futures"), "Future");
+            for (size_t i = 0; future_type && i < sizeof(resolvers)/sizeof(resolvers[0]); i++) {
+                PyObject* descr = PyObject_GetAttrString(future_type, resolvers[i]);
+                if (descr && Py_IS_TYPE(descr, &PyMethodDescr_Type)) {
+                    future_resolvers[i] = ((PyMethodDescrObject*)descr)->d_method;
+                }
+                Py_XDECREF(descr);
+            }
+            PyErr_Clear();
+        }
+        // trio is optional and it's even slower to import, only do it when needed
+        if (trio_module == NULL) {
+            if ((trio_module = PyImport_ImportModule("trio"))) {
+                trio_lowlevel_module = PyImport_AddModule("trio.lowlevel");
+                curr_task_getters[1] = PyObject_GetAttrString(trio_lowlevel_module, "current_task");
+            } else {
+                PyErr_Clear();
+            }
         }
         SET_FLAG(self->check_flags, SNAPTRACE_LOG_ASYNC);
     } else {
@@ -400,6 +425,161 @@ Tracer_log_async_getter(TracerObject* self, void* closure)
     }
 }
 
+static int
+Tracer_log_sparse_setter(TracerObject* self, PyObject* value, void* closure)
+{
+    if (value == NULL) {
+        PyErr_SetString(PyExc_AttributeError, "Cannot delete the attribute");
+        return -1;
+    }
+
+    if (!PyBool_Check(value)) {
+        PyErr_SetString(PyExc_TypeError, "log_sparse must be a boolean");
+        return -1;
+    }
+
+    if (value == Py_True) {
+        SET_FLAG(self->check_flags, SNAPTRACE_LOG_SPARSE);
+    } else {
+        UNSET_FLAG(self->check_flags, SNAPTRACE_LOG_SPARSE);
+    }
+    return 0;
+}
+
+static PyObject*
+Tracer_log_sparse_getter(TracerObject* self, void* closure)
+{
+    if (CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_SPARSE)) {
+        Py_RETURN_TRUE;
+    } else {
+        Py_RETURN_FALSE;
+    }
+}
+
+static int
+Tracer_log_cpu_time_setter(TracerObject* self, PyObject* value, void* closure)
+{
+    if (value == NULL) {
+        PyErr_SetString(PyExc_AttributeError, "Cannot delete the attribute");
+        return -1;
+    }
+
+    if (!PyBool_Check(value)) {
+        PyErr_SetString(PyExc_TypeError, "log_cpu_time must be a boolean");
+        return -1;
+    }
+
+    if (value == Py_True) {
+        SET_FLAG(self->check_flags, SNAPTRACE_LOG_CPU_TIME);
+    } else {
+        UNSET_FLAG(self->check_flags, SNAPTRACE_LOG_CPU_TIME);
+    }
+    return 0;
+}
+
+static PyObject*
+Tracer_log_cpu_time_getter(TracerObject* self, void* closure)
+{
+    if (CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_CPU_TIME)) {
+        Py_RETURN_TRUE;
+    } else {
+        Py_RETURN_FALSE;
+    }
+}
+
+static int
+Tracer_log_memory_setter(TracerObject* self, PyObject* value, void* closure)
+{
+    if (value == NULL) {
+        PyErr_SetString(PyExc_AttributeError, "Cannot delete the attribute");
+        return -1;
+    }
+
+    if (!PyBool_Check(value)) {
+        PyErr_SetString(PyExc_TypeError, "log_memory must be a boolean");
+        return -1;
+    }
+
+    if (value == Py_True) {
+        SET_FLAG(self->check_flags, SNAPTRACE_LOG_MEMORY);
+    } else {
+        UNSET_FLAG(self->check_flags, SNAPTRACE_LOG_MEMORY);
+    }
+    return 0;
+}
+
+static PyObject*
+Tracer_log_memory_getter(TracerObject* self, void* closure)
+{
+    if (CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_MEMORY)) {
+        Py_RETURN_TRUE;
+    } else {
+        Py_RETURN_FALSE;
+    }
+}
+
+static int
+Tracer_log_exception_setter(TracerObject* self, PyObject* value, void* closure)
+{
+    if (value == NULL) {
+        PyErr_SetString(PyExc_AttributeError, "Cannot delete the attribute");
+        return -1;
+    }
+
+    if (!PyBool_Check(value)) {
+        PyErr_SetString(PyExc_TypeError, "log_exception must be a boolean");
+        return -1;
+    }
+
+    if (value == Py_True) {
+        SET_FLAG(self->check_flags, SNAPTRACE_LOG_EXCEPTION);
+    } else {
+        UNSET_FLAG(self->check_flags, SNAPTRACE_LOG_EXCEPTION);
+    }
+    return 0;
+}
+
+static PyObject*
+Tracer_log_exception_getter(TracerObject* self, void* closure)
+{
+    if (CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_EXCEPTION)) {
+        Py_RETURN_TRUE;
+    } else {
+        Py_RETURN_FALSE;
+    }
+}
+
+static int
+Tracer_log_line_events_setter(TracerObject* self, PyObject* value, void* closure)
+{
+    if (value == NULL) {
+        PyErr_SetString(PyExc_AttributeError, "Cannot delete the attribute");
+        return -1;
+    }
+
+    if (!PyBool_Check(value)) {
+        PyErr_SetString(PyExc_TypeError, "log_line_events must be a boolean");
+        return -1;
+    }
+
+    if (value == Py_True) {
+        SET_FLAG(self->check_flags, SNAPTRACE_LOG_LINE_EVENTS);
+    } else {
+        UNSET_FLAG(self->check_flags, SNAPTRACE_LOG_LINE_EVENTS);
+    }
+    return 0;
+}
+
+static PyObject*
+Tracer_log_line_events_getter(TracerObject* self, void* closure)
+{
+    if (CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_LINE_EVENTS)) {
+        Py_RETURN_TRUE;
+    } else {
+        Py_RETURN_FALSE;
+    }
+}
+
 static int
 Tracer_trace_self_setter(TracerObject* self, PyObject* value, void* closure)
 {
@@ -464,6 +644,488 @@ Tracer_log_func_repr_getter(TracerObject* self, void* closure)
     return Py_NewRef(self->log_func_repr);
 }
 
+static int
+Tracer_log_func_repr_limit_setter(TracerObject* self, PyObject* value, void* closure)
+{
+    if (value == NULL) {
+        PyErr_SetString(PyExc_AttributeError, "Cannot delete the attribute");
+        return -1;
+    }
+
+    if (!PyLong_Check(value)) {
+        PyErr_SetString(PyExc_TypeError, "log_func_repr_limit must be an integer");
+        return -1;
+    }
+
+    self->repr_limit = PyLong_AsLong(value);
+
+    if (self->repr_limit < 0) {
+        self->repr_limit = 0;
+    }
+
+    return 0;
+}
+
+static PyObject*
+Tracer_log_func_repr_limit_getter(TracerObject* self, void* closure)
+{
+    return PyLong_FromLong(self->repr_limit);
+}
+
+static int
+set_func_patterns(PyObject** patterns, PyObject* value, const char* name)
+{
+    // Keep a copy of value, which should be a list of str, so it can't be
+    // changed without going through here. NULL if value is None or empty.
+    if (value == NULL) {
+        PyErr_SetString(PyExc_AttributeError, "Cannot delete the attribute");
+        return -1;
+    }
+
+    if (!PyList_Check(value) && value != Py_None) {
+        PyErr_Format(PyExc_TypeError, "%s must be a list or None", name);
+        return -1;
+    }
+
+    if (value != Py_None) {
+        for (Py_ssize_t i = 0; i < PyList_GET_SIZE(value); i++) {
+            if (!PyUnicode_Check(PyList_GET_ITEM(value, i))) {
+                PyErr_Format(PyExc_TypeError, "%s must be a list of str", name);
+                return -1;
+            }
+        }
+    }
+
+    Py_CLEAR(*patterns);
+    if (value != Py_None && PyList_GET_SIZE(value) > 0) {
+        *patterns = PyList_GetSlice(value, 0, PyList_GET_SIZE(value));
+        if (!*patterns) {
+            return -1;
+        }
+    }
+    return 0;
+}
+
+static PyObject*
+get_func_patterns(PyObject* patterns)
+{
+    if (patterns) {
+        return PyList_GetSlice(patterns, 0, PyList_GET_SIZE(patterns));
+    } else {
+        Py_RETURN_NONE;
+    }
+}
+
+static int
+Tracer_log_func_filter_setter(TracerObject* self, PyObject* value, void* closure)
+{
+    int ret = set_func_patterns(&self->log_func_filter, value, "log_func_filter");
+
+    if (self->log_func_filter) {
+        // The cached results of the previous filter are invalid now
+        self->log_func_filter_generation = ++log_func_filter_generation;
+        SET_FLAG(self->check_flags, SNAPTRACE_LOG_FUNC_FILTER);
+    } else {
+        UNSET_FLAG(self->check_flags, SNAPTRACE_LOG_FUNC_FILTER);
+    }
+    return ret;
+}
+
+static PyObject*
+Tracer_log_func_filter_getter(TracerObject* self, void* closure)
+{
+    return get_func_patterns(self->log_func_filter);
+}
+
+static int
+Tracer_tail_roots_setter(TracerObject* self, PyObject* value, void* closure)
+{
+    int ret = set_func_patterns(&self->tail_roots, value, "tail_roots");
+
+    if (self->tail_roots) {
+        self->tail_roots_generation = ++tail_roots_generation;
+    }
+    return ret;
+}
+
+static PyObject*
+Tracer_tail_roots_getter(TracerObject* self, void* closure)
+{
+    return get_func_patterns(self->tail_roots);
+}
+
+static int
+Tracer_trigger_functions_setter(TracerObject* self, PyObject* value, void* closure)
+{
+    int ret = set_func_patterns(&self->trigger_functions, value, "trigger_functions");
+
+    if (self->trigger_functions) {
+        self->trigger_functions_generation = ++trigger_functions_generation;
+        SET_FLAG(self->check_flags, SNAPTRACE_TRIGGER_FUNCTIONS);
+    } else {
+        UNSET_FLAG(self->check_flags, SNAPTRACE_TRIGGER_FUNCTIONS);
+    }
+    return ret;
+}
+
+static PyObject*
+Tracer_trigger_functions_getter(TracerObject* self, void* closure)
+{
+    return get_func_patterns(self->trigger_functions);
+}
+
+static int
+Tracer_line_functions_setter(TracerObject* self, PyObject* value, void* closure)
+{
+    if (self->collecting) {
+        // The line callback is only registered when the tracer starts
+        PyErr_SetString(PyExc_RuntimeError, "Can't change line_functions while the tracer is collecting");
+        return -1;
+    }
+
+    int ret = set_func_patterns(&self->line_functions, value, "line_functions");
+
+    if (self->line_functions) {
+        self->line_functions_generation = ++line_functions_generation;
+    }
+    return ret;
+}
+
+static PyObject*
+Tracer_line_functions_getter(TracerObject* self, void* closure)
+{
+    return get_func_patterns(self->line_functions);
+}
+
+static int
+Tracer_include_functions_setter(TracerObject* self, PyObject* value, void* closure)
+{
+    if (self->collecting) {
+        // The events are only set up when the tracer starts
+        PyErr_SetString(PyExc_RuntimeError, "Can't change include_functions while the tracer is collecting");
+        return -1;
+    }
+
+    int ret = set_func_patterns(&self->include_functions, value, "include_functions");
+
+    if (self->include_functions) {
+        self->include_functions_generation = ++include_functions_generation;
+    }
+    return ret;
+}
+
+static PyObject*
+Tracer_include_functions_getter(TracerObject* self, void* closure)
+{
+    return get_func_patterns(self->include_functions);
+}
+
+static int
+Tracer_sample_rate_setter(TracerObject* self, PyObject* value, void* closure)
+{
+    if (value == NULL) {
+        PyErr_SetString(PyExc_AttributeError, "Cannot delete the attribute");
+        return -1;
+    }
+
+    if (PyFloat_Check(value)) {
+        self->sample_rate = PyFloat_AsDouble(value);
+    } else if (PyLong_Check(value)) {
+        self->sample_rate = PyLong_AsDouble(value);
+    } else {
+        PyErr_SetString(PyExc_TypeError, "sample_rate must be a float or an integer");
+        return -1;
+    }
+
+    if (self->sample_rate < 0) {
+        self->sample_rate = 0;
+    } else if (self->sample_rate > 1) {
+        self->sample_rate = 1;
+    }
+
+    // Round up so 1 / N is not sampled less than 1 out of N
+    double step = self->sample_rate * SNAPTRACE_SAMPLE_SCALE;
+    self->sample_step = (uint64_t)step;
+    if (self->sample_step < step) {
+        self->sample_step += 1;
+    }
+
+    return 0;
+}
+
+static PyObject*
+Tracer_sample_rate_getter(TracerObject* self, void* closure)
+{
+    return PyFloat_FromDouble(self->sample_rate);
+}
+
+static int
+Tracer_tail_duration_setter(TracerObject* self, PyObject* value, void* closure)
+{
+    if (value == NULL) {
+        PyErr_SetString(PyExc_AttributeError, "Cannot delete the attribute");
+        return -1;
+    }
+
+    if (PyFloat_Check(value)) {
+        self->tail_duration = PyFloat_AsDouble(value);
+    } else if (PyLong_Check(value)) {
+        self->tail_duration = PyLong_AsDouble(value);
+    } else {
+        PyErr_SetString(PyExc_TypeError, "tail_duration must be a float or an integer");
+        return -1;
+    }
+
+    if (self->tail_duration < 0) {
+        self->tail_duration = 0;
+    }
+
+    // The unit is us in Python and ns in C
+    self->tail_duration *= 1000;
+
+    return 0;
+}
+
+static PyObject*
+Tracer_tail_duration_getter(TracerObject* self, void* closure)
+{
+    return PyFloat_FromDouble(self->tail_duration / 1000);
+}
+
+static int
+Tracer_log_func_defer_repr_setter(TracerObject* self, PyObject* value, void* closure)
+{
+    if (value == NULL) {
+        PyErr_SetString(PyExc_AttributeError, "Cannot delete the attribute");
+        return -1;
+    }
+
+    if (!PyBool_Check(value)) {
+        PyErr_SetString(PyExc_TypeError, "log_func_defer_repr must be a boolean");
+        return -1;
+    }
+
+    if (value == Py_True) {
+        SET_FLAG(self->check_flags, SNAPTRACE_LOG_FUNC_DEFER_REPR);
+    } else {
+        UNSET_FLAG(self->check_flags, SNAPTRACE_LOG_FUNC_DEFER_REPR);
+    }
+    return 0;
+}
+
+static PyObject*
+Tracer_log_func_defer_repr_getter(TracerObject* self, void* closure)
+{
+    if (CHECK_FLAG(self->check_flags, SNAPTRACE_LOG_FUNC_DEFER_REPR)) {
+        Py_RETURN_TRUE;
+    } else {
+        Py_RETURN_FALSE;
+    }
+}
+
+static int
+Tracer_log_func_snapshot_setter(TracerObject* self, PyObject* value, void* closure)
+{
+    if (value == NULL) {
+        PyErr_SetString(PyExc_AttributeError, "Cannot delete the attribute");
+        return -1;
+    }
+
+    if (value == Py_None) {
+        Py_CLEAR(self->log_func_snapshot);
+        return 0;
+    }
+
+    if (!PyCallable_Check(value)) {
+        PyErr_SetString(PyExc_TypeError, "log_func_snapshot must be callable");
+        return -1;
+    }
+
+    Py_XSETREF(self->log_func_snapshot, Py_NewRef(value));
+
+    return 0;
+}
+
+static PyObject*
+Tracer_log_func_snapshot_getter(TracerObject* self, void* closure)
+{
+    if (self->log_func_snapshot == NULL) {
+        Py_RETURN_NONE;
+    }
+    return Py_NewRef(self->log_func_snapshot);
+}
+
+static int
+Tracer_fold_loops_setter(TracerObject* self, PyObject* value, void* closure)
+{
+    if (value == NULL) {
+        PyErr_SetString(PyExc_AttributeError, "Cannot delete the attribute");
+        return -1;
+    }
+
+    if (!PyBool_Check(value)) {
+        PyErr_SetString(PyExc_TypeError, "fold_loops must be a boolean");
+        return -1;
+    }
+
+    if (value == Py_True) {
+        SET_FLAG(self->check_flags, SNAPTRACE_FOLD_LOOPS);
+    } else {
+        UNSET_FLAG(self->check_flags, SNAPTRACE_FOLD_LOOPS);
+    }
+    return 0;
+}
+
+static PyObject*
+Tracer_fold_loops_getter(TracerObject* self, void* closure)
+{
+    if (CHECK_FLAG(self->check_flags, SNAPTRACE_FOLD_LOOPS)) {
+        Py_RETURN_TRUE;
+    } else {
+        Py_RETURN_FALSE;
+    }
+}
+
+static int
+Tracer_throttle_rate_setter(TracerObject* self, PyObject* value, void* closure)
+{
+    if (value == NULL) {
+        PyErr_SetString(PyExc_AttributeError, "Cannot delete the attribute");
+        return -1;
+    }
+
+    if (PyFloat_Check(value)) {
+        self->throttle_rate = PyFloat_AsDouble(value);
+    } else if (PyLong_Check(value)) {
+        self->throttle_rate = PyLong_AsDouble(value);
+    } else {
+        PyErr_SetString(PyExc_TypeError, "throttle_rate must be a float or an integer");
+        return -1;
+    }
+
+    if (self->throttle_rate < 0) {
+        self->throttle_rate = 0;
+    }
+
+    return 0;
+}
+
+static PyObject*
+Tracer_throttle_rate_getter(TracerObject* self, void* closure)
+{
+    return PyFloat_FromDouble(self->throttle_rate);
+}
+
+static int
+Tracer_throttle_duration_setter(TracerObject* self, PyObject* value, void* closure)
+{
+    if (value == NULL) {
+        PyErr_SetString(PyExc_AttributeError, "Cannot delete the attribute");
+        return -1;
+    }
+
+    if (PyFloat_Check(value)) {
+        self->throttle_duration = PyFloat_AsDouble(value);
+    } else if (PyLong_Check(value)) {
+        self->throttle_duration = PyLong_AsDouble(value);
+    } else {
+        PyErr_SetString(PyExc_TypeError, "throttle_duration must be a float or an integer");
+        return -1;
+    }
+
+    if (self->throttle_duration < 0) {
+        self->throttle_duration = 0;
+    }
+
+    // The unit is us in Python and ns in C
+    self->throttle_duration *= 1000;
+
+    return 0;
+}
+
+static PyObject*
+Tracer_throttle_duration_getter(TracerObject* self, void* closure)
+{
+    return PyFloat_FromDouble(self->throttle_duration / 1000);
+}
+
+// Indexed by enum QuickTimeClock
+static const char* clock_names[] = {"tsc", "monotonic", "monotonic_coarse"};
+
+static int
+Tracer_clock_setter(TracerObject* self, PyObject* value, void* closure)
+{
+    if (value == NULL) {
+        PyErr_SetString(PyExc_AttributeError, "Cannot delete the attribute");
+        return -1;
+    }
+
+    if (!PyUnicode_Check(value)) {
+        PyErr_SetString(PyExc_TypeError, "clock must be a string");
+        return -1;
+    }
+
+    if (self->collecting) {
+        PyErr_SetString(PyExc_RuntimeError, "Can't change the clock while tracing");
+        return -1;
+    }
+
+    const char* name = PyUnicode_AsUTF8(value);
+    int clock = -1;
+    if (strcmp(name, "auto") == 0) {
+        clock = quicktime_tsc_supported() ? QUICKTIME_CLOCK_TSC : QUICKTIME_CLOCK_MONOTONIC;
+    } else {
+        for (int i = 0; i < (int)(sizeof(clock_names) / sizeof(clock_names[0])); i++) {
+            if (strcmp(name, clock_names[i]) == 0) {
+                clock = i;
+                break;
+            }
+        }
+    }
+
+    if (clock == -1) {
+        PyErr_Format(PyExc_ValueError, "clock must be one of auto, tsc, monotonic and monotonic_coarse, not %s", name);
+        return -1;
+    }
+
+    // The clock is shared by all the tracers, and the timestamps in the
+    // buffers are only converted with it when they are saved
+    if (clock != quicktime_clock) {
+        for (TracerObject* tracer = all_tracers; tracer; tracer = tracer->next_tracer) {
+            if (tracer->collecting) {
+                PyErr_SetString(PyExc_RuntimeError, "Can't change the clock while another tracer is tracing");
+                return -1;
+            }
+            if (tracer->buffer_head_idx != tracer->buffer_tail_idx) {
+                PyErr_SetString(PyExc_RuntimeError, "Can't change the clock while a tracer has unsaved entries");
+                return -1;
+            }
+        }
+    }
+
+    if (quicktime_set_clock(clock) != 0) {
+        PyErr_Format(PyExc_ValueError, "clock %s is not available on this machine", name);
+        return -1;
+    }
+
+    return 0;
+}
+
+static PyObject*
+Tracer_clock_getter(TracerObject* self, void* closure)
+{
+    return PyUnicode_FromString(clock_names[quicktime_clock]);
+}
+
+static PyObject*
+Tracer_tool_id_getter(TracerObject* self, void* closure)
+{
+    if (self->tool_id < 0) {
+        Py_RETURN_NONE;
+    }
+    return PyLong_FromLong(self->tool_id);
+}
+
 PyGetSetDef Tracer_getsetters[] = {
     {"max_stack_depth", (getter)Tracer_max_stack_depth_getter, (setter)Tracer_max_stack_depth_setter, "max_stack_depth", NULL},
     {"include_files", (getter)Tracer_include_files_getter, (setter)Tracer_include_files_setter, "include_files", NULL},
@@ -478,6 +1140,26 @@ PyGetSetDef Tracer_getsetters[] = {
     {"log_func_args", (getter)Tracer_log_func_args_getter, (setter)Tracer_log_func_args_setter, "log_func_args", NULL},
     {"log_async", (getter)Tracer_log_async_getter, (setter)Tracer_log_async_setter, "log_async", NULL},
     {"trace_self", (getter)Tracer_trace_self_getter, (setter)Tracer_trace_self_setter, "trace_self", NULL},
+    {"log_sparse", (getter)Tracer_log_sparse_getter, (setter)Tracer_log_sparse_setter, "log_sparse", NULL},
+    {"log_cpu_time", (getter)Tracer_log_cpu_time_getter, (setter)Tracer_log_cpu_time_setter, "log_cpu_time", NULL},
+    {"log_memory", (getter)Tracer_log_memory_getter, (setter)Tracer_log_memory_setter, "log_memory", NULL},
+    {"log_exception", (getter)Tracer_log_exception_getter, (setter)Tracer_log_exception_setter, "log_exception", NULL},
     {"log_func_repr", (getter)Tracer_log_func_repr_getter, (setter)Tracer_log_func_repr_setter, "log_func_repr", NULL},
+    {"log_func_filter", (getter)Tracer_log_func_filter_getter, (setter)Tracer_log_func_filter_setter, "log_func_filter", NULL},
+    {"log_func_repr_limit", (getter)Tracer_log_func_repr_limit_getter, (setter)Tracer_log_func_repr_limit_setter, "log_func_repr_limit", NULL},
+    {"log_func_defer_repr", (getter)Tracer_log_func_defer_repr_getter, (setter)Tracer_log_func_defer_repr_setter, "log_func_defer_repr", NULL},
+    {"log_func_snapshot", (getter)Tracer_log_func_snapshot_getter, (setter)Tracer_log_func_snapshot_setter, "log_func_snapshot", NULL},
+    {"tail_roots", (getter)Tracer_tail_roots_getter, (setter)Tracer_tail_roots_setter, "tail_roots", NULL},
+    {"tail_duration", (getter)Tracer_tail_duration_getter, (setter)Tracer_tail_duration_setter, "tail_duration", NULL},
+    {"trigger_functions", (getter)Tracer_trigger_functions_getter, (setter)Tracer_trigger_functions_setter, "trigger_functions", NULL},
+    {"include_functions", (getter)Tracer_include_functions_getter, (setter)Tracer_include_functions_setter, "include_functions", NULL},
+    {"line_functions", (getter)Tracer_line_functions_getter, (setter)Tracer_line_functions_setter, "line_functions", NULL},
+    {"log_line_events", (getter)Tracer_log_line_events_getter, (setter)Tracer_log_line_events_setter, "log_line_events", NULL},
+    {"sample_rate", (getter)Tracer_sample_rate_getter, (setter)Tracer_sample_rate_setter, "sample_rate", NULL},
+    {"fold_loops", (getter)Tracer_fold_loops_getter, (setter)Tracer_fold_loops_setter, "fold_loops", NULL},
+    {"throttle_rate", (getter)Tracer_throttle_rate_getter, (setter)Tracer_throttle_rate_setter, "throttle_rate", NULL},
+    {"throttle_duration", (getter)Tracer_throttle_duration_getter, (setter)Tracer_throttle_duration_setter, "throttle_duration", NULL},
+    {"clock", (getter)Tracer_clock_getter, (setter)Tracer_clock_setter, "clock", NULL},
+    {"tool_id", (getter)Tracer_tool_id_getter, NULL, "tool_id", NULL},
     {NULL}
 };
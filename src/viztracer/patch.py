@@ -3,7 +3,9 @@
 
 from __future__ import annotations
 
+import builtins
 import functools
+import itertools
 import multiprocessing.spawn
 import multiprocessing.util
 import os
@@ -12,6 +14,7 @@ import shutil
 import subprocess
 import sys
 import textwrap
+import threading
 import weakref
 from multiprocessing import Process
 from typing import TYPE_CHECKING, Any, Callable, Sequence, no_type_check
@@ -19,11 +22,17 @@ from typing import TYPE_CHECKING, Any, Callable, Sequence, no_type_check
 if TYPE_CHECKING:
     from .viztracer import VizTracer
 
+# Set while subprocess.Popen starts a child. A fork in there is only a
+# helper that runs exec, the child was already sampled by Popen
+_popen_state = threading.local()
 
-def patch_subprocess(viz_args: list[str]) -> None:
+
+def patch_subprocess(tracer: VizTracer, child_config: str) -> None:
     import shlex
     import subprocess
 
+    tracer_ref = weakref.ref(tracer)
+
     # Try to detect the end of the python argument list and parse out various invocation patterns:
     # `file.py args` | - args | `-- file.py args` | `-cprint(5) args` | `-Esm mod args`
     py_arg_pat = re.compile("([^-].+)|-$|(--)$|-([a-z]+)?(c|m)(.+)?", re.IGNORECASE)
@@ -81,9 +90,8 @@ def patch_subprocess(viz_args: list[str]) -> None:
                 sys.executable,
                 *py_args,
                 "-m",
-                "viztracer",
-                "--quiet",
-                *viz_args,
+                "viztracer.bootstrap",
+                child_config,
                 "--",
                 script,
                 *args_iter,
@@ -93,11 +101,9 @@ def patch_subprocess(viz_args: list[str]) -> None:
                 sys.executable,
                 *py_args,
                 "-m",
-                "viztracer",
-                "--quiet",
-                *viz_args,
+                "viztracer.bootstrap",
+                child_config,
                 *mode,
-                "--",
                 *args_iter,
             ]
         return None
@@ -130,14 +136,20 @@ def patch_subprocess(viz_args: list[str]) -> None:
                 new_args = [
                     "python",
                     "-m",
-                    "viztracer",
-                    "--quiet",
-                    *viz_args,
+                    "viztracer.bootstrap",
+                    child_config,
                     "--",
                     *new_args,
                 ]
             else:
                 new_args = None
+            if (
+                new_args is not None
+                and (tracer := tracer_ref()) is not None
+                and not tracer._should_trace_child()
+            ):
+                # This child is not sampled, run it as it is
+                new_args = None
             if new_args is not None and kwargs.get("shell") and isinstance(args, str):
                 # For shell=True, we should convert the commands back to string
                 # if it was passed as string
@@ -147,17 +159,27 @@ def patch_subprocess(viz_args: list[str]) -> None:
         if new_args is None:
             new_args = args
         assert hasattr(subprocess_init, "__wrapped__")  # for mypy
-        subprocess_init.__wrapped__(self, new_args, **kwargs)
+        _popen_state.active = True
+        try:
+            subprocess_init.__wrapped__(self, new_args, **kwargs)
+        finally:
+            _popen_state.active = False
 
     setattr(subprocess.Popen, "__originit__", subprocess.Popen.__init__)
     setattr(subprocess.Popen, "__init__", subprocess_init)
 
 
-def patch_multiprocessing(tracer: VizTracer, viz_args: list[str]) -> None:
+def patch_multiprocessing(
+    tracer: VizTracer, viz_args: list[str], child_config: str
+) -> None:
     tracer_ref = weakref.ref(tracer)
 
     # For fork process
     def func_after_fork(tracer: VizTracer):
+        if not tracer._trace_forked_child:
+            # HookManager already stopped the tracer in this child
+            return
+
         # This is the callback specifically for multiprocessing
         # We have to re-register exit handler here because multiprocessing clears it
         # We also want to reset the stack so it believes the current frame is the root
@@ -188,7 +210,7 @@ def patch_multiprocessing(tracer: VizTracer, viz_args: list[str]) -> None:
                     "%s=%r" % item for item in kwds.items()
                 ]
             else:
-                if (tracer := tracer_ref()) is None:
+                if (tracer := tracer_ref()) is None or not tracer._should_trace_child():
                     prog = (
                         "from multiprocessing.spawn import spawn_main; spawn_main(%s)"
                     )
@@ -230,12 +252,18 @@ def patch_multiprocessing(tracer: VizTracer, viz_args: list[str]) -> None:
                         + ["-m", "viztracer", "--patch_only", *viz_args]
                         + args[idx:]
                     )
-                elif "resource_tracker" not in cmd:
+                elif "resource_tracker" not in cmd and (
+                    (tracer := tracer_ref()) is None or tracer._should_trace_child()
+                ):
                     # We don't trace resource_tracker as it does not quit before the main process
                     # This is a normal spawned process. Only one of spawnv_passfds and spawn._main
                     # can be patched. forkserver process will use spawn._main after forking a child,
                     # so on POSIX we patch spawnv_passfds which has a similar effect on spawned processes.
-                    args = args[:idx] + ["-m", "viztracer", *viz_args] + args[idx:]
+                    args = (
+                        args[:idx]
+                        + ["-m", "viztracer.bootstrap", child_config]
+                        + args[idx:]
+                    )
             ret = _spawnv_passfds(path, args, passfds)
             return ret
 
@@ -300,6 +328,127 @@ def patch_spawned_process(viztracer_kwargs: dict[str, Any], cmdline_args: list[s
     multiprocessing.spawn._main = _main  # type: ignore
 
 
+_task_counter = itertools.count()
+
+
+def _task_name(func: Callable) -> str:
+    import multiprocessing.pool
+
+    while isinstance(func, functools.partial):
+        func = func.func
+    if func in (multiprocessing.pool.mapstar, multiprocessing.pool.starmapstar):  # type: ignore
+        return "map chunk"
+    return getattr(func, "__qualname__", None) or type(func).__qualname__
+
+
+class PoolTask:
+    # A task submitted to a pool. The submission is logged as the start of a
+    # flow event and the run in the worker, which could be in another process,
+    # is logged as a span with the end of the flow event
+    def __init__(self, tracer: VizTracer, func: Callable) -> None:
+        self.func = func
+        self.name = _task_name(func)
+        self.submit_pid = os.getpid()
+        # Flow ids have to be unique across processes and fit in a double
+        self.flow_id = (self.submit_pid << 31) | (next(_task_counter) & 0x7FFFFFFF)
+        self.submit_ts = tracer.getts()
+        tracer.add_raw(
+            {
+                "ph": "s",
+                "id": self.flow_id,
+                "name": "task",
+                "cat": "task",
+                "ts": self.submit_ts,
+            }
+        )
+
+    def __call__(self, *args, **kwargs) -> Any:
+        tracer = builtins.__dict__.get("__viz_tracer__", None)
+        if tracer is None or not tracer.enable:
+            return self.func(*args, **kwargs)
+
+        start = tracer.getts()
+        prev_ignore_stack = tracer.setignorestackcounter(0)
+        try:
+            return self.func(*args, **kwargs)
+        finally:
+            tracer.setignorestackcounter(prev_ignore_stack)
+            end = tracer.getts()
+            tracer.add_raw(
+                {
+                    "ph": "X",
+                    "name": f"task {self.name}",
+                    "cat": "task",
+                    "ts": start,
+                    "dur": end - start,
+                    "args": {
+                        "submit_pid": self.submit_pid,
+                        "submit_ts": self.submit_ts,
+                        "queue_wait": start - self.submit_ts,
+                    },
+                }
+            )
+            tracer.add_raw(
+                {
+                    "ph": "f",
+                    "bp": "e",
+                    "id": self.flow_id,
+                    "name": "task",
+                    "cat": "task",
+                    "ts": start,
+                }
+            )
+
+
+def patch_pool_tasks(tracer: VizTracer) -> None:
+    import concurrent.futures
+    import multiprocessing.pool
+
+    tracer_ref = weakref.ref(tracer)
+
+    def wrap_task(func: Callable) -> Callable:
+        if (tracer := tracer_ref()) is None or not tracer.enable:
+            return func
+        return PoolTask(tracer, func)
+
+    # multiprocessing.pool hands the tasks to the workers in a separate thread,
+    # the task is considered submitted when it's put in the worker queue
+    _handle_tasks = multiprocessing.pool.Pool._handle_tasks  # type: ignore
+
+    @functools.wraps(_handle_tasks)
+    def handle_tasks(taskqueue, put, *args, **kwargs):
+        def traced_put(task):
+            if task is not None:
+                job, idx, func, func_args, func_kwargs = task
+                task = (job, idx, wrap_task(func), func_args, func_kwargs)
+            return put(task)
+
+        return _handle_tasks(taskqueue, traced_put, *args, **kwargs)
+
+    setattr(
+        multiprocessing.pool.Pool,
+        "_handle_tasks_orig",
+        multiprocessing.pool.Pool.__dict__["_handle_tasks"],
+    )
+    setattr(multiprocessing.pool.Pool, "_handle_tasks", staticmethod(handle_tasks))
+
+    for executor in (
+        concurrent.futures.ThreadPoolExecutor,
+        concurrent.futures.ProcessPoolExecutor,
+    ):
+        _submit = executor.submit
+
+        def make_submit(_submit):
+            @functools.wraps(_submit)
+            def submit(self, fn, /, *args, **kwargs):
+                return _submit(self, wrap_task(fn), *args, **kwargs)
+
+            return submit
+
+        setattr(executor, "submit_orig", _submit)
+        setattr(executor, "submit", make_submit(_submit))
+
+
 class HookManager:
     _instance = None
 
@@ -317,10 +466,27 @@ class HookManager:
     def install_hooks(self):
         if not self._installed:
             if hasattr(os, "register_at_fork"):
-                os.register_at_fork(after_in_child=self._after_fork)
+                os.register_at_fork(
+                    before=self._before_fork, after_in_child=self._after_fork
+                )
             sys.addaudithook(self._audit_callback)
             self._installed = True
 
+    def _before_fork(self):
+        if (
+            self._tracer
+            and (tracer := self._tracer())
+            and not tracer.ignore_multiprocess
+        ):
+            if getattr(_popen_state, "active", False):
+                # subprocess forks to exec the command, this is not a child
+                # that runs our code so it does not count
+                tracer._trace_forked_child = False
+                return
+            # The sampling decision has to be made in the parent process so
+            # the counters are shared by all the children
+            tracer._trace_forked_child = tracer._should_trace_child()
+
     def _after_fork(self):
         if (
             self._tracer
@@ -329,12 +495,28 @@ class HookManager:
         ):
             if tracer.report_server_process is not None:
                 tracer.report_server_process = None
+            if not tracer._trace_forked_child:
+                # This child is not sampled. Stop tracing and forget about the
+                # report server. The socket is a copy of the parent's one so
+                # closing it here does not affect the parent
+                tracer.stop()
+                if tracer.report_socket_file is not None:
+                    tracer.report_socket_file.close()
+                    tracer.report_socket_file = None
+                tracer._exiting = True
+                return
+            tracer._spawned_children = 0
+            tracer._traced_children = 0
+            # The rotated files of the parent belong to the parent
+            tracer._rotate_seq = 0
+            tracer._rotated_files.clear()
             if tracer.report_socket_file is not None:
                 # Reconnect to report server in the forked child process
                 # otherwise it conflicts with the parent's connection
                 tracer.connect_report_server()
             tracer.register_exit()
             tracer.start()
+            tracer._start_rotation()
 
     def _audit_callback(self, event: str, args: Any) -> None:  # pragma: no cover
         if (
@@ -356,12 +538,17 @@ class HookManager:
 def install_all_hooks(tracer: VizTracer) -> None:
     uninstall_all_hooks()
 
-    args = tracer.get_args()
-
     # multiprocess hook
     if not tracer.ignore_multiprocess:
-        patch_multiprocessing(tracer, args)
-        patch_subprocess(args)
+        from .bootstrap import encode_config
+
+        args = tracer.get_args()
+        child_config = encode_config(tracer.get_child_kwargs())
+        patch_multiprocessing(tracer, args, child_config)
+        patch_subprocess(tracer, child_config)
+
+    if tracer.log_pool_tasks:
+        patch_pool_tasks(tracer)
 
     HookManager().set_tracer(tracer)
 
@@ -392,3 +579,16 @@ def uninstall_all_hooks() -> None:
             multiprocessing.util.spawnv_passfds_orig,
         )
         delattr(multiprocessing.util, "spawnv_passfds_orig")
+
+    if (pool := sys.modules.get("multiprocessing.pool")) is not None:
+        if "_handle_tasks_orig" in pool.Pool.__dict__:
+            setattr(
+                pool.Pool, "_handle_tasks", pool.Pool.__dict__["_handle_tasks_orig"]
+            )
+            delattr(pool.Pool, "_handle_tasks_orig")
+
+    if (futures := sys.modules.get("concurrent.futures")) is not None:
+        for executor in (futures.ThreadPoolExecutor, futures.ProcessPoolExecutor):
+            if "submit_orig" in executor.__dict__:
+                setattr(executor, "submit", executor.submit_orig)
+                delattr(executor, "submit_orig")
@@ -8,14 +8,19 @@ class Tracer:
 
     include_files: list[str] | None
     exclude_files: list[str] | None
-
-    def __init__(self, tracer_entries: int, /) -> None: ...
+    verbose: int
+    @property
+    def tool_id(self) -> int | None: ...
+    def __init__(self, tracer_entries: int, tracer_memory: int = 0, /) -> None: ...
     def start(self) -> None: ...
     def stop(self, stop_option: str | None) -> None: ...
     def resume(self) -> None: ...
     def pause(self) -> None: ...
     def clear(self) -> None: ...
-    def load(self) -> dict[str, Any]: ...
+    def swap_buffer(self) -> Tracer: ...
+    def get_entry_count(self) -> int: ...
+    def memory_usage(self) -> int: ...
+    def load(self) -> list[dict[str, Any]]: ...
     def dump(self, filename: str, sanitize_function_name: bool = False) -> None: ...
     def setignorestackcounter(self, value: int) -> int: ...
     def reset_stack(self) -> None: ...
@@ -39,3 +44,13 @@ class Tracer:
     def get_sync_marker(self) -> float | None:
         """get synchronization marker or None if not set"""
         ...
+
+class SparseWrapper:
+    def __init__(
+        self,
+        func: Callable,
+        tracer: Tracer | None = None,
+        sample_rate: float = 1.0,
+    ) -> None: ...
+    def __call__(self, *args: Any, **kwargs: Any) -> Any: ...
+    def __reduce__(self) -> str: ...
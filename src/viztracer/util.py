@@ -140,6 +140,23 @@ def time_str_to_us(t_s: str) -> float:
         raise ValueError(f"Can't convert {t_s} to time")
 
 
+def size_str_to_bytes(s: str) -> int:
+    # s is a string representing a size
+    # Should be [0-9\.]+([KMGT]i?B?)?, units are 1024 based
+    #   ex. 512MB 1.5G 300KiB 4096
+    m = re.fullmatch(r"([0-9\.]+)\s*(?:([KMGT])i?)?B?", s.strip(), re.IGNORECASE)
+    if m:
+        try:
+            val = float(m.group(1))
+        except ValueError:
+            raise ValueError(f"Can't convert {s} to size")
+        if m.group(2):
+            val *= 1024 ** ("KMGT".index(m.group(2).upper()) + 1)
+        return int(val)
+    else:
+        raise ValueError(f"Can't convert {s} to size")
+
+
 # https://github.com/giampaolo/psutil
 def pid_exists(pid):
     """Check whether pid exists in the current process table."""
@@ -3,9 +3,9 @@
 
 import builtins
 import gc
-import inspect
 import io
 import json
+import math
 import multiprocessing
 import os
 import platform
@@ -13,16 +13,17 @@ import signal
 import socket
 import subprocess
 import sys
+import threading
+import time
 import warnings
 import zlib
+from collections import deque
 from typing import Any, Callable, Literal, Sequence, TextIO
 
 from viztracer.snaptrace import Tracer
 
 from . import __version__
 from .patch import install_all_hooks, uninstall_all_hooks
-from .report_builder import ReportBuilder
-from .report_server import ReportServer
 from .util import frame_stack_has_func, unique_path
 from .vizevent import VizEvent
 from .vizplugin import VizPluginBase, VizPluginManager
@@ -34,6 +35,7 @@ class VizTracer(Tracer):
     def __init__(
         self,
         tracer_entries: int = 1000000,
+        tracer_memory: int = 0,
         verbose: int = 1,
         max_stack_depth: int = -1,
         include_files: list[str] | None = None,
@@ -43,28 +45,52 @@ class VizTracer(Tracer):
         log_func_retval: bool = False,
         log_func_args: bool = False,
         log_func_repr: Callable[..., str] | None = None,
+        log_func_repr_limit: int = 0,
+        log_func_defer_repr: bool = False,
+        log_func_snapshot: Callable[[Any], Any] | None = None,
+        log_func_filter: list[str] | None = None,
         log_func_with_objprint: bool = False,
         log_print: bool = False,
         log_gc: bool = False,
         log_sparse: bool = False,
         log_async: bool = False,
+        log_cpu_time: bool = False,
+        log_memory: bool = False,
+        log_exception: bool = False,
         log_torch: bool = False,
         log_audit: Sequence[str] | None = None,
+        log_pool_tasks: bool = False,
         ignore_multiprocess: bool = True,
+        trace_child_ratio: float = 1.0,
+        max_traced_children: int = -1,
         pid_suffix: bool = False,
         file_info: bool = True,
         register_global: bool = True,
         report_endpoint: str | None = None,
         trace_self: bool = False,
         min_duration: float = 0,
+        fold_loops: bool = False,
+        tail_roots: list[str] | None = None,
+        tail_duration: float = 0,
+        trigger_functions: list[str] | None = None,
+        include_functions: list[str] | None = None,
+        sample_rate: float = 1.0,
+        line_functions: list[str] | None = None,
+        log_line_events: bool = False,
+        throttle_rate: float = 0,
+        throttle_duration: float = 1,
+        clock: str = "auto",
         minimize_memory: bool = False,
         dump_raw: bool = False,
+        rotate_interval: float = 0,
+        rotate_entries: int = 0,
+        rotate_keep: int = 0,
         sanitize_function_name: bool = False,
         process_name: str | None = None,
         output_file: str = "result.json",
         plugins: Sequence[VizPluginBase | str] | None = None,
     ) -> None:
-        super().__init__(tracer_entries)
+        super().__init__(tracer_entries, tracer_memory)
 
         # Members of C Tracer object
         self.verbose = verbose
@@ -74,12 +100,19 @@ class VizTracer(Tracer):
         self.log_func_args = log_func_args
         self.log_func_retval = log_func_retval
         self.log_async = log_async
+        self.log_cpu_time = log_cpu_time
+        self.log_memory = log_memory
+        self.log_exception = log_exception
         self.log_gc = log_gc
         self.log_print = log_print
         self.trace_self = trace_self
         self.lib_file_path = os.path.dirname(sys._getframe().f_code.co_filename)
         self.process_name = process_name
         self.min_duration = min_duration
+        self.fold_loops = fold_loops
+        self.throttle_rate = throttle_rate
+        self.throttle_duration = throttle_duration
+        self.clock = clock
 
         if include_files is None:
             self.include_files = include_files
@@ -101,9 +134,15 @@ class VizTracer(Tracer):
         self.log_sparse = log_sparse
         self.log_audit = log_audit
         self.log_torch = log_torch
+        self.log_pool_tasks = log_pool_tasks
         self.ignore_multiprocess = ignore_multiprocess
+        self.trace_child_ratio = trace_child_ratio
+        self.max_traced_children = max_traced_children
         self.torch_profile = None
         self.dump_raw = dump_raw
+        self.rotate_interval = rotate_interval
+        self.rotate_entries = rotate_entries
+        self.rotate_keep = rotate_keep
         self.sanitize_function_name = sanitize_function_name
         self.minimize_memory = minimize_memory
         self.system_print = builtins.print
@@ -114,6 +153,7 @@ class VizTracer(Tracer):
         self.enable = False
         self.parsed = False
         self.tracer_entries = tracer_entries
+        self.tracer_memory = tracer_memory
         self.data: dict[str, Any] = {}
         self.total_entries = 0
         self.gc_start_args: dict[str, int] = {}
@@ -127,6 +167,13 @@ class VizTracer(Tracer):
         self.report_directory: str | None = None
 
         self._exiting = False
+        self._spawned_children = 0
+        self._traced_children = 0
+        self._trace_forked_child = True
+        self._rotate_thread: threading.Thread | None = None
+        self._rotate_stop_event = threading.Event()
+        self._rotate_seq = 0
+        self._rotated_files: deque[tuple[str, threading.Thread]] = deque()
         if register_global:
             self.register_global()
 
@@ -142,6 +189,44 @@ class VizTracer(Tracer):
                 )
             log_func_repr = objprint.objstr
         self.log_func_repr = log_func_repr
+        self.log_func_repr_limit = log_func_repr_limit
+        self.log_func_defer_repr = log_func_defer_repr
+        self.log_func_snapshot = log_func_snapshot
+        if log_func_filter is None:
+            self.log_func_filter = log_func_filter
+        else:
+            self.log_func_filter = [
+                self._normalize_func_pattern(f) for f in log_func_filter
+            ]
+
+        if tail_roots is None:
+            self.tail_roots = tail_roots
+        else:
+            self.tail_roots = [self._normalize_func_pattern(f) for f in tail_roots]
+        self.tail_duration = tail_duration
+
+        if trigger_functions is None:
+            self.trigger_functions = trigger_functions
+        else:
+            self.trigger_functions = [
+                self._normalize_func_pattern(f) for f in trigger_functions
+            ]
+        self.sample_rate = sample_rate
+
+        if include_functions is None:
+            self.include_functions = include_functions
+        else:
+            self.include_functions = [
+                self._normalize_func_pattern(f) for f in include_functions
+            ]
+
+        if line_functions is None:
+            self.line_functions = line_functions
+        else:
+            self.line_functions = [
+                self._normalize_func_pattern(f) for f in line_functions
+            ]
+        self.log_line_events = log_line_events
 
         self._afterfork_cb: Callable | None = None
         self._afterfork_args: tuple = tuple()
@@ -163,10 +248,12 @@ class VizTracer(Tracer):
 
         self.clean_report_server_process()
 
-        if not self.ignore_multiprocess:
+        if not self.ignore_multiprocess or self.log_pool_tasks:
             uninstall_all_hooks()
 
     def get_args(self) -> list[str]:
+        import inspect
+
         args = []
         signature = inspect.signature(VizTracer)
         for name, param in signature.parameters.items():
@@ -178,10 +265,14 @@ class VizTracer(Tracer):
                 if name in ("process_name",):
                     continue
 
-                if isinstance(attr, bool):
+                if name == "min_duration":
+                    # min_duration is stored in ns in the C tracer
+                    args.append(f"--{name}")
+                    args.append(f"{attr / 1000}us")
+                elif isinstance(attr, bool):
                     if attr:
                         args.append(f"--{name}")
-                elif isinstance(attr, (int, str)):
+                elif isinstance(attr, (int, float, str)):
                     args.append(f"--{name}")
                     args.append(str(attr))
                 elif (
@@ -194,6 +285,47 @@ class VizTracer(Tracer):
                         args.append(str(item))
         return args
 
+    def get_child_kwargs(self) -> dict[str, Any]:
+        # The kwargs to create the tracer in the child processes. Unlike
+        # init_kwargs, this only includes the changed ones and it has to be
+        # json serializable so it can be passed to viztracer.bootstrap
+        import inspect
+
+        kwargs: dict[str, Any] = {}
+        signature = inspect.signature(VizTracer)
+        for name, param in signature.parameters.items():
+            if name in ("process_name",):
+                continue
+
+            if (attr := getattr(self, name)) != param.default:
+                if name == "min_duration":
+                    # min_duration is stored in ns in the C tracer
+                    kwargs[name] = attr / 1000
+                elif attr is None or isinstance(attr, (bool, int, float, str)):
+                    kwargs[name] = attr
+                elif isinstance(attr, list) and all(isinstance(i, str) for i in attr):
+                    kwargs[name] = attr
+
+        kwargs["verbose"] = 0
+        kwargs["file_info"] = False
+        kwargs["dump_raw"] = True
+        return kwargs
+
+    def _should_trace_child(self) -> bool:
+        # Decide whether the next child process should be traced. Children are
+        # picked evenly with trace_child_ratio, until max_traced_children
+        # of them are traced
+        idx = self._spawned_children
+        self._spawned_children += 1
+        if 0 <= self.max_traced_children <= self._traced_children:
+            return False
+        if math.ceil((idx + 1) * self.trace_child_ratio) <= math.ceil(
+            idx * self.trace_child_ratio
+        ):
+            return False
+        self._traced_children += 1
+        return True
+
     @property
     def pid_suffix(self) -> bool:
         return self.__pid_suffix
@@ -209,6 +341,7 @@ class VizTracer(Tracer):
     def init_kwargs(self) -> dict:
         return {
             "tracer_entries": self.tracer_entries,
+            "tracer_memory": self.tracer_memory,
             "verbose": self.verbose,
             "output_file": self.output_file,
             "max_stack_depth": self.max_stack_depth,
@@ -218,20 +351,52 @@ class VizTracer(Tracer):
             "ignore_frozen": self.ignore_frozen,
             "log_func_retval": self.log_func_retval,
             "log_func_args": self.log_func_args,
+            "log_func_repr_limit": self.log_func_repr_limit,
+            "log_func_defer_repr": self.log_func_defer_repr,
+            "log_func_filter": self.log_func_filter,
             "log_print": self.log_print,
             "log_gc": self.log_gc,
             "log_sparse": self.log_sparse,
             "log_async": self.log_async,
+            "log_cpu_time": self.log_cpu_time,
+            "log_memory": self.log_memory,
+            "log_exception": self.log_exception,
             "log_audit": self.log_audit,
             "log_torch": self.log_torch,
+            "log_pool_tasks": self.log_pool_tasks,
             "pid_suffix": self.pid_suffix,
             "ignore_multiprocess": self.ignore_multiprocess,
+            "trace_child_ratio": self.trace_child_ratio,
+            "max_traced_children": self.max_traced_children,
             "report_endpoint": self.report_endpoint,
             "min_duration": self.min_duration,
+            "fold_loops": self.fold_loops,
+            "tail_roots": self.tail_roots,
+            "tail_duration": self.tail_duration,
+            "trigger_functions": self.trigger_functions,
+            "include_functions": self.include_functions,
+            "sample_rate": self.sample_rate,
+            "line_functions": self.line_functions,
+            "log_line_events": self.log_line_events,
+            "throttle_rate": self.throttle_rate,
+            "throttle_duration": self.throttle_duration,
+            "clock": self.clock,
             "dump_raw": self.dump_raw,
+            "rotate_interval": self.rotate_interval,
+            "rotate_entries": self.rotate_entries,
+            "rotate_keep": self.rotate_keep,
             "minimize_memory": self.minimize_memory,
         }
 
+    @staticmethod
+    def _normalize_func_pattern(pattern: str) -> str:
+        # file:line patterns with an existing file are matched by the
+        # absolute path, so relative paths work too
+        file_name, sep, lineno = pattern.rpartition(":")
+        if sep and lineno.isdigit() and os.path.isfile(file_name):
+            return f"{os.path.abspath(file_name)}:{lineno}"
+        return pattern
+
     def __enter__(self) -> "VizTracer":
         self.start()
         return self
@@ -240,7 +405,8 @@ class VizTracer(Tracer):
         self.stop()
         self.save()
         self.terminate()
-        builtins.__dict__.pop("__viz_tracer__", None)
+        if get_tracer() is self:
+            builtins.__dict__.pop("__viz_tracer__", None)
 
     def connect_report_server(self) -> None:
         assert self.report_endpoint is not None
@@ -343,6 +509,8 @@ class VizTracer(Tracer):
             if not self.ignore_multiprocess or self.report_endpoint is not None:
                 # Multiprocess mode, we need report endpoint and report server
                 if self.report_endpoint is None:
+                    from .report_server import ReportServer
+
                     self.report_server_process, self.report_endpoint = (
                         ReportServer.start_process(
                             output_file=self.output_file,
@@ -355,13 +523,14 @@ class VizTracer(Tracer):
                 if self.report_socket_file is None:
                     self.connect_report_server()
 
-                if not self.ignore_multiprocess:
-                    install_all_hooks(self)
+            if not self.ignore_multiprocess or self.log_pool_tasks:
+                install_all_hooks(self)
 
             self._plugin_manager.event("pre-start")
             if not self.log_sparse:
                 self.enable = True
                 super().start()
+                self._start_rotation()
 
     def stop(self, stop_option: str | None = None) -> None:
         if self.enable:
@@ -369,11 +538,12 @@ class VizTracer(Tracer):
                 self.restore_print()
             if not self.log_sparse:
                 self.enable = False
+                self._stop_rotation()
                 super().stop(stop_option)
             if self.torch_profile is not None:
                 self.torch_profile.__exit__(None, None, None)
             self._plugin_manager.event("post-stop")
-            if not self.ignore_multiprocess:
+            if not self.ignore_multiprocess or self.log_pool_tasks:
                 uninstall_all_hooks()
 
     def parse(self) -> int:
@@ -382,30 +552,63 @@ class VizTracer(Tracer):
         # We parse the buffer into Chrome Trace Event Format
         self.stop()
         if not self.parsed:
-            self.data = {
-                "traceEvents": self.load(),
-                "viztracer_metadata": {
-                    "version": __version__,
-                    "overflow": False,
-                },
-            }
-            sync_marker = self.get_sync_marker()
-            if sync_marker is not None:
-                self.data["viztracer_metadata"]["sync_marker"] = sync_marker
-
-            metadata_count = 0
-            for d in self.data["traceEvents"]:
-                if d["ph"] == "M":
-                    metadata_count += 1
-                else:
-                    break
-            self.total_entries = len(self.data["traceEvents"]) - metadata_count
-            if self.total_entries == self.tracer_entries:
-                self.data["viztracer_metadata"]["overflow"] = True
+            self.data, self.total_entries = self._build_data(
+                self.load(), self.get_sync_marker()
+            )
             self.parsed = True
 
         return self.total_entries
 
+    def _build_data(
+        self, events: list[dict[str, Any]], sync_marker: float | None
+    ) -> tuple[dict[str, Any], int]:
+        # Wrap the loaded events with the metadata, return the data and
+        # the number of non-metadata entries
+        metadata_count = 0
+        for d in events:
+            if d["ph"] == "M":
+                metadata_count += 1
+            else:
+                break
+        total_entries = len(events) - metadata_count
+        data: dict[str, Any] = {
+            "traceEvents": events,
+            "viztracer_metadata": {
+                "version": __version__,
+                "overflow": total_entries == self.tracer_entries,
+            },
+        }
+        if sync_marker is not None:
+            data["viztracer_metadata"]["sync_marker"] = sync_marker
+        return data, total_entries
+
+    def _can_dump_raw(self, output_file: str | TextIO) -> bool:
+        # If there are plugins, we can't do dump raw because it will skip the data
+        # manipulation phase
+        # If we want to dump torch profile, we can't do dump raw either
+        return (
+            not self._plugin_manager.has_plugin
+            and not self.log_torch
+            and self.dump_raw
+            and isinstance(output_file, str)
+        )
+
+    def _write_report(
+        self,
+        data: dict[str, Any] | list,
+        output_file: str | TextIO,
+        file_info: bool,
+    ) -> None:
+        from .report_builder import ReportBuilder
+
+        rb = ReportBuilder(
+            data,
+            0,
+            minimize_memory=self.minimize_memory,
+            base_time=self.get_base_time(),
+        )
+        rb.save(output_file=output_file, file_info=file_info)
+
     def run(self, command: str, output_file: str | None = None) -> None:
         self.start()
         exec(command)
@@ -429,15 +632,8 @@ class VizTracer(Tracer):
             if not os.path.isdir(os.path.dirname(output_file)):
                 os.makedirs(os.path.dirname(output_file), exist_ok=True)
 
-        # If there are plugins, we can't do dump raw because it will skip the data
-        # manipulation phase
-        # If we want to dump torch profile, we can't do dump raw either
-        if (
-            not self._plugin_manager.has_plugin
-            and not self.log_torch
-            and self.dump_raw
-            and isinstance(output_file, str)
-        ):
+        if self._can_dump_raw(output_file):
+            assert isinstance(output_file, str)  # for mypy
             self.dump(output_file, sanitize_function_name=self.sanitize_function_name)
         else:
             if not self.parsed:
@@ -450,7 +646,7 @@ class VizTracer(Tracer):
 
                 with tempfile.NamedTemporaryFile(suffix=".json") as tmpfile:
                     self.torch_profile.export_chrome_trace(tmpfile.name)
-                    rb = ReportBuilder(
+                    self._write_report(
                         [
                             (
                                 tmpfile.name,
@@ -458,19 +654,11 @@ class VizTracer(Tracer):
                             ),
                             self.data,
                         ],
-                        0,
-                        minimize_memory=self.minimize_memory,
-                        base_time=self.get_base_time(),
+                        output_file,
+                        file_info,
                     )
-                    rb.save(output_file=output_file, file_info=file_info)
             else:
-                rb = ReportBuilder(
-                    self.data,
-                    0,
-                    minimize_memory=self.minimize_memory,
-                    base_time=self.get_base_time(),
-                )
-                rb.save(output_file=output_file, file_info=file_info)
+                self._write_report(self.data, output_file, file_info)
 
     def save(
         self,
@@ -585,6 +773,110 @@ class VizTracer(Tracer):
 
         return p
 
+    def background_save(
+        self, output_file: str | None = None, file_info: bool | None = None
+    ) -> threading.Thread:
+        # Detach the recorded data from the tracer and save it in another
+        # thread. The tracer keeps recording into a new buffer.
+        if output_file is None:
+            output_file = self.output_file
+
+        if file_info is None:
+            file_info = self.file_info
+
+        output_file = os.path.abspath(output_file)
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+
+        snapshot = self.swap_buffer()
+
+        t = threading.Thread(
+            target=self._save_snapshot,
+            args=(snapshot, output_file, file_info),
+            name="VizTracer background save",
+        )
+        t.start()
+
+        return t
+
+    def _start_rotation(self) -> None:
+        if self.rotate_interval <= 0 and self.rotate_entries <= 0:
+            return
+
+        if self._rotate_thread is not None and self._rotate_thread.is_alive():
+            return
+
+        self._rotate_stop_event = threading.Event()
+        self._rotate_thread = threading.Thread(
+            target=self._rotate_loop,
+            args=(self._rotate_stop_event, os.path.abspath(self.output_file)),
+            name="VizTracer rotation",
+            daemon=True,
+        )
+        self._rotate_thread.start()
+
+    def _stop_rotation(self) -> None:
+        self._rotate_stop_event.set()
+        if (
+            self._rotate_thread is not None
+            and self._rotate_thread is not threading.current_thread()
+        ):
+            self._rotate_thread.join()
+        self._rotate_thread = None
+
+    def rotate(self, output_file: str | None = None) -> None:
+        # Save the data recorded so far to a new file without stopping the
+        # tracer, and remove the oldest files if there are more than
+        # rotate_keep of them
+        if output_file is None:
+            output_file = os.path.abspath(self.output_file)
+        root, ext = os.path.splitext(output_file)
+        self._rotate_seq += 1
+        path = f"{root}_{time.strftime('%Y%m%d_%H%M%S')}_{os.getpid()}_{self._rotate_seq:04d}{ext}"
+        self._rotated_files.append((path, self.background_save(path)))
+
+        if self.rotate_keep > 0:
+            while len(self._rotated_files) > self.rotate_keep:
+                old_path, t = self._rotated_files.popleft()
+                t.join()
+                try:
+                    os.remove(old_path)
+                except FileNotFoundError:  # pragma: no cover
+                    pass
+
+    def _rotate_loop(self, stop_event: threading.Event, output_file: str) -> None:
+        # This function is in viztracer, so nothing under it will be traced
+        last_rotate = time.monotonic()
+        while True:
+            if self.rotate_entries > 0:
+                # We need to poll the buffer for the number of entries
+                timeout = 0.05
+            else:
+                timeout = max(last_rotate + self.rotate_interval - time.monotonic(), 0)
+            if stop_event.wait(timeout):
+                return
+            now = time.monotonic()
+            if (
+                self.rotate_interval > 0 and now - last_rotate >= self.rotate_interval
+            ) or (
+                self.rotate_entries > 0
+                and self.get_entry_count() >= self.rotate_entries
+            ):
+                self.rotate(output_file)
+                last_rotate = now
+
+    def _save_snapshot(
+        self, snapshot: Tracer, output_file: str, file_info: bool
+    ) -> None:
+        # This function is in viztracer, so nothing under it will be traced
+        snapshot.verbose = 0
+        if self._can_dump_raw(output_file):
+            snapshot.dump(
+                output_file, sanitize_function_name=self.sanitize_function_name
+            )
+        else:
+            data, _ = self._build_data(snapshot.load(), snapshot.get_sync_marker())
+            self._write_report(data, output_file, file_info)
+
     def terminate(self) -> None:
         self._plugin_manager.terminate()
 
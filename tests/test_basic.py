@@ -417,6 +417,34 @@ class TestForkSave(BaseTmpl):
             tracer.fork_save("result.json")
 
 
+class TestBackgroundSave(BaseTmpl):
+    def test_basic(self):
+        for dump_raw in (False, True):
+            with self.subTest(dump_raw=dump_raw):
+                with tempfile.TemporaryDirectory() as tmpdir:
+                    tracer = VizTracer(verbose=0, dump_raw=dump_raw)
+                    tracer.start()
+                    threads = []
+                    for i in range(5, 8):
+                        fib(i)
+                        threads.append(
+                            tracer.background_save(os.path.join(tmpdir, f"{i}.json"))
+                        )
+                    tracer.stop()
+
+                    expected = {5: 15, 6: 25, 7: 41}
+                    for i, t in zip(range(5, 8), threads):
+                        t.join()
+                        with open(os.path.join(tmpdir, f"{i}.json")) as f:
+                            data = json.load(f)
+                        fib_events = [
+                            e
+                            for e in data["traceEvents"]
+                            if e["name"].startswith("fib")
+                        ]
+                        self.assertEqual(len(fib_events), expected[i])
+
+
 class TestGlobalTracer(BaseTmpl):
     def test_get_tracer(self):
         if "__viz_tracer__" in builtins.__dict__:
@@ -3,6 +3,7 @@
 
 import configparser
 import importlib.util
+import json
 import os
 import re
 import signal
@@ -212,6 +213,62 @@ print(os.getpid())
 """
 
 
+file_rotate = """
+import time
+def work():
+    time.sleep(0.01)
+for _ in range(100):
+    work()
+"""
+
+file_tracer_memory = """
+def work(s):
+    return s
+for _ in range(5000):
+    work("a" * 100)
+"""
+
+
+file_fold_loops = """
+def validate(x):
+    return x
+for i in range(1000):
+    validate(i)
+"""
+
+
+file_tail_roots = """
+import time
+def handler(i):
+    if i == 3:
+        time.sleep(0.01)
+for i in range(10):
+    handler(i)
+"""
+
+
+file_trigger_functions = """
+def leaf():
+    pass
+def handler():
+    leaf()
+for i in range(10):
+    leaf()
+    handler()
+"""
+
+
+file_throttle = """
+import time
+def tiny(x):
+    return x
+for i in range(30):
+    for _ in range(1000):
+        tiny(i)
+    time.sleep(0.01)
+"""
+
+
 class TestCommandLineBasic(CmdlineTmpl):
     def test_no_file(self):
         result = self.template(
@@ -527,6 +584,63 @@ class TestCommandLineBasic(CmdlineTmpl):
             [sys.executable, "-m", "viztracer", "--log_func_args", "cmdline_test.py"]
         )
 
+    def test_log_func_repr_limit(self):
+        def check_func(data):
+            for event in data["traceEvents"]:
+                if event["ph"] == "X" and event["name"].startswith("fib"):
+                    self.assertLessEqual(len(event["args"]["return_value"]), 4)
+
+        self.template(
+            [
+                sys.executable,
+                "-m",
+                "viztracer",
+                "--log_func_retval",
+                "--log_func_repr_limit",
+                "1",
+                "cmdline_test.py",
+            ],
+            check_func=check_func,
+        )
+
+    def test_log_func_defer_repr(self):
+        def check_func(data):
+            for event in data["traceEvents"]:
+                if event["ph"] == "X" and event["name"].startswith("fib"):
+                    self.assertIsInstance(event["args"]["return_value"], str)
+
+        self.template(
+            [
+                sys.executable,
+                "-m",
+                "viztracer",
+                "--log_func_retval",
+                "--log_func_defer_repr",
+                "cmdline_test.py",
+            ],
+            check_func=check_func,
+        )
+
+    def test_log_func_filter(self):
+        def check_func(data):
+            for event in data["traceEvents"]:
+                if event["ph"] == "X":
+                    self.assertEqual("args" in event, event["name"].startswith("fib"))
+
+        self.template(
+            [
+                sys.executable,
+                "-m",
+                "viztracer",
+                "--log_func_args",
+                "--log_func_filter",
+                "fib",
+                "--",
+                "cmdline_test.py",
+            ],
+            check_func=check_func,
+        )
+
     def test_log_func_with_objprint(self):
         self.template(
             [
@@ -717,6 +831,38 @@ class TestCommandLineBasic(CmdlineTmpl):
             ]
         )
 
+    def test_tracer_memory(self):
+        def check_func(data):
+            events = [e for e in data["traceEvents"] if e["ph"] == "X"]
+            self.assertGreater(len(events), 10)
+            self.assertLess(len(events), 1000)
+
+        self.template(
+            [
+                sys.executable,
+                "-m",
+                "viztracer",
+                "--tracer_memory",
+                "32KB",
+                "--log_func_args",
+                "cmdline_test.py",
+            ],
+            script=file_tracer_memory,
+            check_func=check_func,
+        )
+        self.template(
+            [
+                sys.executable,
+                "-m",
+                "viztracer",
+                "--tracer_memory",
+                "32XB",
+                "cmdline_test.py",
+            ],
+            success=False,
+            expected_output_file=None,
+        )
+
     def test_trace_self(self):
         def check_func(data):
             self.assertGreater(len(data["traceEvents"]), 1000)
@@ -773,6 +919,283 @@ class TestCommandLineBasic(CmdlineTmpl):
             success=False,
         )
 
+    def test_fold_loops(self):
+        def check_func(data):
+            events = [
+                e
+                for e in data["traceEvents"]
+                if e["ph"] == "X" and e["name"].startswith("validate")
+            ]
+            self.assertEqual(len(events), 1)
+            self.assertEqual(events[0]["args"]["folded"]["count"], 1000)
+
+        self.template(
+            [
+                sys.executable,
+                "-m",
+                "viztracer",
+                "--fold_loops",
+                "cmdline_test.py",
+            ],
+            script=file_fold_loops,
+            check_func=check_func,
+        )
+
+    def test_tail_roots(self):
+        def check_func(data):
+            events = [
+                e
+                for e in data["traceEvents"]
+                if e["ph"] == "X" and e["name"].startswith("handler")
+            ]
+            self.assertEqual(len(events), 1)
+
+        self.template(
+            [
+                sys.executable,
+                "-m",
+                "viztracer",
+                "--tail_roots",
+                "handler",
+                "--tail_duration",
+                "5ms",
+                "--",
+                "cmdline_test.py",
+            ],
+            script=file_tail_roots,
+            check_func=check_func,
+        )
+        self.template(
+            [
+                sys.executable,
+                "-m",
+                "viztracer",
+                "--tail_roots",
+                "handler",
+                "--tail_duration",
+                "5.5.5ms",
+                "--",
+                "cmdline_test.py",
+            ],
+            success=False,
+        )
+
+    def test_trigger_functions(self):
+        def check_func(data):
+            names = [
+                e["name"].split()[0] for e in data["traceEvents"] if e["ph"] == "X"
+            ]
+            self.assertEqual(names.count("handler"), 10)
+            self.assertEqual(names.count("leaf"), 10)
+            self.assertEqual(len(names), 20)
+
+        self.template(
+            [
+                sys.executable,
+                "-m",
+                "viztracer",
+                "--trigger_functions",
+                "handler",
+                "--",
+                "cmdline_test.py",
+            ],
+            script=file_trigger_functions,
+            check_func=check_func,
+        )
+
+    def test_include_functions(self):
+        def check_func(data):
+            names = [
+                e["name"].split()[0] for e in data["traceEvents"] if e["ph"] == "X"
+            ]
+            self.assertEqual(names, ["handler"] * 10)
+
+        self.template(
+            [
+                sys.executable,
+                "-m",
+                "viztracer",
+                "--include_functions",
+                "handler",
+                "--",
+                "cmdline_test.py",
+            ],
+            script=file_trigger_functions,
+            check_func=check_func,
+        )
+
+    @skipIf(sys.version_info < (3, 12), "Line events need sys.monitoring")
+    def test_line_functions(self):
+        def check_func(data):
+            stats = [e for e in data["traceEvents"] if e["ph"] == "i"]
+            self.assertEqual(len(stats), 1)
+            self.assertEqual(stats[0]["args"]["3"]["hits"], 20)
+            lines = [e for e in data["traceEvents"] if e.get("cat") == "LINE"]
+            self.assertEqual(len(lines), 20)
+
+        self.template(
+            [
+                sys.executable,
+                "-m",
+                "viztracer",
+                "--line_functions",
+                "leaf",
+                "--log_line_events",
+                "--",
+                "cmdline_test.py",
+            ],
+            script=file_trigger_functions,
+            check_func=check_func,
+        )
+
+    def test_sample_rate(self):
+        def check_func(data):
+            names = [
+                e["name"].split()[0] for e in data["traceEvents"] if e["ph"] == "X"
+            ]
+            self.assertEqual(names.count("handler"), 5)
+            self.assertEqual(len(names), 10)
+
+        self.template(
+            [
+                sys.executable,
+                "-m",
+                "viztracer",
+                "--trigger_functions",
+                "handler",
+                "--sample_rate",
+                "0.5",
+                "--",
+                "cmdline_test.py",
+            ],
+            script=file_trigger_functions,
+            check_func=check_func,
+        )
+        self.template(
+            [
+                sys.executable,
+                "-m",
+                "viztracer",
+                "--sample_rate",
+                "2",
+                "--",
+                "cmdline_test.py",
+            ],
+            success=False,
+        )
+
+    def test_throttle(self):
+        def check_func(data):
+            logged = [e for e in data["traceEvents"] if e["name"].startswith("tiny")]
+            throttled = [
+                e for e in data["traceEvents"] if e["name"].startswith("throttled tiny")
+            ]
+            self.assertLess(len(logged), 30000)
+            self.assertEqual(
+                len(logged) + sum(e["args"]["calls"] for e in throttled), 30000
+            )
+
+        self.template(
+            [
+                sys.executable,
+                "-m",
+                "viztracer",
+                "--throttle_rate",
+                "1000",
+                "--throttle_duration",
+                "0.1ms",
+                "cmdline_test.py",
+            ],
+            script=file_throttle,
+            check_func=check_func,
+        )
+        self.template(
+            [
+                sys.executable,
+                "-m",
+                "viztracer",
+                "--throttle_rate",
+                "1000",
+                "--throttle_duration",
+                "0.0.1ms",
+                "cmdline_test.py",
+            ],
+            success=False,
+        )
+
+    def test_rotate(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.template(
+                [
+                    sys.executable,
+                    "-m",
+                    "viztracer",
+                    "--rotate_entries",
+                    "40",
+                    "--rotate_keep",
+                    "2",
+                    "--output_dir",
+                    tmpdir,
+                    "cmdline_test.py",
+                ],
+                expected_output_file=None,
+                script=file_rotate,
+            )
+            rotated = sorted(f for f in os.listdir(tmpdir) if f != "result.json")
+            self.assertEqual(len(rotated), 2)
+            for f in rotated:
+                self.assertRegex(f, r"result_\d{8}_\d{6}_\d+_\d{4}\.json")
+                with open(os.path.join(tmpdir, f)) as ff:
+                    self.assertGreaterEqual(
+                        len(
+                            [e for e in json.load(ff)["traceEvents"] if e["ph"] == "X"]
+                        ),
+                        40,
+                    )
+            self.assertFileExists(os.path.join(tmpdir, "result.json"))
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.template(
+                [
+                    sys.executable,
+                    "-m",
+                    "viztracer",
+                    "--rotate_interval",
+                    "0.2",
+                    "--output_dir",
+                    tmpdir,
+                    "cmdline_test.py",
+                ],
+                expected_output_file=None,
+                script=file_rotate,
+            )
+            self.assertGreaterEqual(len(os.listdir(tmpdir)), 3)
+
+        self.template(
+            [
+                sys.executable,
+                "-m",
+                "viztracer",
+                "--rotate_keep",
+                "-1",
+                "cmdline_test.py",
+            ],
+            success=False,
+        )
+        self.template(
+            [
+                sys.executable,
+                "-m",
+                "viztracer",
+                "--tracer_entries",
+                "10",
+                "--rotate_entries",
+                "20",
+                "cmdline_test.py",
+            ],
+            success=False,
+        )
+
     def test_pid_suffix(self):
         result = self.template(
             [
@@ -827,6 +1250,41 @@ class TestCommandLineBasic(CmdlineTmpl):
     def test_log_gc(self):
         self.template(["viztracer", "--log_gc", "cmdline_test.py"], script=file_gc)
 
+    def test_log_cpu_time(self):
+        def check_func(data):
+            events = [e for e in data["traceEvents"] if e["ph"] == "X"]
+            self.assertTrue(events)
+            self.assertTrue(all(e["tdur"] <= e["dur"] + 1 for e in events))
+
+        self.template(
+            ["viztracer", "--log_cpu_time", "cmdline_test.py"],
+            script=file_c_function,
+            check_func=check_func,
+        )
+
+    def test_clock(self):
+        self.template(
+            ["viztracer", "--clock", "monotonic", "cmdline_test.py"],
+            script=file_c_function,
+            expected_entries=3,
+        )
+        self.template(
+            ["viztracer", "--clock", "rdtsc", "cmdline_test.py"],
+            success=False,
+        )
+
+    def test_log_memory(self):
+        def check_func(data):
+            events = [e for e in data["traceEvents"] if e["ph"] == "X"]
+            self.assertTrue(events)
+            self.assertTrue(all(e["args"]["alloc_bytes"] >= 0 for e in events))
+
+        self.template(
+            ["viztracer", "--log_memory", "cmdline_test.py"],
+            script=file_c_function,
+            check_func=check_func,
+        )
+
     def test_log_var(self):
         self.template(
             ["viztracer", "--log_var", "lst", "-o", "result.json", "cmdline_test.py"],
@@ -954,7 +1412,8 @@ class TestCommandLineBasic(CmdlineTmpl):
             ["viztracer", "--log_exception", "-o", "result.json", "cmdline_test.py"],
             script=file_log_exception,
             expected_output_file="result.json",
-            expected_entries=3,
+            # The exception is raised and handled since 3.12
+            expected_entries=4 if sys.version_info >= (3, 12) else 3,
         )
         # Coverage for visit_Raise without change
         self.template(
@@ -60,6 +60,50 @@ assert g() == 1
 """
 
 
+file_sample_rate = """
+from viztracer import log_sparse
+
+@log_sparse(sample_rate=0.1)
+def f():
+    return 1
+
+def h():
+    return 1
+
+@log_sparse(stack_depth=2, sample_rate=0.5)
+def g():
+    return h()
+
+for _ in range(20):
+    assert f() == 1
+for _ in range(20):
+    assert g() == 1
+"""
+
+
+file_method = """
+from viztracer import log_sparse
+
+class A:
+    @log_sparse
+    def f(self, x):
+        \"\"\"doc of f\"\"\"
+        if x < 0:
+            raise ValueError(x)
+        return x
+
+a = A()
+assert a.f(1) == 1
+assert A.f(a, x=2) == 2
+assert A.f.__name__ == "f"
+assert A.f.__doc__ == "doc of f"
+try:
+    a.f(-1)
+except ValueError:
+    pass
+"""
+
+
 file_multiprocess = """
 from multiprocessing import Process
 from viztracer import log_sparse
@@ -98,6 +142,19 @@ if __name__ == "__main__":
     main()
 """
 
+file_multiprocess_pool_spawn = """
+import multiprocessing
+from viztracer import log_sparse
+
+@log_sparse
+def f(x):
+    return x * 2
+
+if __name__ == "__main__":
+    with multiprocessing.get_context("spawn").Pool(2) as pool:
+        assert pool.map(f, range(4)) == [0, 2, 4, 6]
+"""
+
 file_context_manager = """
 from viztracer import VizTracer, log_sparse
 
@@ -215,6 +272,31 @@ class TestLogSparse(CmdlineTmpl):
             check_func=functools.partial(self.check_func, target=["f", "g", "f", "g"]),
         )
 
+    def test_sample_rate(self):
+        self.template(
+            ["viztracer", "-o", "result.json", "--log_sparse", "cmdline_test.py"],
+            script=file_sample_rate,
+            expected_output_file="result.json",
+            expected_entries=22,
+            check_func=functools.partial(
+                self.check_func, target=["f", "f"] + ["h", "g"] * 10
+            ),
+        )
+
+    def test_method(self):
+        self.template(
+            ["viztracer", "-o", "result.json", "--log_sparse", "cmdline_test.py"],
+            script=file_method,
+            expected_output_file="result.json",
+            expected_entries=2,
+            check_func=functools.partial(self.check_func, target=["A.f", "A.f"]),
+        )
+        self.template(
+            [sys.executable, "cmdline_test.py"],
+            script=file_method,
+            expected_output_file=None,
+        )
+
     def test_without_tracer(self):
         self.template(
             [sys.executable, "cmdline_test.py"],
@@ -276,6 +358,16 @@ class TestLogSparse(CmdlineTmpl):
             concurrency="multiprocessing",
         )
 
+    def test_multiprocess_pool_spawn(self):
+        # The function is pickled by reference to the spawned workers
+        self.template(
+            ["viztracer", "-o", "result.json", "--log_sparse", "cmdline_test.py"],
+            script=file_multiprocess_pool_spawn,
+            expected_output_file="result.json",
+            check_func=functools.partial(self.check_func, target=["f"] * 4),
+            concurrency="multiprocessing",
+        )
+
     def test_context_manager(self):
         self.template(
             [sys.executable, "cmdline_test.py"],
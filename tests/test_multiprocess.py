@@ -287,6 +287,103 @@ class TestSubprocess(CmdlineTmpl):
             check_func=check_func,
         )
 
+    def test_child_config(self):
+        script = """
+import subprocess
+import sys
+subprocess.run([sys.executable, "child.py"])
+"""
+
+        def check_func(data):
+            pids = set()
+            func_args = []
+            for entry in data["traceEvents"]:
+                pids.add(entry["pid"])
+                if entry["name"].startswith("fib"):
+                    func_args.append(entry["args"]["func_args"])
+            self.assertEqual(len(pids), 2)
+            self.assertIn({"n": "1"}, func_args)
+
+        self.template(
+            ["viztracer", "-o", "result.json", "--log_func_args", "cmdline_test.py"],
+            expected_output_file="result.json",
+            script=script,
+            check_func=check_func,
+        )
+
+    def test_bootstrap(self):
+        from viztracer import VizTracer
+        from viztracer.bootstrap import decode_config, encode_config
+
+        tracer = VizTracer(
+            max_stack_depth=10,
+            include_files=["./"],
+            min_duration=100,
+            log_func_repr=repr,
+            register_global=False,
+        )
+        kwargs = decode_config(encode_config(tracer.get_child_kwargs()))
+        self.assertEqual(kwargs["max_stack_depth"], 10)
+        self.assertEqual(kwargs["min_duration"], 100)
+        self.assertIn("./", kwargs["include_files"])
+        self.assertEqual(kwargs["verbose"], 0)
+        self.assertNotIn("log_func_repr", kwargs)
+        self.assertNotIn("tracer_entries", kwargs)
+
+        self.template(
+            [
+                sys.executable,
+                "-m",
+                "viztracer.bootstrap",
+                encode_config({"output_file": "result.json"}),
+                "--",
+                "cmdline_test.py",
+            ],
+            expected_output_file="result.json",
+        )
+
+    def test_trace_child_ratio(self):
+        def check_func(expected_pids):
+            def inner(data):
+                pids = set()
+                for entry in data["traceEvents"]:
+                    pids.add(entry["pid"])
+                self.assertEqual(len(pids), expected_pids)
+
+            return inner
+
+        script = """
+import subprocess
+import sys
+for _ in range(3):
+    subprocess.run([sys.executable, "child.py"])
+"""
+
+        # 0.5 traces the 1st and the 3rd child
+        for ratio, expected_pids in (("0", 1), ("0.5", 3)):
+            self.template(
+                [
+                    "viztracer",
+                    "-o",
+                    "result.json",
+                    "--trace_child_ratio",
+                    ratio,
+                    "cmdline_test.py",
+                ],
+                expected_output_file="result.json",
+                script=script,
+                check_func=check_func(expected_pids),
+            )
+
+    def test_trace_child_ratio_invalid(self):
+        self.template(
+            ["viztracer", "--trace_child_ratio", "1.5", "cmdline_test.py"],
+            script=file_parent,
+            expected_output_file=None,
+            success=False,
+            expected_stdout=".*between 0 and 1.*",
+        )
+
     def test_child_process(self):
         with tempfile.TemporaryDirectory() as tmpdir:
             output_path = os.path.join(tmpdir, "result.json")
@@ -664,6 +761,47 @@ class TestMultiprocessing(CmdlineTmpl):
             if not os.getenv("COVERAGE_RUN"):
                 raise e
 
+    @unittest.skipIf("win32" in sys.platform, "Does not support Windows")
+    def test_log_pool_tasks(self):
+        script = """
+            from concurrent.futures import ThreadPoolExecutor
+            from multiprocessing import Pool
+
+            def work(x):
+                return x * 2
+
+            if __name__ == "__main__":
+                with ThreadPoolExecutor(2) as executor:
+                    list(executor.map(work, range(3)))
+                with Pool(2) as pool:
+                    pool.map(work, range(4), chunksize=1)
+        """
+
+        def check_func(data):
+            tasks = [e for e in data["traceEvents"] if e.get("cat") == "task"]
+            spans = [e for e in tasks if e["ph"] == "X"]
+            self.assertEqual(len(spans), 7)
+            self.assertEqual(
+                sorted(e["name"] for e in spans),
+                ["task map chunk"] * 4 + ["task work"] * 3,
+            )
+            main_pid = spans[-1]["args"]["submit_pid"]
+            self.assertEqual(len([e for e in spans if e["pid"] != main_pid]), 4)
+            for span in spans:
+                self.assertGreaterEqual(span["args"]["queue_wait"], 0)
+            flow_start = {e["id"] for e in tasks if e["ph"] == "s"}
+            flow_end = {e["id"] for e in tasks if e["ph"] == "f"}
+            self.assertEqual(len(flow_start), 7)
+            self.assertEqual(flow_start, flow_end)
+
+        self.template(
+            ["viztracer", "-o", "result.json", "--log_pool_tasks", "cmdline_test.py"],
+            expected_output_file="result.json",
+            script=script,
+            check_func=check_func,
+            concurrency="multiprocessing",
+        )
+
     @unittest.skipIf("win32" in sys.platform, "Does not support Windows")
     def test_multiprocessing_pool_with_pickle(self):
         def check_func(data):
@@ -756,6 +894,101 @@ class TestMultiprocessing(CmdlineTmpl):
             concurrency="multiprocessing",
         )
 
+    @unittest.skipIf(
+        "fork" not in multiprocessing.get_all_start_methods(), "Only need to test fork"
+    )
+    def test_max_traced_children(self):
+        script = """
+            import multiprocessing
+            import os
+
+            def f():
+                pass
+
+            if __name__ == "__main__":
+                for _ in range(3):
+                    p = multiprocessing.Process(target=f)
+                    p.start()
+                    p.join()
+                pid = os.fork()
+                if pid == 0:
+                    f()
+                    os._exit(0)
+                os.waitpid(pid, 0)
+        """
+
+        def check_func(data):
+            pids = set()
+            for entry in data["traceEvents"]:
+                pids.add(entry["pid"])
+            self.assertEqual(len(pids), 2)
+
+        self.template(
+            [
+                "viztracer",
+                "-o",
+                "result.json",
+                "--max_traced_children",
+                "1",
+                "cmdline_test.py",
+            ],
+            expected_output_file="result.json",
+            script=script,
+            check_func=check_func,
+            concurrency="multiprocessing",
+        )
+
+    @unittest.skipIf(
+        "fork" not in multiprocessing.get_all_start_methods(), "Only need to test fork"
+    )
+    def test_max_traced_children_subprocess_fork(self):
+        # subprocess forks a helper to run exec with preexec_fn, it does not
+        # count as a child
+        script = """
+            import multiprocessing
+            import subprocess
+
+            def f():
+                pass
+
+            if __name__ == "__main__":
+                for _ in range(3):
+                    subprocess.run(["true"], preexec_fn=f)
+                p = multiprocessing.Process(target=f)
+                p.start()
+                p.join()
+        """
+
+        def check_func(data):
+            pids = set()
+            for entry in data["traceEvents"]:
+                pids.add(entry["pid"])
+            self.assertEqual(len(pids), 2)
+
+        self.template(
+            [
+                "viztracer",
+                "-o",
+                "result.json",
+                "--max_traced_children",
+                "1",
+                "cmdline_test.py",
+            ],
+            expected_output_file="result.json",
+            script=script,
+            check_func=check_func,
+            concurrency="multiprocessing",
+        )
+
+    def test_should_trace_child(self):
+        from viztracer import VizTracer
+
+        tracer = VizTracer(
+            trace_child_ratio=0.25, max_traced_children=3, register_global=False
+        )
+        decisions = [tracer._should_trace_child() for _ in range(16)]
+        self.assertEqual([i for i, traced in enumerate(decisions) if traced], [0, 4, 8])
+
 
 class TestInlineSupport(CmdlineTmpl):
     def test_inline_basic(self):
@@ -9,6 +9,7 @@ import os
 import random
 import tempfile
 import time
+import tracemalloc
 
 from viztracer import VizTracer
 
@@ -105,6 +106,28 @@ class TestPerformance(BaseTmpl):
                 tracer.dump(ofile)
         tracer.clear()
 
+        # With viztracer + c tracer + thread CPU time
+        tracer = VizTracer(verbose=0, log_cpu_time=True)
+        tracer.start()
+        with bm_timer.time("c_cpu_time", "c_cpu_time"):
+            func()
+        tracer.stop()
+        tracer.clear()
+
+        # With viztracer + c tracer + allocated bytes
+        tracer = VizTracer(verbose=0, log_memory=True)
+        tracer.start()
+        with bm_timer.time("c_memory", "c_memory"):
+            func()
+        tracer.stop()
+        tracer.clear()
+
+        # With tracemalloc only, for the cost of tracking memory
+        tracemalloc.start()
+        with bm_timer.time("tracemalloc", "tracemalloc"):
+            func()
+        tracemalloc.stop()
+
         # With cProfiler
         pr = cProfile.Profile()
         pr.enable()
@@ -265,6 +288,15 @@ class TestFilterPerformance(BaseTmpl):
         tracer.stop()
         tracer.clear()
 
+        tracer.max_stack_depth = -1
+        tracer.include_functions = [func.__name__]
+        tracer.start()
+        with Timer() as t:
+            func()
+            include_functions = t.get_time()
+        tracer.stop()
+        tracer.clear()
+
         logging.info("Filter performance:")
         logging.info(f"Baseline:        {baseline:.9f}(1)")
         logging.info(
@@ -273,6 +305,9 @@ class TestFilterPerformance(BaseTmpl):
         logging.info(
             f"Max stack depth: {max_stack_depth:.9f}({max_stack_depth / baseline:.2f})"
         )
+        logging.info(
+            f"Include funcs:   {include_functions:.9f}({include_functions / baseline:.2f})"
+        )
 
     def test_hanoi(self):
         def hanoi():
@@ -285,3 +320,43 @@ class TestFilterPerformance(BaseTmpl):
             TowerOfHanoi(12, "A", "B", "C")
 
         self.do_one_function(hanoi)
+
+
+class TestClockPerformance(BaseTmpl):
+    def test_clock(self):
+        def hanoi():
+            def TowerOfHanoi(n, source, destination, auxiliary):
+                if n == 1:
+                    return
+                TowerOfHanoi(n - 1, source, auxiliary, destination)
+                TowerOfHanoi(n - 1, auxiliary, destination, source)
+
+            TowerOfHanoi(15, "A", "B", "C")
+
+        def time_calls(func, n=100000):
+            with Timer() as t:
+                for _ in range(n):
+                    func()
+                return t.get_time() / n
+
+        tracer = VizTracer(verbose=0)
+        logging.info("Clock performance:")
+        for clock in ["tsc", "monotonic", "monotonic_coarse"]:
+            try:
+                tracer.clock = clock
+            except ValueError:
+                logging.info(f"{clock:<17} not available")
+                continue
+
+            # The cost of reading the clock, minus a similar call without it
+            read = time_calls(tracer.getts) - time_calls(tracer.get_base_time)
+
+            tracer.start()
+            with Timer() as t:
+                hanoi()
+                trace = t.get_time()
+            tracer.stop()
+            tracer.clear()
+
+            logging.info(f"{clock:<17} read: {read * 1e9:.1f}ns trace: {trace:.9f}")
+        tracer.clock = "auto"
@@ -1,12 +1,19 @@
 # Licensed under the Apache License: http://www.apache.org/licenses/LICENSE-2.0
 # For details: https://github.com/gaogaotiantian/viztracer/blob/master/NOTICE.txt
 
+import dataclasses
+import gc
 import json
 import os
+import sys
 import tempfile
+import threading
 import time
+import weakref
+from unittest import skipIf
 
 from viztracer import VizTracer
+from viztracer.snaptrace import Tracer
 
 from .base_tmpl import BaseTmpl
 
@@ -80,6 +87,49 @@ class TestCTracer(BaseTmpl):
         tracer.clear()
         tracer.clear()
 
+    def test_c_event_content(self):
+        tracer = VizTracer(verbose=0, log_func_args=True, log_func_retval=True)
+        tracer.start()
+        fib(1)
+        len([1, 2])
+        "a b".split()
+        tracer.stop()
+        events = [e for e in tracer.load() if e["ph"] == "X"]
+        self.assertEqual(len(events), 3)
+        self.assertEqual(
+            events[0]["args"], {"func_args": {"n": "1"}, "return_value": "1"}
+        )
+        self.assertEqual(events[1]["name"], "builtins.len")
+        self.assertEqual(events[2]["name"], "str.split")
+        self.assertNotIn("args", events[1])
+
+        tracer.start()
+        tracer.add_object("N", "1", "obj")
+        with self.assertRaises(ValueError):
+            tracer.add_object("NN", "1", "obj")
+        tracer.stop()
+        events = [e for e in tracer.load() if e["ph"] == "N"]
+        self.assertEqual(events[0]["id"], "1")
+
+    def test_swap_buffer(self):
+        tracer = VizTracer(verbose=0)
+        tracer.start()
+        fib(5)
+        snapshot = tracer.swap_buffer()
+        fib(3)
+        tracer.stop()
+
+        self.assertEqual(tracer.parse(), 5)
+        events = snapshot.load()
+        self.assertEqual(len([e for e in events if e["ph"] == "X"]), 15)
+        self.assertEqual(events[1]["args"]["name"], "MainThread")
+
+        with self.assertRaises(RuntimeError):
+            snapshot.start()
+
+        with self.assertRaises(RuntimeError):
+            snapshot.swap_buffer()
+
 
 class TestCircularBuffer(BaseTmpl):
     def test_wrap(self):
@@ -90,6 +140,33 @@ class TestCircularBuffer(BaseTmpl):
         entries = tracer.parse()
         self.assertEqual(entries, 10)
 
+    def test_memory_limit(self):
+        def foo(s):
+            return s
+
+        tracer = VizTracer(tracer_memory=64 * 1024, verbose=0, log_func_args=True)
+        tracer.start()
+        for _ in range(5000):
+            foo("a" * 100)
+        tracer.stop()
+        usage = tracer.memory_usage()
+        self.assertLessEqual(usage, 64 * 1024)
+        self.assertGreater(usage, 32 * 1024)
+        entries = tracer.parse()
+        self.assertGreater(entries, 10)
+        self.assertLess(entries, 1000)
+        self.assertEqual(tracer.memory_usage(), 0)
+
+        tracer = VizTracer(verbose=0, log_func_args=True)
+        tracer.start()
+        for _ in range(10):
+            foo("a" * 100)
+        tracer.stop()
+        self.assertGreater(tracer.memory_usage(), 10 * 100)
+
+        with self.assertRaises(ValueError):
+            Tracer(100, 1)
+
 
 class TestTracerFilter(BaseTmpl):
     def test_max_stack_depth(self):
@@ -235,6 +312,852 @@ class TestTracerFeature(BaseTmpl):
             and events[0]["args"]["func_args"]["n"] == "deadbeef"
         )
 
+    def test_log_func_repr_limit(self):
+        def foo(a, b, c, d, e, f):
+            return e
+
+        tracer = VizTracer(
+            verbose=0,
+            log_func_args=True,
+            log_func_retval=True,
+            log_func_repr_limit=10,
+        )
+        tracer.start()
+        foo(None, True, 10**20, 0.5, "a" * 20, [1] * 10)
+        tracer.stop()
+        tracer.parse()
+        events = [e for e in tracer.data["traceEvents"] if e["ph"] == "X"]
+        self.assertEqual(
+            events[0]["args"]["func_args"],
+            {
+                "a": "None",
+                "b": "True",
+                "c": "1000000000...",
+                "d": "0.5",
+                "e": "'aaaaaaaaa...",
+                "f": "[1, 1, 1, ...",
+            },
+        )
+        self.assertEqual(events[0]["args"]["return_value"], "'aaaaaaaaa...")
+
+    def test_log_func_repr_limit_large(self):
+        repr_count = 0
+
+        class Item:
+            def __repr__(self):
+                nonlocal repr_count
+                repr_count += 1
+                return "Item()"
+
+        def foo(a, b, c):
+            return a
+
+        tracer = VizTracer(
+            verbose=0,
+            log_func_args=True,
+            log_func_repr_limit=20,
+        )
+        items = [Item() for _ in range(10000)]
+        tracer.start()
+        foo(items, {"items": items, "text": "a'b" * 10000}, (items,))
+        tracer.stop()
+        tracer.parse()
+        events = [e for e in tracer.data["traceEvents"] if e["ph"] == "X"]
+        self.assertEqual(
+            events[0]["args"]["func_args"],
+            {
+                "a": "[Item(), Item(), Ite...",
+                "b": "{'items': [Item(), I...",
+                "c": "([Item(), Item(), It...",
+            },
+        )
+        self.assertLess(repr_count, 20)
+
+    def test_log_func_defer_repr(self):
+        @dataclasses.dataclass(frozen=True)
+        class Frozen:
+            key: str
+            values: tuple
+
+        def foo(a, b, c, d):
+            return a
+
+        repr_calls = []
+
+        def myrepr(obj):
+            repr_calls.append(obj)
+            return f"repr {obj}"
+
+        tracer = VizTracer(
+            verbose=0,
+            log_func_args=True,
+            log_func_retval=True,
+            log_func_repr=myrepr,
+            log_func_defer_repr=True,
+        )
+        # Create the objects before tracing, __init__ sees an incomplete self
+        frozen = Frozen("a", (1, "b"))
+        lst = [1]
+        tracer.start()
+        foo(frozen, (1, 2), "s", lst)
+        tracer.stop()
+        lst.append(2)
+        # Only the mutable list is repr'ed eagerly
+        self.assertEqual(len(repr_calls), 1)
+        self.assertIs(repr_calls[0], lst)
+        tracer.parse()
+        events = [e for e in tracer.data["traceEvents"] if e["ph"] == "X"]
+        self.assertEqual(
+            events[0]["args"],
+            {
+                "func_args": {
+                    "a": f"repr {frozen}",
+                    "b": "repr (1, 2)",
+                    "c": "repr s",
+                    "d": "repr [1]",
+                },
+                "return_value": f"repr {frozen}",
+            },
+        )
+
+        tracer = VizTracer(
+            verbose=0,
+            log_func_args=True,
+            log_func_defer_repr=True,
+            log_func_snapshot=list,
+        )
+        lst = [1]
+        tracer.start()
+        foo(None, 1, {"a": [1]}, lst)
+        tracer.stop()
+        lst.append(2)
+        tracer.parse()
+        events = [e for e in tracer.data["traceEvents"] if e["ph"] == "X"]
+        self.assertEqual(
+            events[0]["args"]["func_args"],
+            {"a": "None", "b": "1", "c": "['a']", "d": "[1]"},
+        )
+
+    def test_log_func_filter(self):
+        class A:
+            def method(self, x):
+                return x
+
+        def foo(a):
+            return a
+
+        def bar(b):
+            return b
+
+        lineno = bar.__code__.co_firstlineno
+        for log_func_filter, expected in (
+            (["foo"], ["foo"]),
+            (["TestTracerFeature.test_log_func_filter.<locals>.A"], ["method"]),
+            ([f"{__name__}.TestTracerFeature"], ["foo", "bar", "method"]),
+            ([f"{__file__}:{lineno}"], ["bar"]),
+            ([f"{os.path.basename(__file__)}:{lineno}"], ["bar"]),
+            (["oo", "bar.b"], []),
+        ):
+            with self.subTest(log_func_filter=log_func_filter):
+                tracer = VizTracer(
+                    verbose=0,
+                    log_func_args=True,
+                    log_func_retval=True,
+                    log_func_filter=log_func_filter,
+                )
+                tracer.start()
+                foo(1)
+                bar(2)
+                A().method(3)
+                tracer.stop()
+                tracer.parse()
+                logged = [
+                    e["name"].split()[0].split(".")[-1]
+                    for e in tracer.data["traceEvents"]
+                    if e["ph"] == "X" and "args" in e
+                ]
+                self.assertEqual(logged, expected)
+
+    def test_throttle(self):
+        def tiny(x):
+            return x
+
+        def slow():
+            time.sleep(0.002)
+
+        tracer = VizTracer(verbose=0, throttle_rate=1000, throttle_duration=100)
+        self.assertEqual(tracer.throttle_duration, 100)
+        tracer.start()
+        for i in range(30):
+            for _ in range(1000):
+                tiny(i)
+            slow()
+            time.sleep(0.01)
+        tracer.stop()
+        tracer.parse()
+        events = tracer.data["traceEvents"]
+        tiny_events = [
+            e for e in events if e["ph"] == "X" and "<locals>.tiny " in e["name"]
+        ]
+        slow_events = [
+            e for e in events if e["ph"] == "X" and "<locals>.slow " in e["name"]
+        ]
+        summaries = [e for e in events if e["ph"] == "C"]
+        self.assertLess(len(tiny_events), 30000)
+        self.assertEqual(len(slow_events), 30)
+        self.assertTrue(all("<locals>.tiny " in e["name"] for e in summaries))
+        self.assertEqual(
+            len(tiny_events) + sum(e["args"]["calls"] for e in summaries), 30000
+        )
+
+    def test_tail_roots(self):
+        def step():
+            pass
+
+        def handler(i):
+            step()
+            # Dropped or kept with the root
+            tracer.log_instant(f"instant {i}")
+            tracer.add_counter("counter", {"i": i})
+            if i % 5 == 0:
+                time.sleep(0.002)
+
+        def long_handler():
+            for _ in range(2000):
+                step()
+            time.sleep(0.002)
+
+        tracer = VizTracer(verbose=0, tail_roots=["handler"], tail_duration=1000)
+        self.assertEqual(tracer.tail_duration, 1000)
+        tracer.start()
+        for i in range(20):
+            handler(i)
+        step()
+        tracer.stop()
+        tracer.parse()
+        names = [
+            e["name"].split()[0].split(".")[-1]
+            for e in tracer.data["traceEvents"]
+            if e["ph"] == "X"
+        ]
+        self.assertEqual(names.count("handler"), 4)
+        self.assertEqual(names.count("sleep"), 4)
+        # 4 under the slow handlers and 1 outside
+        self.assertEqual(names.count("step"), 5)
+        instants = [e["name"] for e in tracer.data["traceEvents"] if e["ph"] == "i"]
+        self.assertEqual(instants, [f"instant {i}" for i in range(0, 20, 5)])
+        counters = [e["args"] for e in tracer.data["traceEvents"] if e["ph"] == "C"]
+        self.assertEqual(counters, [{"i": i} for i in range(0, 20, 5)])
+
+        # The stage drops the oldest entries when it's as large as the buffer
+        tracer = VizTracer(
+            verbose=0,
+            tail_roots=["long_handler"],
+            tail_duration=1000,
+            tracer_entries=1000,
+        )
+        tracer.start()
+        long_handler()
+        tracer.stop()
+        tracer.parse()
+        events = [e for e in tracer.data["traceEvents"] if e["ph"] == "X"]
+        names = [e["name"].split()[0].split(".")[-1] for e in events]
+        self.assertEqual(names[-2:], ["sleep", "long_handler"])
+        self.assertGreater(names.count("step"), 900)
+
+    def test_trigger_functions(self):
+        def leaf():
+            pass
+
+        def inner():
+            leaf()
+
+        def trigger():
+            inner()
+
+        def outer():
+            leaf()
+            trigger()
+
+        tracer = VizTracer(verbose=0, trigger_functions=["trigger"], max_stack_depth=2)
+        tracer.start()
+        outer()
+        t = threading.Thread(target=outer)
+        t.start()
+        t.join()
+        leaf()
+        tracer.stop()
+        tracer.parse()
+        names = [
+            e["name"].split()[0].split(".")[-1]
+            for e in tracer.data["traceEvents"]
+            if e["ph"] == "X"
+        ]
+        self.assertEqual(sorted(names), ["inner", "inner", "trigger", "trigger"])
+
+    def test_sample_rate(self):
+        def trigger():
+            pass
+
+        tracer = VizTracer(verbose=0, trigger_functions=["trigger"], sample_rate=0.1)
+        self.assertEqual(tracer.sample_rate, 0.1)
+        tracer.start()
+        for _ in range(100):
+            trigger()
+        tracer.stop()
+        tracer.parse()
+        events = [e for e in tracer.data["traceEvents"] if e["ph"] == "X"]
+        self.assertEqual(len(events), 10)
+
+        def root():
+            trigger()
+
+        tracer = VizTracer(verbose=0, tail_roots=["root"], sample_rate=0.25)
+        tracer.start()
+        for _ in range(20):
+            root()
+        tracer.stop()
+        tracer.parse()
+        names = [
+            e["name"].split()[0].split(".")[-1]
+            for e in tracer.data["traceEvents"]
+            if e["ph"] == "X"
+        ]
+        self.assertEqual(sorted(names), ["root"] * 5 + ["trigger"] * 5)
+
+    def test_log_cpu_time(self):
+        def busy():
+            # Spin until the thread actually used the CPU time, the wall time
+            # could be much longer if the machine is busy
+            start = time.thread_time()
+            while time.thread_time() - start < 0.01:
+                pass
+
+        def idle():
+            time.sleep(0.05)
+
+        tracer = VizTracer(verbose=0, log_cpu_time=True)
+        tracer.start()
+        busy()
+        idle()
+        tracer.stop()
+        tracer.parse()
+        events = {
+            e["name"].split()[0].split(".")[-1]: e
+            for e in tracer.data["traceEvents"]
+            if e["ph"] == "X"
+        }
+        self.assertGreater(events["busy"]["tdur"], events["idle"]["tdur"])
+        self.assertLess(events["idle"]["tdur"], events["idle"]["dur"])
+        self.assertGreaterEqual(events["idle"]["tts"], events["busy"]["tts"])
+        self.assertIn("tdur", events["sleep"])
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "result.json")
+            tracer.save(path)
+            with open(path) as f:
+                data = json.load(f)
+            events = [e for e in data["traceEvents"] if e["ph"] == "X"]
+            self.assertTrue(all("tts" in e and "tdur" in e for e in events))
+
+    def test_clock(self):
+        def sleep():
+            time.sleep(0.02)
+
+        tracer = VizTracer(verbose=0)
+        self.assertIn(tracer.clock, ["tsc", "monotonic"])
+        for clock in ["tsc", "monotonic", "monotonic_coarse"]:
+            try:
+                tracer.clock = clock
+            except ValueError:
+                continue
+            self.assertEqual(tracer.clock, clock)
+            tracer.start()
+            with self.assertRaises(RuntimeError):
+                tracer.clock = "auto"
+            sleep()
+            tracer.stop()
+            tracer.parse()
+            events = [e for e in tracer.data["traceEvents"] if e["ph"] == "X"]
+            self.assertEqual(len({e["ts"] for e in events}), len(events))
+            event = next(
+                e for e in events if e["name"].split()[0].split(".")[-1] == "sleep"
+            )
+            if clock != "monotonic_coarse":
+                # The coarse clock could be a few ms off
+                self.assertGreater(event["dur"], 10000)
+            self.assertLess(event["dur"], 1000000)
+            tracer.clear()
+
+        with self.assertRaises(ValueError):
+            tracer.clock = "rdtsc"
+        tracer.clock = "auto"
+
+    def test_cfunction_types(self):
+        # The types of the C methods are not kept alive by the tracer
+        classes = [type(f"List{i}", (list,), {}) for i in range(10)]
+        refs = [weakref.ref(cls) for cls in classes]
+        tracer = VizTracer(verbose=0)
+        tracer.start()
+        for cls in classes:
+            cls().append(0)
+        tracer.stop()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "result.json")
+            tracer.save(path)
+            with open(path) as f:
+                data = json.load(f)
+        names = {e["name"] for e in data["traceEvents"] if e["ph"] == "X"}
+        self.assertTrue(all(f"List{i}.append" in names for i in range(10)))
+
+        del tracer, classes, cls
+        gc.collect()
+        self.assertTrue(all(ref() is None for ref in refs))
+
+    def test_cfunction_interleaved(self):
+        # The C function info is shared by all the tracers and snapshots
+        tracer = VizTracer(verbose=0)
+        other_tracer = VizTracer(verbose=0, register_global=False)
+        tracer.start()
+        [].append(0)
+        snapshot = tracer.swap_buffer()
+        tracer.stop()
+        tracer.clear()
+
+        other_tracer.start()
+        {}.get(0)
+        other_tracer.stop()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            other_tracer.dump(os.path.join(tmpdir, "result.json"))
+        other_tracer.clear()
+
+        tracer.start()
+        ().count(0)
+        tracer.stop()
+        names = {e["name"] for e in snapshot.load() if e["ph"] == "X"}
+        self.assertIn("list.append", names)
+        tracer.parse()
+        names = {e["name"] for e in tracer.data["traceEvents"] if e["ph"] == "X"}
+        self.assertIn("tuple.count", names)
+
+    def test_clock_unsaved(self):
+        def sleep():
+            time.sleep(0.01)
+
+        other_tracer = VizTracer(verbose=0, register_global=False)
+        tracer = VizTracer(verbose=0, clock="monotonic")
+        tracer.start()
+        sleep()
+        tracer.stop()
+        # The timestamps in the buffer are converted with the clock when
+        # they are saved, so the clock can't be changed before that
+        with self.assertRaises(RuntimeError):
+            other_tracer.clock = "monotonic_coarse"
+        tracer.parse()
+        event = next(
+            e
+            for e in tracer.data["traceEvents"]
+            if e["ph"] == "X" and e["name"].split()[0].split(".")[-1] == "sleep"
+        )
+        self.assertGreater(event["dur"], 10000)
+        self.assertLess(event["dur"], 1000000)
+        tracer.clock = "auto"
+
+    @skipIf(sys.version_info < (3, 12), "Exception events need sys.monitoring")
+    def test_log_exception(self):
+        def handled():
+            try:
+                int("x")
+            except ValueError:
+                pass
+
+        def reraised():
+            try:
+                raise KeyError("key")
+            except KeyError:
+                raise
+
+        tracer = VizTracer(verbose=0, log_exception=True)
+        tracer.start()
+        handled()
+        try:
+            reraised()
+        except KeyError:
+            pass
+        tracer.stop()
+        tracer.parse()
+        events = [
+            (
+                e["name"],
+                e["args"]["event"],
+                e["args"]["location"].split()[0].split(".")[-1],
+            )
+            for e in tracer.data["traceEvents"]
+            if e["ph"] == "i"
+        ]
+        self.assertIn(("ValueError", "raise", "handled"), events)
+        self.assertIn(("ValueError", "handled", "handled"), events)
+        self.assertIn(("KeyError", "reraise", "reraised"), events)
+        event = next(e for e in tracer.data["traceEvents"] if e["ph"] == "i")
+        self.assertEqual(
+            event["args"]["message"], "invalid literal for int() with base 10: 'x'"
+        )
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "result.json")
+            tracer.start()
+            handled()
+            tracer.stop()
+            tracer.dump(path)
+            with open(path) as f:
+                data = json.load(f)
+            events = [e for e in data["traceEvents"] if e["ph"] == "i"]
+            self.assertEqual([e["name"] for e in events], ["ValueError"] * 2)
+            self.assertEqual(events[0]["args"]["event"], "raise")
+
+    def test_include_functions(self):
+        def leaf():
+            return len([])
+
+        def target():
+            leaf()
+            return len([])
+
+        tracer = VizTracer(verbose=0, include_functions=["target", "defined_later"])
+        tracer.start()
+        target()
+        leaf()
+
+        # Defined after the tracer starts
+        def defined_later():
+            leaf()
+
+        defined_later()
+        tracer.stop()
+        tracer.parse()
+        names = [
+            e["name"].split()[0].split(".")[-1]
+            for e in tracer.data["traceEvents"]
+            if e["ph"] == "X"
+        ]
+        self.assertEqual(sorted(names), ["defined_later", "len", "target"])
+        if sys.version_info >= (3, 12):
+            self.assertEqual(sys.monitoring.get_local_events(2, target.__code__), 0)
+
+        with self.assertRaises(TypeError):
+            tracer.include_functions = "target"
+
+    @skipIf(sys.version_info < (3, 12), "Line events need sys.monitoring")
+    def test_line_functions(self):
+        def hot(n):
+            s = 0
+            for i in range(n):
+                s += i
+            return s
+
+        def cold():
+            return 0
+
+        first_line = hot.__code__.co_firstlineno
+        tracer = VizTracer(verbose=0, line_functions=["hot"], log_line_events=True)
+        tracer.start()
+        hot(3)
+        cold()
+        tracer.stop()
+        tracer.parse()
+        events = tracer.data["traceEvents"]
+        stats = [e for e in events if e["ph"] == "i"]
+        self.assertEqual(len(stats), 1)
+        self.assertEqual(stats[0]["name"].split()[1].split(".")[-1], "hot")
+        hits = {
+            int(line) - first_line: line_stats["hits"]
+            for line, line_stats in stats[0]["args"].items()
+        }
+        self.assertEqual(hits, {1: 1, 2: 4, 3: 3, 4: 1})
+        lines = [e for e in events if e["ph"] == "X" and e["cat"] == "LINE"]
+        self.assertEqual(len(lines), 9)
+        hot_event = next(
+            e
+            for e in events
+            if e["ph"] == "X" and e["name"].split()[0].split(".")[-1] == "hot"
+        )
+        for line in lines:
+            # The last line ends with the function, up to the float error
+            self.assertGreaterEqual(line["ts"], hot_event["ts"])
+            self.assertLessEqual(
+                line["ts"] + line["dur"], hot_event["ts"] + hot_event["dur"] + 0.001
+            )
+        # The line events are only enabled when the tracer is on
+        self.assertEqual(sys.monitoring.get_local_events(2, hot.__code__), 0)
+
+        tracer = VizTracer(verbose=0, line_functions=["hot"])
+        tracer.start()
+        hot(1)
+        tracer.pause()
+        hot(1)
+        tracer.resume()
+        hot(1)
+        tracer.stop()
+        tracer.parse()
+        events = tracer.data["traceEvents"]
+        self.assertFalse(any(e.get("cat") == "LINE" for e in events))
+        stats = next(e for e in events if e["ph"] == "i")
+        self.assertEqual(stats["args"][str(first_line + 4)]["hits"], 2)
+
+    @skipIf(sys.version_info < (3, 12), "Multiple tracers need sys.monitoring")
+    def test_multiple_tracers(self):
+        def outer():
+            inner()
+
+        def inner():
+            return 0
+
+        def names(tracer):
+            tracer.parse()
+            return sorted(
+                e["name"].split()[0].split(".")[-1]
+                for e in tracer.data["traceEvents"]
+                if e["ph"] == "X"
+            )
+
+        tracer = VizTracer(verbose=0)
+        tracer.start()
+        outer()
+        inner_tracer = VizTracer(
+            verbose=0, register_global=False, include_functions=["inner"]
+        )
+        inner_tracer.start()
+        tool_ids = (tracer.tool_id, inner_tracer.tool_id)
+        outer()
+        inner_tracer.stop()
+        inner()
+        tracer.stop()
+        self.assertNotEqual(*tool_ids)
+        self.assertIsNone(tracer.tool_id)
+        self.assertEqual(names(inner_tracer), ["inner"])
+        self.assertEqual(names(tracer), ["inner", "inner", "inner", "outer", "outer"])
+
+        tracers = [VizTracer(verbose=0, register_global=False) for _ in range(3)]
+        for t in tracers:
+            t.start()
+        self.assertEqual(len({t.tool_id for t in tracers}), 3)
+        with self.assertRaises(RuntimeError):
+            VizTracer(verbose=0, register_global=False).start()
+        for t in tracers:
+            t.stop()
+        self.assertTrue(all(t.tool_id is None for t in tracers))
+
+    @skipIf(sys.version_info < (3, 12), "Multiple tracers need sys.monitoring")
+    def test_multiple_tracers_code_state(self):
+        # The state kept on the code objects is not shared by the tracers
+        def hot(n):
+            s = 0
+            for i in range(n):
+                s += i
+            return s
+
+        def tiny():
+            pass
+
+        tracers = [
+            VizTracer(
+                verbose=0,
+                register_global=False,
+                line_functions=["hot"],
+                throttle_rate=1000,
+            )
+            for _ in range(2)
+        ]
+        for t in tracers:
+            t.start()
+        hot(10)
+        # Throttling is decided for each window of 100ms
+        for _ in range(30):
+            for _ in range(1000):
+                tiny()
+            time.sleep(0.01)
+        for t in tracers:
+            t.stop()
+
+        first_line = hot.__code__.co_firstlineno
+        for t in tracers:
+            t.parse()
+            events = t.data["traceEvents"]
+            stats = [e for e in events if e["ph"] == "i"]
+            self.assertEqual(len(stats), 1)
+            self.assertEqual(stats[0]["args"][str(first_line + 3)]["hits"], 10)
+            tiny_events = [
+                e for e in events if e["ph"] == "X" and "<locals>.tiny " in e["name"]
+            ]
+            summaries = [e for e in events if e["ph"] == "C"]
+            self.assertLess(len(tiny_events), 30000)
+            self.assertEqual(
+                len(tiny_events) + sum(e["args"]["calls"] for e in summaries), 30000
+            )
+
+    def test_log_async(self):
+        import asyncio
+
+        async def work():
+            await asyncio.sleep(0)
+            await asyncio.sleep(0)
+
+        async def main():
+            await asyncio.gather(
+                *[asyncio.create_task(work(), name=f"worker-{i}") for i in range(3)]
+            )
+
+        tracer = VizTracer(verbose=0, log_async=True)
+        tracer.start()
+        asyncio.run(main())
+        tracer.stop()
+        tracer.parse()
+        events = tracer.data["traceEvents"]
+        names = {
+            e["tid"]: e["args"]["name"]
+            for e in events
+            if e["ph"] == "M" and e["name"] == "thread_name"
+        }
+        work_tids = {
+            e["tid"]
+            for e in events
+            if e["ph"] == "X" and e["name"].split()[0].split(".")[-1] == "work"
+        }
+        self.assertEqual(
+            sorted(names[tid] for tid in work_tids),
+            ["worker-0", "worker-1", "worker-2"],
+        )
+        # The loop switches between the workers for each step
+        switches = [e["args"] for e in events if e["name"] == "task switch"]
+        self.assertEqual(
+            [s["task"] for s in switches if s["task"].startswith("worker")],
+            ["worker-0", "worker-1", "worker-2"] * 3,
+        )
+        self.assertTrue(all(names[s["tid"]] == s["task"] for s in switches))
+
+    def test_log_async_flow(self):
+        import asyncio
+
+        async def produce(fut):
+            await asyncio.sleep(0)
+            fut.set_result(1)
+
+        async def consume(fut):
+            return await fut
+
+        async def main():
+            fut = asyncio.get_running_loop().create_future()
+            consumer = asyncio.create_task(consume(fut), name="consumer")
+            await asyncio.create_task(produce(fut), name="producer")
+            await consumer
+
+        for ignore_c_function in (False, True):
+            with self.subTest(ignore_c_function=ignore_c_function):
+                tracer = VizTracer(
+                    verbose=0, log_async=True, ignore_c_function=ignore_c_function
+                )
+                tracer.start()
+                asyncio.run(main())
+                tracer.stop()
+                tracer.parse()
+                events = tracer.data["traceEvents"]
+                names = {
+                    e["tid"]: e["args"]["name"]
+                    for e in events
+                    if e["ph"] == "M" and e["name"] == "thread_name"
+                }
+                flows = {}
+                for e in events:
+                    if e.get("cat") == "await":
+                        flows.setdefault(e["id"], []).append(e)
+                pairs = []
+                for start, finish in flows.values():
+                    self.assertEqual((start["ph"], finish["ph"]), ("s", "f"))
+                    self.assertLessEqual(start["ts"], finish["ts"])
+                    pairs.append((names.get(start["tid"]), names[finish["tid"]]))
+                # The future is done by set_result() in producer
+                self.assertEqual(
+                    ("producer", "consumer") in pairs, not ignore_c_function
+                )
+                # The unnamed main task waits for producer to finish
+                self.assertTrue(
+                    any(s == "producer" and f.startswith("Task-") for s, f in pairs)
+                )
+
+    def test_log_memory(self):
+        def allocate():
+            return [[i] for i in range(10000)]
+
+        def noop():
+            pass
+
+        tracer = VizTracer(verbose=0, log_memory=True)
+        tracer.start()
+        allocate()
+        noop()
+        tracer.stop()
+        tracer.parse()
+        events = {
+            e["name"].split()[0].split(".")[-1]: e
+            for e in tracer.data["traceEvents"]
+            if e["ph"] == "X"
+        }
+        self.assertGreater(events["allocate"]["args"]["alloc_bytes"], 10000 * 56)
+        self.assertEqual(events["noop"]["args"]["alloc_bytes"], 0)
+        counters = [
+            e
+            for e in tracer.data["traceEvents"]
+            if e["ph"] == "C" and e["name"] == "allocated bytes"
+        ]
+        self.assertTrue(counters)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "result.json")
+            tracer.save(path)
+            with open(path) as f:
+                data = json.load(f)
+            events = [e for e in data["traceEvents"] if e["ph"] == "X"]
+            self.assertTrue(all("alloc_bytes" in e["args"] for e in events))
+
+    def test_fold_loops(self):
+        def leaf(x):
+            return x
+
+        def validate(x):
+            leaf(x)
+            return leaf(x)
+
+        def other():
+            pass
+
+        tracer = VizTracer(verbose=0, fold_loops=True)
+        tracer.start()
+        for i in range(100):
+            validate(i)
+        other()
+        for i in range(3):
+            validate(i)
+        tracer.stop()
+        tracer.parse()
+        events = [
+            (e["name"].split()[0].split(".")[-1], e.get("args", {}).get("folded"))
+            for e in tracer.data["traceEvents"]
+            if e["ph"] == "X"
+        ]
+        self.assertEqual(
+            [(name, folded and folded["count"]) for name, folded in events],
+            [
+                ("leaf", 2),
+                ("validate", 100),
+                ("other", None),
+                ("leaf", 2),
+                ("validate", 3),
+            ],
+        )
+        folded = events[1][1]
+        self.assertLessEqual(folded["min"], folded["max"])
+        self.assertLessEqual(folded["max"], folded["total"])
+
     def test_log_gc(self):
         import gc
 
@@ -39,6 +39,15 @@ class TestUtil(BaseTmpl):
         self.assertRaises(ValueError, time_str_to_us, "0.0.0")
         self.assertRaises(ValueError, time_str_to_us, "invalid")
 
+    def test_size_str_to_bytes(self):
+        size_str_to_bytes = viztracer.util.size_str_to_bytes
+        self.assertEqual(size_str_to_bytes("4096"), 4096)
+        self.assertEqual(size_str_to_bytes("300KiB"), 300 * 1024)
+        self.assertEqual(size_str_to_bytes("512MB"), 512 * 1024**2)
+        self.assertEqual(size_str_to_bytes("1.5g"), int(1.5 * 1024**3))
+        self.assertRaises(ValueError, size_str_to_bytes, "0.0.0MB")
+        self.assertRaises(ValueError, size_str_to_bytes, "invalid")
+
     def test_pid_exists(self):
         pid_exists = viztracer.util.pid_exists
         self.assertFalse(pid_exists(-1))